@@ -0,0 +1,870 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import heapq
+import weakref
+from time import monotonic
+
+import pymongo
+from bson import ObjectId
+from pymongo import UpdateOne, InsertOne, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from pymdict.bson_order import bson_identity, document_sort_key
+from pymdict.mongo_client_pool import KEY_INDEX
+from pymdict.mongo_dict import ___MONGO_DICT_META___, ITERATION_CHUNK_SIZE, BasicMongoDict, ForkedMongoDict, \
+    BulkMongoDict
+from pymdict.mongo_query_parser import QUERY_PARSER
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+# Motor clients are bound to an event loop, so they are shared per loop and (host, port, database, credentials).
+# Loops are weakly referenced: once a loop is garbage collected its clients are released with it.
+_clients = weakref.WeakKeyDictionary()
+
+# Indexes already requested, per client: {client: {(collection full name, index name)}}.
+_indexed = weakref.WeakKeyDictionary()
+
+
+def _get_client(mongo_host:str, mongo_port:int, mongo_database:str, credentials:tuple=None):
+    if AsyncIOMotorClient is None:
+        raise ImportError("AsyncMongoDict requires the motor package. Install it with: pip3 install pymdict[async]")
+
+    if credentials is not None and len(credentials) == 2:
+        credentials = tuple(credentials)
+    else:
+        credentials = None
+
+    loop_clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (mongo_host, mongo_port, mongo_database, credentials)
+    client = loop_clients.get(key)
+
+    if client is None:
+        mongo_uri = "mongodb://"
+
+        if credentials is not None:
+            mongo_uri += "{}:{}@".format(credentials[0], credentials[1])
+
+        mongo_uri += "{}:{}/{}".format(mongo_host, mongo_port, mongo_database)
+
+        client = AsyncIOMotorClient(mongo_uri)
+        loop_clients[key] = client
+
+    return client
+
+
+class AsyncMongoDict:
+    """
+    Asyncio version of MongoDict. It shares the storage format with MongoDict, so both can work over the same
+    dictionaries, including their versions and forks.
+
+    Every operation that reaches the backend is a coroutine:
+
+        >>> d = AsyncMongoDict("my_dict", mongo_host="localhost")
+        >>> await d.set('k1', 'v1')
+        >>> await d['k1']
+        'v1'
+        >>> await d.get('k2', default=None)
+        >>> await d.get_many(['k1', 'k2'])
+        {'k1': 'v1', 'k2': None}
+        >>> async for key, value in d.items():
+        ...     print("{}: {}".format(key, value))
+        >>> async for key, value, _id in d('value % v'):
+        ...     print("{}: {}".format(key, value))
+        >>> await d.create_value_index('value.age')
+        >>> async for key, value, _id in d('value.age > 40', sort='value.age desc', limit=10):
+        ...     print("{}: {}".format(key, value))
+        >>> async with d.bulk() as b:
+        ...     await b.set('k2', 'v2')
+        >>> fork = await d.fork()
+
+    The version of the dictionary is loaded on its first operation. New versions created by other instances (for
+    example, by forking this dictionary) are picked by the next operation, as in MongoDict: the latest version is read
+    from the metadata at most once every version_check_interval seconds. Call reload() to pick them immediately.
+
+    Requires Python 3.6 onwards and the motor package.
+    """
+
+    def __init__(self, original_dict_id:str=None, mongo_host:str="localhost", mongo_port:int=27017,
+                 mongo_database="mongo_dicts", credentials:tuple=None, version=None, version_check_interval:float=1):
+        """
+        Instantiates the dictionary back-ended in mongo. No connection is done until the first operation.
+        :param original_dict_id: ID of the dictionary. Same meaning as in MongoDict.
+        :param mongo_host:  host of the mongodb
+        :param mongo_port:  port of the mongodb
+        :param mongo_database:  database name of the mongo db. By default it will use "mongo_dicts"
+        :param credentials: tuple containing the user and password. Leave it as None if no credentials are required.
+        :param version: version of the dict to load. If None, it loads the latest one.
+        :param version_check_interval: seconds between reads of the latest version of the dict, when no version is
+                    requested. 0 reads it before every operation.
+        """
+        if original_dict_id is None:
+            original_dict_id = str(ObjectId())
+
+        self._original_dict_id = original_dict_id
+        self._mongo_host = mongo_host
+        self._mongo_port = mongo_port
+        self._mongo_database = mongo_database
+        self._credentials = credentials
+        self._requested_version = version
+        self._version = None
+        self._layers = None
+        self._version_check_interval = version_check_interval
+        self._version_checked = None
+
+    @property
+    def _storage(self):
+        return _get_client(self._mongo_host, self._mongo_port, self._mongo_database,
+                           self._credentials)[self._mongo_database]
+
+    @property
+    def _dict_meta(self):
+        return self._storage[___MONGO_DICT_META___]
+
+    @property
+    def _instance(self):
+        return self._layers[0]
+
+    def _is_fork(self):
+        return len(self._layers) > 1
+
+    async def _ensure_key_index(self, collection):
+        await self._ensure_index(collection, [('key', pymongo.ASCENDING)], KEY_INDEX, unique=True)
+
+    @staticmethod
+    async def _ensure_index(collection, keys:list, name:str, **kwargs):
+        indexed = _indexed.setdefault(collection.database.client, set())
+        index_key = (collection.full_name, name)
+
+        if index_key not in indexed:
+            await collection.create_index(keys, name=name, **kwargs)
+            indexed.add(index_key)
+
+    async def _ensure_value_indexes(self, metadata:dict):
+        """
+        Creates the value indexes recorded in the metadata of this dict on its own collection, as MongoDict does.
+        """
+        for index in metadata.get('value_indexes', []):
+            await self._ensure_index(self._instance, [tuple(key) for key in index['keys']], index['name'])
+
+    async def _load(self):
+        if self._layers is None:
+            await self.reload()
+
+        elif self._requested_version is None and \
+                monotonic() - self._version_checked >= self._version_check_interval:
+            # Other instances may have created a new version meanwhile (MongoDict is told by its version watcher)
+            document = await self._dict_meta.find_one({'key': self._original_dict_id}, {'value.version': 1})
+            versions = document['value']['version'] if document is not None else []
+
+            if (versions[-1] if len(versions) > 0 else 0) != self._version:
+                await self.reload()
+            else:
+                self._version_checked = monotonic()
+
+    async def reload(self):
+        """
+        Loads the requested version of the dictionary (or the latest one), and the chain of collections behind it.
+        """
+        metadata_cache = {}
+
+        async def read_metadata(dict_id):
+            if dict_id not in metadata_cache:
+                document = await self._dict_meta.find_one({'key': dict_id})
+                metadata_cache[dict_id] = document['value'] if document is not None else None
+
+            return metadata_cache[dict_id]
+
+        metadata = await read_metadata(self._original_dict_id)
+
+        if metadata is None:
+            # Only inserted if no other process has created it meanwhile
+            await self._dict_meta.update_one({'key': self._original_dict_id},
+                                             {'$setOnInsert': {'value': {'version': [], 'modified': True}}},
+                                             upsert=True)
+            del metadata_cache[self._original_dict_id]
+            metadata = await read_metadata(self._original_dict_id)
+
+        own_metadata = metadata
+
+        if self._requested_version is not None:
+            self._version = self._requested_version
+        else:
+            self._version = metadata['version'][-1] if len(metadata['version']) > 0 else 0
+
+        # Same rules as MongoDict._load_version(), walked iteratively
+        layers = []
+        dict_id, version = self._original_dict_id, self._version
+
+        while True:
+            layers.append(self._storage[dict_id + ("v{}".format(version) if version > 0 else "")])
+
+            if version in metadata.get('base_versions', []):
+                break
+            elif version > 0:
+                version -= 1
+            elif 'ancestor_fork' in metadata:
+                dict_id, version = metadata['ancestor_fork'], metadata['ancestor_version']
+                metadata = await read_metadata(dict_id)
+
+                if metadata is None:
+                    break
+            else:
+                break
+
+        self._layers = layers
+        self._version_checked = monotonic()
+        await self._ensure_key_index(self._instance)
+        await self._ensure_value_indexes(own_metadata)
+
+    async def create_value_index(self, fields):
+        """
+        Creates an index over fields of the values, shared with MongoDict. Same behaviour as
+        MongoDict.create_value_index().
+        :param fields: fields of the index, with the same syntax as the sort of queries.
+        :return: name of the index.
+        """
+        await self._load()
+        keys = QUERY_PARSER.transform_sort(fields)
+
+        for field, _ in keys:
+            BasicMongoDict._check_query_field(field, ["value"])
+
+        name = "_".join("{}_{}".format(field, direction) for field, direction in keys)
+        await self._dict_meta.update_one({'key': self._original_dict_id}, {'$addToSet': {
+            'value.value_indexes': {'name': name, 'keys': [[field, direction] for field, direction in keys]}}})
+
+        for collection in self._layers:
+            await self._ensure_index(collection, keys, name)
+
+        return name
+
+    async def value_indexes(self):
+        """
+        Retrieves the indexes over fields of the values of the dictionary, created with create_value_index().
+        :return: dict with the name of each index and its list of (field, direction) pairs.
+        """
+        document = await self._dict_meta.find_one({'key': self._original_dict_id})
+        metadata = document['value'] if document is not None else {}
+
+        return {index['name']: [tuple(key) for key in index['keys']] for index in metadata.get('value_indexes', [])}
+
+    async def _on_modified(self):
+        await self._dict_meta.update_one({'key': self._original_dict_id}, {'$set': {'value.modified': True}})
+
+    async def _length_delta(self, changes:list):
+        """
+        Computes how many entries some changes add to this dict, as MongoDict._length_delta() does. Only forks keep a
+        length counter.
+        :param changes: list of tuples (key, visible), where visible tells whether the key is in the dict after the
+                    change.
+        :return: the difference of length, or None if this dict does not keep a length counter.
+        """
+        if not self._is_fork() or len(changes) == 0:
+            return None
+
+        latest = {}
+        for key, visible in changes:
+            latest[bson_identity(key)] = visible
+
+        keys = [key for key, _ in changes]
+
+        async def query_layer(collection):
+            return await collection.find({'key': {'$in': keys}}, {'_id': 0, 'key': 1, '___removed': 1}).to_list(None)
+
+        previous = {}
+
+        # Layers are ordered by precedence: documents of upper layers win
+        for documents in await asyncio.gather(*[query_layer(collection) for collection in self._layers]):
+            for document in documents:
+                previous.setdefault(bson_identity(document['key']), '___removed' not in document)
+
+        return sum(int(visible) - int(previous.get(identity, False)) for identity, visible in latest.items())
+
+    async def _add_length(self, delta):
+        if delta:
+            field = 'value.lengths.{}'.format(self._version)
+            await self._dict_meta.update_one({'key': self._original_dict_id, field: {'$exists': True}},
+                                             {'$inc': {field: delta}})
+
+    async def _forget_length(self):
+        if self._is_fork():
+            await self._dict_meta.update_one({'key': self._original_dict_id},
+                                             {'$unset': {'value.lengths.{}'.format(self._version): ""}})
+
+    async def _get_many_raw(self, keys:list):
+        """
+        Retrieves the raw documents for the given keys, resolved through the whole fork and version chain. Every layer
+        is queried concurrently.
+        :return: dict of bson_identity() of the key -> document (it might be a tombstone). Keys not found are not
+                    included.
+        """
+        async def query_layer(collection):
+            return await collection.find({'key': {'$in': keys}}, {'_id': 0}).to_list(None)
+
+        layers_documents = await asyncio.gather(*[query_layer(collection) for collection in self._layers])
+
+        result = {}
+
+        # Layers are ordered by precedence: documents of upper layers win
+        for documents in layers_documents:
+            for document in documents:
+                result.setdefault(bson_identity(document['key']), document)
+
+        return result
+
+    async def get(self, key, default=None):
+        """
+        Retrieves the value for a given key.
+        :param key: item key to search for.
+        :param default: value to return if the key is not in the dictionary.
+        """
+        try:
+            return await self._get_item(key)
+        except KeyError:
+            return default
+
+    async def _get_item(self, key):
+        # Single keys are not put in a dict, since keys like dicts are not hashable, and True and 1 would collide
+        await self._load()
+        document = (await self._get_many_raw([key])).get(bson_identity(key))
+
+        if document is None or '___removed' in document:
+            raise KeyError(key)
+
+        return document['value']
+
+    def __getitem__(self, key):
+        """
+        Retrieves the value for a given key. It must be awaited: value = await d[key]
+        """
+        return self._get_item(key)
+
+    async def get_many(self, keys, default=None):
+        """
+        Retrieves the values for several keys at once, querying every fork and version layer concurrently.
+        :param keys: iterable of item keys to search for.
+        :param default: value to set for the keys that are not in the dictionary.
+        :return: dict with the value for each of the specified keys.
+        """
+        await self._load()
+        keys = list(keys)
+        found = await self._get_many_raw(keys)
+
+        result = {}
+        for key in keys:
+            document = found.get(bson_identity(key))
+            result[key] = default if document is None or '___removed' in document else document['value']
+
+        return result
+
+    async def contains(self, key):
+        """
+        Checks whether a key is contained in the dictionary.
+        """
+        await self._load()
+        document = (await self._get_many_raw([key])).get(bson_identity(key))
+
+        return document is not None and '___removed' not in document
+
+    async def set(self, key, value):
+        """
+        Sets the value for a given key.
+        """
+        await self._set_pairs([(key, value)])
+
+    async def delete(self, key):
+        """
+        Removes a key from the dictionary.
+        """
+        await self.delete_many([key])
+
+    async def set_many(self, mapping):
+        """
+        Sets the values for several keys at once, with a single unordered bulk write.
+        :param mapping: dict of key -> value to set.
+        """
+        await self._set_pairs(list(mapping.items()))
+
+    async def _set_pairs(self, pairs:list):
+        """
+        Sets the values of a list of (key, value) pairs, whose keys do not need to be hashable.
+        """
+        await self._load()
+        operations = [ReplaceOne({'key': key}, {'key': key, 'value': value}, upsert=True) for key, value in pairs]
+
+        if len(operations) > 0:
+            delta = await self._length_delta([(key, True) for key, _ in pairs])
+            await self._on_modified()
+            await self._instance.bulk_write(operations, ordered=False)
+            await self._add_length(delta)
+
+    async def delete_many(self, keys):
+        """
+        Removes several keys at once. Forks store tombstones instead of removing, so their fathers are kept intact.
+        :param keys: iterable of item keys to remove.
+        """
+        await self._load()
+        keys = list(keys)
+
+        if len(keys) == 0:
+            return
+
+        delta = await self._length_delta([(key, False) for key in keys])
+        await self._on_modified()
+
+        if self._is_fork():
+            await self._instance.bulk_write([ReplaceOne({'key': key}, {'key': key, 'value': None, '___removed': 1},
+                                                        upsert=True) for key in keys], ordered=False)
+            await self._add_length(delta)
+        else:
+            await self._instance.delete_many({'key': {'$in': keys}})
+
+    async def update(self, ext_dict):
+        await self.set_many(ext_dict)
+
+    async def __call__(self, query, count_only:bool=False, fields:list=None, sort=None, limit:int=None,
+                       skip:int=None, **parameters):
+        """
+        Performs a query over the dictionary, with the same syntax and options as MongoDict. Overrides and removals of
+        forks are honored.
+        :param query: string query to perform, or prepared query returned by prepare().
+        :param count_only: if set to true, it will yield only the length of the query result.
+        :param fields: if set, only these fields are retrieved. Same as in MongoDict.
+        :param sort: order of the results. Same as in MongoDict.
+        :param limit: maximum number of results. None or 0 for no limit.
+        :param skip: number of results to skip before the first one.
+        :param parameters: values for the parameters of a prepared query.
+        :return: async iterator for the (key, value, _id) elements that satisfy the query, or the size of the elements
+        set if count_only param is true.
+        """
+        await self._load()
+        mongo_query = QUERY_PARSER.to_mongo_query(query, **parameters)
+        sort = BasicMongoDict._query_sort(sort) if sort is not None else None
+        projection = BasicMongoDict._query_projection(fields)
+        skip = skip or 0
+
+        if count_only:
+            yield await self._count(mongo_query, skip, limit)
+            return
+
+        if not self._is_fork():
+            cursor = self._instance.find(mongo_query, projection)
+
+            if sort is not None:
+                cursor = cursor.sort(sort)
+
+            if skip:
+                cursor = cursor.skip(skip)
+
+            if limit:
+                cursor = cursor.limit(limit)
+
+            async for document in cursor:
+                yield document['key'], document.get('value'), document['_id']
+            return
+
+        if sort is None:
+            documents = self._find(mongo_query, projection)
+        else:
+            documents = self._sorted_find(mongo_query, projection, sort)
+
+        position = 0
+
+        async for document in documents:
+            if limit and position >= skip + limit:
+                break
+
+            if position >= skip:
+                yield document['key'], document.get('value'), document['_id']
+
+            position += 1
+
+    async def _count(self, mongo_query:dict, skip:int=0, limit:int=None):
+        """
+        Counts the entries that satisfy a mongo query, after skipping and limiting them.
+        """
+        if not self._is_fork():
+            options = {'skip': skip} if skip else {}
+
+            if limit:
+                options['limit'] = limit
+
+            return await self._instance.count_documents(mongo_query, **options)
+
+        if len(mongo_query) == 0:
+            count = await self.length()
+        else:
+            count = 0
+            async for _ in self._find(mongo_query, {'_id': 0, 'key': 1}):
+                count += 1
+
+        count = max(count - skip, 0)
+
+        return min(count, limit) if limit else count
+
+    def prepare(self, query:str):
+        """
+        Compiles a query with parameters, with the same syntax as MongoDict.prepare().
+        :param query: string query with :name parameters in place of the values.
+        :return: PreparedQuery instance.
+        """
+        return QUERY_PARSER.prepare(query)
+
+    async def _find(self, mongo_query:dict, projection:dict=None):
+        """
+        Iterates over the documents that satisfy a mongo query, through the whole fork and version chain.
+        """
+        used_keys = set()
+        layers = self._layers
+
+        for index, collection in enumerate(layers):
+            async for document in collection.find({'$and': [mongo_query, {'___removed': None}]}, projection):
+                if bson_identity(document['key']) not in used_keys:
+                    yield document
+
+            if index < len(layers) - 1:
+                # Every key of this layer (matching or not, removed or not) hides the same key in the lower layers
+                async for document in collection.find({}, {'_id': 0, 'key': 1}):
+                    used_keys.add(bson_identity(document['key']))
+
+    async def _sorted_find(self, mongo_query:dict, projection:dict, sort:list):
+        """
+        Iterates over the visible documents of the fork ordered by the given sort, as MongoDict does: each layer is
+        read sorted by the backend in chunks, whose keys are looked up in the upper layers to skip the hidden ones,
+        and the layers are merged.
+        """
+        query = {'$and': [mongo_query, {'___removed': None}]}
+        fields = dict(projection or {'_id': 1, 'key': 1, 'value': 1})
+
+        # Sort fields that were not requested are retrieved for the merge, and removed afterwards
+        extra_fields = [field for field, _ in sort if not any(fields.get(prefix) == 1 for prefix in
+                                                              ForkedMongoDict._field_prefixes(field))]
+        fields.update({field: 1 for field in extra_fields})
+        sort_key = document_sort_key(sort)
+
+        async def layer_entries(index):
+            cursor = self._layers[index].find(query, fields).sort(sort)
+
+            while True:
+                chunk = await cursor.to_list(ITERATION_CHUNK_SIZE)
+
+                if len(chunk) == 0:
+                    return
+
+                hidden_keys = await self._keys_in_layers(self._layers[:index],
+                                                         [document['key'] for document in chunk])
+
+                for document in chunk:
+                    if bson_identity(document['key']) not in hidden_keys:
+                        yield sort_key(document), index, document
+
+        layers_entries = [layer_entries(index) for index in range(len(self._layers))]
+        heads = []
+        sequence = 0
+
+        async def push_next(entries):
+            nonlocal sequence
+
+            try:
+                key, index, document = await entries.__anext__()
+            except StopAsyncIteration:
+                return
+
+            # The sequence keeps the order of the entries with the same sort key, and documents are never compared
+            heapq.heappush(heads, (key, index, sequence, document, entries))
+            sequence += 1
+
+        for entries in layers_entries:
+            await push_next(entries)
+
+        while len(heads) > 0:
+            _, _, _, document, entries = heapq.heappop(heads)
+            await push_next(entries)
+
+            for field in extra_fields:
+                ForkedMongoDict._remove_field(document, field)
+
+            yield document
+
+    async def _keys_in_layers(self, layers:list, keys:list):
+        """
+        Retrieves the bson_identity() of the given keys that are in any of the given layers, removed or not.
+        """
+        found = set()
+
+        for collection in layers:
+            async for document in collection.find({'key': {'$in': keys}}, {'_id': 0, 'key': 1}):
+                found.add(bson_identity(document['key']))
+
+        return found
+
+    async def items(self):
+        await self._load()
+
+        async for document in self._find({}, {'_id': 0, 'key': 1, 'value': 1}):
+            yield document['key'], document['value']
+
+    async def keys(self):
+        await self._load()
+
+        async for document in self._find({}, {'_id': 0, 'key': 1}):
+            yield document['key']
+
+    async def values(self):
+        await self._load()
+
+        async for document in self._find({}, {'_id': 0, 'key': 1, 'value': 1}):
+            yield document['value']
+
+    def __aiter__(self):
+        return self.keys()
+
+    async def length(self):
+        """
+        Retrieves the number of elements of the dictionary. Forks read it from the length counter of their metadata,
+        shared with MongoDict.
+        """
+        await self._load()
+
+        if not self._is_fork():
+            return await self._instance.estimated_document_count()
+
+        document = await self._dict_meta.find_one({'key': self._original_dict_id})
+        length = document['value'].get('lengths', {}).get(str(self._version)) if document is not None else None
+
+        if length is None:
+            length = 0
+            async for _ in self._find({}, {'_id': 0, 'key': 1}):
+                length += 1
+
+            await self._dict_meta.update_one({'key': self._original_dict_id},
+                                             {'$set': {'value.lengths.{}'.format(self._version): length}})
+
+        return length
+
+    async def fork(self, new_id=None):
+        """
+        Forks the dictionary. Same behaviour as MongoDict.fork().
+        :param new_id: ID of the new dictionary.
+        :return: AsyncMongoDict of the fork.
+        """
+        await self.reload()
+
+        if new_id is None:
+            new_id = str(ObjectId())
+
+        if new_id == self._original_dict_id:
+            raise Exception("Fork cannot override father's ID")
+
+        length = await self.length()
+        document = await self._dict_meta.find_one({'key': self._original_dict_id})
+        metadata = document['value']
+
+        if metadata['modified']:
+            # The new version starts empty, on top of the current one. Same updates as MongoDict.fork()
+            new_version = self._version + 1
+            await self._dict_meta.update_one({'key': self._original_dict_id, 'value.version': {'$ne': new_version}},
+                                             {'$push': {'value.version': new_version},
+                                              '$set': {'value.lengths.{}'.format(new_version): length,
+                                                       'value.modified': False}})
+
+        fork_document = await self._dict_meta.find_one({'key': new_id})
+        fork_metadata = fork_document['value'] if fork_document is not None else {}
+        created = 'ancestor_fork' not in fork_metadata
+
+        # Forks inherit the value indexes of their father
+        await self._dict_meta.update_one({'key': new_id}, {
+            '$setOnInsert': {'value.version': [], 'value.modified': True},
+            '$set': {'value.ancestor_fork': self._original_dict_id, 'value.ancestor_version': self._version},
+            '$addToSet': {'value.value_indexes': {'$each': metadata.get('value_indexes', [])}}}, upsert=True)
+
+        result = AsyncMongoDict(new_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
+                                mongo_database=self._mongo_database, credentials=self._credentials,
+                                version_check_interval=self._version_check_interval)
+        await result.reload()
+
+        # Same rules as ForkedMongoDict.__init__(): only a new and empty fork starts with the length of its father, and
+        # a fork moved on top of another father is counted from scratch
+        if created and await result._instance.find_one({}, {'_id': 1}) is None:
+            field = 'value.lengths.{}'.format(result._version)
+            await self._dict_meta.update_one({'key': new_id, field: {'$exists': False}}, {'$set': {field: length}})
+        elif not created and (fork_metadata['ancestor_fork'], fork_metadata['ancestor_version']) != \
+                (self._original_dict_id, self._version):
+            await result._forget_length()
+
+        # Reload the latest version
+        await self.reload()
+
+        return result
+
+    def bulk(self, buffer_size:int=500, do_upserts:bool=True):
+        """
+        Performs a bulk operation over the dictionary, managed by an async context manager:
+            >>> async with dictionary.bulk() as d:
+            ...     await d.set('k1', "v1")
+            ...     await d.delete('k2')
+
+        :param buffer_size: number of operations buffered before they are committed to the backend.
+        :param do_upserts: same meaning as in MongoDict.bulk(), "auto" included.
+        :return: async context manager for the write and delete bulk operations. Write errors of a commit are raised
+                    as BulkWriteError.
+        """
+        return AsyncBulkMongoDict(self, buffer_size=buffer_size, do_upserts=do_upserts)
+
+    def get_my_id(self):
+        return self._original_dict_id
+
+    def __str__(self):
+        return "Async_Mongo_Dict ({})".format(self._original_dict_id)
+
+    def __repr__(self):
+        return "Async_Mongo_Dict ({})".format(self._original_dict_id)
+
+
+class AsyncBulkMongoDict:
+    """
+    Buffers write and delete operations of an AsyncMongoDict and commits them in bulks. Like BulkMongoDict, it
+    supports do_upserts="auto". Write errors are raised as BulkWriteError.
+    """
+
+    def __init__(self, mongo_dict:AsyncMongoDict, buffer_size:int=500, do_upserts:bool=True):
+        self._mongo_dict = mongo_dict
+        self._buffer_size = buffer_size
+        self.do_upserts = do_upserts
+        self._operations = []
+        self._changes = []
+        self._documents = []
+
+    async def __aenter__(self):
+        await self._mongo_dict._load()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+
+    async def _append(self, operation, key, visible:bool, document:dict=None):
+        """
+        Buffers an operation, committing the buffer if it is full.
+        :param document: document written by the operation. None if it only carries the key.
+        """
+        self._operations.append(operation)
+        self._changes.append((key, visible))
+        self._documents.append(document)
+
+        if len(self._operations) > self._buffer_size:
+            await self.commit()
+
+    async def set(self, key, value):
+        document = {"key": key, "value": value}
+
+        if self.do_upserts == "auto":
+            operation = ReplaceOne({"key": key}, document, upsert=True)
+        elif self.do_upserts:
+            operation = UpdateOne({"key": key}, {"$set": {"value": value}, "$unset": {"___removed": ""}}, upsert=True)
+        else:
+            operation = InsertOne(document)
+
+        await self._append(operation, key, True, document)
+
+    async def delete(self, key):
+        if not self._mongo_dict._is_fork():
+            await self._append(DeleteOne({"key": key}), key, False)
+            return
+
+        document = {"key": key, "value": None, "___removed": 1}
+
+        if self.do_upserts == "auto":
+            operation = ReplaceOne({"key": key}, document, upsert=True)
+        else:
+            operation = UpdateOne({"key": key}, {"$set": {"value": None, "___removed": 1}}, upsert=True)
+
+        await self._append(operation, key, False, document)
+
+    async def commit(self):
+        if len(self._operations) > 0:
+            delta = await self._mongo_dict._length_delta(self._changes)
+            operation_keys = [key for key, _ in self._changes]
+
+            try:
+                if self.do_upserts == "auto":
+                    await self._write_auto(operation_keys)
+                else:
+                    # Unordered bulks group the operations by type, so only the last operation over each key is written
+                    await self._mongo_dict._instance.bulk_write([self._operations[index] for index in
+                                                                 BulkMongoDict._latest_indexes(operation_keys)],
+                                                                ordered=False)
+            except BulkWriteError:
+                # Part of the operations might have been written, so the length counter cannot be trusted anymore
+                await self._mongo_dict._forget_length()
+                raise
+
+            self._operations = []
+            self._changes = []
+            self._documents = []
+            await self._mongo_dict._on_modified()
+            await self._mongo_dict._add_length(delta)
+
+    async def _write_auto(self, operation_keys:list):
+        """
+        Writes the buffer inserting the documents whose keys do not exist yet, instead of upserting them. Keys inserted
+        by others since they were looked up are retried as replacements.
+        """
+        instance = self._mongo_dict._instance
+        indexes = BulkMongoDict._latest_indexes(operation_keys)
+        written_keys = [operation_keys[index] for index in indexes if self._documents[index] is not None]
+        existing_keys = set()
+
+        if len(written_keys) > 0:
+            async for document in instance.find({'key': {'$in': written_keys}}, {'_id': 0, 'key': 1}):
+                existing_keys.add(bson_identity(document['key']))
+
+        operations = [InsertOne(self._documents[index])
+                      if self._documents[index] is not None and bson_identity(operation_keys[index]) not in existing_keys
+                      else self._operations[index] for index in indexes]
+
+        try:
+            await instance.bulk_write(operations, ordered=False)
+        except BulkWriteError as ex:
+            retries = []
+
+            for error in ex.details['writeErrors']:
+                index = indexes[error['index']]
+
+                if error['code'] == 11000 and type(operations[error['index']]) is InsertOne:
+                    # The failed insert assigned an _id to the document, which cannot replace the existing one
+                    document = {k: v for k, v in self._documents[index].items() if k != '_id'}
+                    retries.append(ReplaceOne({'key': operation_keys[index]}, document, upsert=True))
+
+            if len(retries) < len(ex.details['writeErrors']):
+                raise
+
+            await instance.bulk_write(retries, ordered=False)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import datetime
+import math
+import numbers
+import re
+
+import bson
+from bson import ObjectId, Binary, Timestamp, Regex, MinKey, MaxKey, Decimal128
+
+
+def _type_rank(value):
+    """
+    Position of the type of the value in the BSON comparison order of MongoDB.
+    """
+    if isinstance(value, MinKey):
+        return 0
+    if value is None:
+        return 2
+    if isinstance(value, bool):
+        return 9
+    if isinstance(value, (numbers.Real, Decimal128)):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, dict):
+        return 5
+    if isinstance(value, (list, tuple)):
+        return 6
+    if isinstance(value, (bytes, Binary)):
+        return 7
+    if isinstance(value, ObjectId):
+        return 8
+    if isinstance(value, datetime.datetime):
+        return 10
+    if isinstance(value, Timestamp):
+        return 11
+    if isinstance(value, (Regex, type(re.compile("")))):
+        return 12
+    if isinstance(value, MaxKey):
+        return 13
+
+    return 14
+
+
+def _value_order(value):
+    rank = _type_rank(value)
+
+    if rank == 3:
+        value = float(value.to_decimal()) if isinstance(value, Decimal128) else value
+        # NaN is lower than any other number
+        return rank, (0,) if isinstance(value, float) and math.isnan(value) else (1, value)
+
+    if rank == 5:
+        # Objects are compared field by field: type of the value, name of the field and value
+        return rank, tuple((_type_rank(field_value), field, _value_order(field_value))
+                           for field, field_value in value.items())
+
+    if rank == 6:
+        return rank, tuple(_value_order(element) for element in value)
+
+    if rank == 7:
+        subtype = value.subtype if isinstance(value, Binary) else 0
+        return rank, (len(value), subtype, bytes(value))
+
+    if rank == 8:
+        return rank, value.binary
+
+    if rank == 11:
+        return rank, (value.time, value.inc)
+
+    if rank == 12:
+        return rank, (value.pattern, str(value.flags))
+
+    if rank == 14:
+        return rank, repr(value)
+
+    if rank in (0, 2, 13):
+        return rank, ()
+
+    return rank, value
+
+
+def bson_sort_key(value):
+    """
+    Key function that orders the values of a field the same way as an ascending MongoDB sort over that field does:
+
+        >>> sorted([True, "b", 3, None, 1.5], key=bson_sort_key)
+        [None, 1.5, 3, 'b', True]
+
+    Like MongoDB, an array is ordered by its lowest element, and an empty array goes before null. Hence, different
+    values might have the same sort key (for example, 1 and [1, 2]); use bson_identity() to tell them apart.
+    """
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return 1, ()
+
+        return min(_value_order(element) for element in value)
+
+    return _value_order(value)
+
+
+def bson_identity(value):
+    """
+    Hashable identity of a value, equal for the values that MongoDB considers equal (like 4 and 4.0, even inside
+    documents and arrays) and different for the ones that it does not (like True and 1).
+    """
+    return bson.BSON.encode({'v': _normalize_numbers(value)})
+
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _normalize_number(value):
+    """
+    Canonical form of a number, equal for the numbers that are exactly equal regardless of their type. Integral
+    numbers become int, other numbers become float when the float holds their exact value, and Decimal128 otherwise.
+    """
+    if isinstance(value, Decimal128):
+        decimal = value.to_decimal()
+
+        if not decimal.is_finite():
+            return float(decimal)
+
+        if decimal == decimal.to_integral_value() and _INT64_MIN <= decimal <= _INT64_MAX:
+            return int(decimal)
+
+        if decimal == type(decimal)(float(decimal)):
+            return float(decimal)
+
+        return Decimal128(decimal.normalize())
+
+    if isinstance(value, float):
+        if value.is_integer() and _INT64_MIN <= value <= _INT64_MAX:
+            return int(value)
+
+        return value
+
+    if isinstance(value, int):
+        return value
+
+    # Other numbers.Real types (like Fraction) are stored as float by the driver
+    return _normalize_number(float(value))
+
+
+def _normalize_numbers(value):
+    """
+    Converts every number inside the value to its canonical form, so that equal numbers of different types encode the
+    same while different numbers (like 2 ** 53 and 2 ** 53 + 1) do not.
+    """
+    if isinstance(value, (numbers.Real, Decimal128)) and not isinstance(value, bool):
+        return _normalize_number(value)
+
+    if isinstance(value, dict):
+        return {field: _normalize_numbers(item) for field, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_normalize_numbers(item) for item in value]
+
+    return value
+
+
+class _Descending:
+    """
+    Sort key compared in reverse order.
+    """
+
+    __slots__ = ['key']
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _field_value(document:dict, path:str):
+    value = document
+
+    for name in path.split("."):
+        if not isinstance(value, dict) or name not in value:
+            return None
+
+        value = value[name]
+
+    return value
+
+
+def document_sort_key(sort:list):
+    """
+    Builds a key function that orders documents the same way as a MongoDB sort over several fields does:
+
+        >>> documents = [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 2, 'b': 'z'}]
+        >>> sorted(documents, key=document_sort_key([('a', -1), ('b', 1)]))
+        [{'a': 2, 'b': 'y'}, {'a': 2, 'b': 'z'}, {'a': 1, 'b': 'x'}]
+
+    Missing fields are ordered as null. Like MongoDB, an array is ordered by its lowest element in ascending sorts and
+    by its highest element in descending sorts.
+
+    :param sort: list of (dotted field path, direction) pairs, direction being 1 for ascending and -1 for descending.
+    :return: function that receives a document and returns its sort key.
+    """
+    def descending_key(value):
+        if isinstance(value, (list, tuple)) and len(value) > 0:
+            return _Descending(max(_value_order(element) for element in value))
+
+        return _Descending(bson_sort_key(value))
+
+    field_keys = [(path, bson_sort_key if direction == 1 else descending_key) for path, direction in sort]
+
+    def sort_key(document):
+        return tuple(field_key(_field_value(document, path)) for path, field_key in field_keys)
+
+    return sort_key
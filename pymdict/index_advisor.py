@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from itertools import product
+from threading import Lock
+
+EQUALITY_OPERATORS = ["$eq", "$in"]
+RANGE_OPERATORS = ["$gt", "$gte", "$lt", "$lte"]
+
+# Upper bound of the conjunctive branches analyzed per query, since $and of several $or multiplies them.
+MAX_QUERY_BRANCHES = 64
+
+
+class IndexAdvisor:
+    """
+    Opt-in recorder of the fields used by the queries of the dictionaries, which reports the value indexes that would
+    have served them:
+
+        >>> INDEX_ADVISOR.enable()
+        >>> for key, value, _ in dictionary("value.age > 40"):
+        ...     pass
+        >>> INDEX_ADVISOR.report()
+        [{'dict': 'my_dict', 'index': [('value.age', 1)], 'queries': 1}]
+
+    The suggested indexes follow the equality, sort, range rule: fields compared for equality go first, then the fields
+    of the sort and then the fields compared by range. Each branch of an $or is served by its own index, so each one
+    gets its own suggestion. Queries that the key index or a value index of the dictionary can already serve are not
+    reported.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._usage = {}
+        self._lock = Lock()
+
+    def enable(self):
+        """
+        Starts recording the queries of the dictionaries.
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording the queries of the dictionaries. The recorded ones are kept.
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forgets every recorded query.
+        """
+        with self._lock:
+            self._usage = {}
+
+    def record(self, dict_id:str, mongo_query:dict, sort:list=None, indexes:list=None):
+        """
+        Records a query performed over a dictionary.
+        :param dict_id: ID of the dictionary.
+        :param mongo_query: filter of the query, as built by the query parser.
+        :param sort: list of (field, direction) pairs of the sort of the query, if any.
+        :param indexes: value indexes of the dictionary, each one as a list of (field, direction) pairs.
+        """
+        indexes = indexes or []
+
+        for keys in self.suggest(mongo_query, sort):
+            if any(index[0][0] == keys[0][0] for index in indexes if len(index) > 0):
+                continue
+
+            with self._lock:
+                usage_key = (dict_id, tuple(keys))
+                self._usage[usage_key] = self._usage.get(usage_key, 0) + 1
+
+    def report(self):
+        """
+        Retrieves the indexes that would have served the recorded queries.
+        :return: list of dicts with the ID of the dictionary ('dict'), the suggested index as a list of (field,
+        direction) pairs ('index') and the number of queries it would have served ('queries'), most used first.
+        """
+        with self._lock:
+            usage = list(self._usage.items())
+
+        return [{'dict': dict_id, 'index': list(keys), 'queries': queries}
+                for (dict_id, keys), queries in sorted(usage, key=lambda entry: -entry[1])]
+
+    @staticmethod
+    def suggest(mongo_query:dict, sort:list=None):
+        """
+        Builds the indexes that would serve a query.
+        :param mongo_query: filter of the query.
+        :param sort: list of (field, direction) pairs of the sort of the query, if any.
+        :return: list of indexes, each one as a list of (field, direction) pairs.
+        """
+        sort = [(field, direction) for field, direction in sort or [] if field.startswith("value")]
+        suggestions = []
+
+        for branch in IndexAdvisor._branches(mongo_query):
+            if ("key", "equality") in branch:
+                continue
+
+            equalities = [field for field, kind in branch if kind == "equality"]
+            ranges = [field for field, kind in branch if kind == "range"]
+            keys = []
+
+            for field, direction in [(field, 1) for field in equalities] + sort + [(field, 1) for field in ranges]:
+                if field.startswith("value") and all(field != used for used, _ in keys):
+                    keys.append((field, direction))
+
+            if len(keys) > 0 and keys not in suggestions:
+                suggestions.append(keys)
+
+        return suggestions
+
+    @staticmethod
+    def _branches(mongo_query:dict):
+        """
+        Splits a filter into its conjunctive branches, each one as a list of (field, kind) pairs.
+        """
+        branches = [[]]
+
+        for field, condition in mongo_query.items():
+            if field == "$or":
+                alternatives = [branch for term in condition for branch in IndexAdvisor._branches(term)]
+            elif field == "$and":
+                alternatives = [[]]
+
+                for term in condition:
+                    alternatives = [a + b for a, b in product(alternatives, IndexAdvisor._branches(term))]
+                    alternatives = alternatives[:MAX_QUERY_BRANCHES]
+            else:
+                alternatives = [[(field, IndexAdvisor._condition_kind(condition))]]
+
+            branches = [a + b for a, b in product(branches, alternatives)][:MAX_QUERY_BRANCHES]
+
+        return branches
+
+    @staticmethod
+    def _condition_kind(condition):
+        if type(condition) is not dict:
+            return "equality"
+
+        if any(operator in condition for operator in EQUALITY_OPERATORS):
+            return "equality"
+
+        if any(operator in condition for operator in RANGE_OPERATORS):
+            return "range"
+
+        # Only regular expressions anchored to the start of the text are served by an index
+        if type(condition.get("$regex")) is str and condition["$regex"].startswith("^"):
+            return "range"
+
+        return "other"
+
+
+# Process-wide advisor used by every dictionary. It is disabled until enable() is called.
+INDEX_ADVISOR = IndexAdvisor()
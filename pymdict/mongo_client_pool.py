@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+from threading import Lock
+
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+
+# Index over the 'key' field that serves every point lookup of the dictionaries.
+KEY_INDEX = "key_unique_index"
+
+# Text index used by older versions over the 'key' field. It is replaced by KEY_INDEX when found.
+LEGACY_KEY_INDEX = "key_index"
+
+
+class MongoClientPool:
+    """
+    Registry of MongoClient instances shared by every dictionary of the process.
+
+    A MongoClient already holds its own pool of connections and it is thread-safe, so there is no need to open a new
+    one for each dictionary object. Clients are keyed by (host, port, database, credentials) and they are kept open
+    until they are explicitly closed:
+
+        >>> client = CLIENT_POOL.get_client("localhost", 27017, "mongo_dicts")
+        >>> CLIENT_POOL.close_all()
+
+    A MongoClient must not be used across a fork of the process, so a forked child process starts with an empty
+    pool and opens its own clients.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._indexed = set()
+        self._unsupported = set()
+        self._close_listeners = []
+        self._lock = Lock()
+
+    def _check_process(self):
+        """
+        Forgets the clients inherited from the parent process, if this process is a fork of it. They are not closed,
+        since their sockets are still used by the parent.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = {}
+            self._indexed = set()
+            self._unsupported = set()
+            self._lock = Lock()
+
+    @staticmethod
+    def _build_key(mongo_host:str, mongo_port:int, mongo_database:str, credentials:tuple=None):
+        if credentials is not None and len(credentials) == 2:
+            credentials = tuple(credentials)
+        else:
+            credentials = None
+
+        return mongo_host, mongo_port, mongo_database, credentials
+
+    def get_client(self, mongo_host:str, mongo_port:int, mongo_database:str, credentials:tuple=None) -> MongoClient:
+        """
+        Retrieves the shared client for the given connection parameters, creating it if it does not exist yet.
+        :param mongo_host:  host of the mongodb
+        :param mongo_port:  port of the mongodb
+        :param mongo_database:  database name of the mongo db.
+        :param credentials: tuple containing the user and password. None if no credentials are required.
+        :return: MongoClient instance.
+        """
+        self._check_process()
+        key = self._build_key(mongo_host, mongo_port, mongo_database, credentials)
+
+        with self._lock:
+            client = self._clients.get(key)
+
+            if client is None:
+                mongo_uri = "mongodb://"
+
+                if key[3] is not None:
+                    mongo_uri += "{}:{}@".format(key[3][0], key[3][1])
+
+                mongo_uri += "{}:{}/{}".format(mongo_host, mongo_port, mongo_database)
+
+                try:
+                    client = MongoClient(mongo_uri)
+                except ConnectionFailure:
+                    raise ConnectionError("No connection to the remote dict backend. Ensure that a MongoDB backend is "
+                                          "listening on {}:{}".format(mongo_host, mongo_port)) from None
+
+                self._clients[key] = client
+
+        return client
+
+    def ensure_key_index(self, collection):
+        """
+        Creates the unique ascending index over the 'key' field of the given collection, so that point lookups and
+        upserts do not scan the whole collection. The index creation is only requested to the backend once per
+        collection and client.
+
+        Collections created by older versions of pymdict only have a text index named 'key_index', which cannot serve
+        equality filters. It is replaced by the new one, as is a non-unique index named like the new one. If the
+        collection holds duplicated keys (they could be inserted by bulks without upserts), the unique index cannot be
+        built and an exception is raised. The documents are left untouched: DictDropper.migrate_key_index() can remove
+        the duplicates.
+
+        :param collection: pymongo collection to index.
+        """
+        index_key = (id(collection.database.client), collection.full_name)
+
+        if index_key in self._indexed:
+            return
+
+        indexes = collection.index_information()
+        replaced = KEY_INDEX in indexes and not indexes[KEY_INDEX].get('unique', False)
+
+        if replaced:
+            collection.drop_index(KEY_INDEX)
+            del indexes[KEY_INDEX]
+
+        if KEY_INDEX not in indexes:
+            try:
+                collection.create_index([('key', pymongo.ASCENDING)], name=KEY_INDEX, unique=True)
+            except DuplicateKeyError:
+                if replaced:
+                    collection.create_index([('key', pymongo.ASCENDING)], name=KEY_INDEX)
+
+                raise Exception("Collection {} holds documents with duplicated keys, so its unique key index cannot be "
+                                "built. Use DictDropper.migrate_key_index() with remove_duplicates=True to keep only "
+                                "the last document written of each key.".format(collection.full_name)) from None
+
+        # Dropped once the new index is built, so that lookups never lack an index
+        if LEGACY_KEY_INDEX in indexes:
+            collection.drop_index(LEGACY_KEY_INDEX)
+
+        self._indexed.add(index_key)
+
+    @staticmethod
+    def remove_duplicated_keys(collection):
+        """
+        Removes the documents of the given collection whose key is repeated, except the last one written of each key
+        (the one with the greatest ObjectId).
+        :param collection: pymongo collection.
+        :return: number of documents removed.
+        """
+        removed = 0
+        duplicates = collection.aggregate([
+            {'$group': {'_id': '$key', 'ids': {'$push': '$_id'}, 'last_id': {'$max': '$_id'}}},
+            {'$match': {'ids.1': {'$exists': True}}}
+        ], allowDiskUse=True)
+
+        for duplicate in duplicates:
+            stale_ids = [document_id for document_id in duplicate['ids'] if document_id != duplicate['last_id']]
+            removed += collection.delete_many({'_id': {'$in': stale_ids}}).deleted_count
+
+        return removed
+
+    def ensure_index(self, collection, keys:list, name:str):
+        """
+        Creates a secondary index on the given collection. As with the key index, the index creation is only requested
+        to the backend once per collection, client and index name.
+
+        :param collection: pymongo collection to index.
+        :param keys: list of (field, direction) pairs of the index.
+        :param name: name of the index.
+        """
+        index_key = (id(collection.database.client), collection.full_name, name)
+
+        if index_key in self._indexed:
+            return
+
+        collection.create_index(keys, name=name)
+        self._indexed.add(index_key)
+
+    def forget_key_index(self, collection):
+        """
+        Forgets that the given collection was indexed, so its indexes are requested again the next time. Must be
+        called when the collection is dropped.
+        :param collection: pymongo collection.
+        """
+        collection_key = (id(collection.database.client), collection.full_name)
+        self._indexed = set(k for k in self._indexed if k[:2] != collection_key)
+
+    def supports(self, client, feature:str):
+        """
+        Checks whether a feature of the backend of the given client has not been found unsupported yet.
+        :param client: MongoClient of the backend.
+        :param feature: name of the feature, like '$unionWith'.
+        """
+        return (id(client), feature) not in self._unsupported
+
+    def set_unsupported(self, client, feature:str):
+        """
+        Records that the backend of the given client does not support a feature, so that it is not tried again with
+        the same client.
+        :param client: MongoClient of the backend.
+        :param feature: name of the feature, like '$unionWith'.
+        """
+        self._unsupported.add((id(client), feature))
+
+    def add_close_listener(self, listener):
+        """
+        Registers a function that is called with each client closed by the pool, before it is closed. It is kept in
+        forked child processes.
+        :param listener: function that receives the MongoClient being closed.
+        """
+        self._close_listeners.append(listener)
+
+    def close(self, mongo_host:str, mongo_port:int, mongo_database:str, credentials:tuple=None):
+        """
+        Closes the shared client for the given connection parameters, if any. New dictionaries get a new client from
+        the pool, while dictionaries built before keep their reference to the closed client, so they should be built
+        again: with pymongo 3 the closed client reconnects when it is used, outside of the pool, and with pymongo 4 it
+        raises InvalidOperation.
+        """
+        key = self._build_key(mongo_host, mongo_port, mongo_database, credentials)
+
+        with self._lock:
+            client = self._clients.pop(key, None)
+
+        if client is not None:
+            self._close_client(client)
+
+    def close_all(self):
+        """
+        Closes every client of the pool. As with close(), dictionaries built before should be built again.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+
+        for client in clients:
+            self._close_client(client)
+
+    def _close_client(self, client):
+        for listener in self._close_listeners:
+            listener(client)
+
+        self._forget_indexes(client)
+        client.close()
+
+    def _forget_indexes(self, client):
+        self._indexed = set(k for k in self._indexed if k[0] != id(client))
+        self._unsupported = set(k for k in self._unsupported if k[0] != id(client))
+
+    def __len__(self):
+        return len(self._clients)
+
+
+# Process-wide pool used by every dictionary, bulk writer and dropper.
+CLIENT_POOL = MongoClientPool()
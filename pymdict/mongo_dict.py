@@ -23,23 +23,83 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import deque, OrderedDict
 from contextlib import contextmanager
+from decimal import Decimal, localcontext
 from functools import partial
+from heapq import merge
+from itertools import islice, groupby
+from operator import itemgetter
+from queue import Queue
 from threading import Thread, Lock
-from time import sleep
+from time import sleep, monotonic
 
+import bson
 import pymongo
 from bson import ObjectId
-from pymongo import MongoClient, UpdateOne, DeleteOne, InsertOne
-from pymongo.errors import ConnectionFailure, BulkWriteError
-from pymongo.periodic_executor import PeriodicExecutor
+from bson.decimal128 import Decimal128, create_decimal128_context
+from bson.errors import InvalidDocument
+from pymongo import UpdateOne, DeleteOne, InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
 
-from pymdict.mongo_query_parser import MongoQueryParser
+from pymdict.bloom_filter import BloomFilter
+from pymdict.bson_order import bson_sort_key, bson_identity, document_sort_key
+from pymdict.index_advisor import INDEX_ADVISOR
+from pymdict.mongo_client_pool import CLIENT_POOL
+from pymdict.mongo_dict_cache import LRUCache
+from pymdict.mongo_query_parser import QUERY_PARSER
+from pymdict.version_watcher import VERSION_WATCHER
 
 
 # Special collection for tracking information of mongo dictionaries, like forks families and versioning.
 ___MONGO_DICT_META___ = "___MONGO_DICT_META___"
 
+# Number of entries copied per bulk write when a dict is compacted without server-side support.
+COMPACT_BUFFER_SIZE = 1000
+
+# Number of keys recently missed that each frozen layer of a fork chain remembers, to skip Bloom filter false positives.
+MISSING_KEYS_CACHE_SIZE = 10000
+
+# Number of Bloom filters of frozen layers kept by the process, so that each frozen collection is only scanned once.
+KEY_FILTERS_CACHE_SIZE = 64
+
+# Upper bound for the buffer size chosen by adaptive bulks. MongoDB splits bigger bulks anyway.
+MAX_ADAPTIVE_BUFFER_SIZE = 100000
+
+# Number of commits whose timings are kept by each bulk.
+BULK_COMMIT_HISTORY_SIZE = 1000
+
+# Number of entries per chunk yielded by chunked iterations, when no batch size is given.
+ITERATION_CHUNK_SIZE = 1000
+
+# Number of entries read per page by scans, when no page size is given.
+SCAN_PAGE_SIZE = 1000
+
+# Number of _id sampled per partition to find the split points of split_scan().
+SPLIT_SAMPLES_PER_PARTITION = 100
+
+# Codes of the errors raised by backends that do not know an aggregation stage, like $unionWith before MongoDB 4.4.
+UNSUPPORTED_STAGE_ERROR_CODES = (40324, 40602)
+
+# Bloom filters of the frozen layers built by this process, by collection, in least recently used order. They are
+# shared by every dict that opens the same frozen layer.
+_key_filters = OrderedDict()
+_key_filters_lock = Lock()
+
+# Number of keys in the upper layers of a fork above which its iterations and queries merge the layers sorted by key,
+# instead of keeping those keys in memory.
+FORK_MERGE_THRESHOLD = 100000
+
+# Operators of the accumulators of aggregate(). All of them but count take a field.
+AGGREGATION_OPERATORS = ["count", "sum", "avg", "min", "max"]
+
+# BSON types counted by avg, like MongoDB does.
+NUMERIC_TYPES = ["double", "int", "long", "decimal"]
+
+# Decimal context of Decimal128 values, used to combine the partial sums of aggregate() that are Decimal128.
+DECIMAL128_CONTEXT = create_decimal128_context()
+
 
 class BasicMongoDict:
     """
@@ -136,18 +196,7 @@ class BasicMongoDict:
         if original_dict_id is None:
             original_dict_id = str(ObjectId())
 
-        mongo_uri = "mongodb://"
-
-        if credentials is not None and len(credentials) == 2:
-            mongo_uri += "{}:{}@".format(credentials[0], credentials[1])
-
-        mongo_uri += "{}:{}/{}".format(mongo_host, mongo_port, mongo_database)
-
-        try:
-            self._client = MongoClient(mongo_uri)
-        except ConnectionFailure:
-            raise ConnectionError("No connection to the remote dict backend. Ensure that a MongoDB backend is listening"
-                                  " on {}:{}".format(mongo_host, mongo_port)) from None
+        self._client = CLIENT_POOL.get_client(mongo_host, mongo_port, mongo_database, credentials)
 
         self._mongo_host = mongo_host
         self._mongo_port = mongo_port
@@ -155,7 +204,7 @@ class BasicMongoDict:
         self._credentials = credentials
         self._storage = self._client[mongo_database]
         self._instance = self._storage[original_dict_id]
-        self._instance.create_index([('key', pymongo.TEXT)], name='key_index')
+        CLIENT_POOL.ensure_key_index(self._instance)
 
         self._original_dict_id = original_dict_id
 
@@ -182,6 +231,36 @@ class BasicMongoDict:
 
         return result
 
+    def get_many(self, keys, default=None):
+        """
+        Retrieves the values for several keys at once, with a single query to the backend (per fork or version level).
+            >>> dictionary.get_many(['k1', 'k2', 'k5'])
+            {'k1': 'v1', 'k2': 'v2', 'k5': None}
+
+        :param keys: iterable of item keys to search for.
+        :param default: value to set for the keys that are not in the dictionary.
+        :return: dict with the value for each of the specified keys.
+        """
+        keys = list(keys)
+        found = self._get_many_raw(keys)
+
+        result = {}
+        for key in keys:
+            document = found.get(bson_identity(key))
+            result[key] = default if document is None or '___removed' in document else document['value']
+
+        return result
+
+    def _get_many_raw(self, keys:list):
+        """
+        Retrieves the raw documents for the given keys.
+        :param keys: list of item keys to search for.
+        :return: dict of bson_identity() of the key -> document, so that keys are told apart as MongoDB does. Keys not
+                    found are not included.
+        """
+        return {bson_identity(document['key']): document
+                for document in self._instance.find({'key': {'$in': keys}}, {'_id': 0})}
+
     def __setitem__(self, key, value):
         """
         Sets the value for a given key.
@@ -191,8 +270,37 @@ class BasicMongoDict:
         self._on_modified_callback()
         self._instance.replace_one({'key': key},  {'key': key, 'value': value}, upsert=True)
 
+    def set_many(self, mapping):
+        """
+        Sets the values for several keys at once, with a single unordered bulk write to the backend.
+            >>> dictionary.set_many({'k1': 'v1', 'k2': 'v2'})
+
+        :param mapping: dict of key -> value to set.
+        """
+        operations = [ReplaceOne({'key': key}, {'key': key, 'value': value}, upsert=True)
+                      for key, value in mapping.items()]
+
+        if len(operations) > 0:
+            self._on_modified_callback()
+            self._instance.bulk_write(operations, ordered=False)
+
+    def delete_many(self, keys):
+        """
+        Removes several keys at once, with a single call to the backend. Keys that are not in the dictionary are
+        ignored.
+            >>> dictionary.delete_many(['k1', 'k2'])
+
+        :param keys: iterable of item keys to remove.
+        """
+        keys = list(keys)
+
+        if len(keys) > 0:
+            self._on_modified_callback()
+            self._instance.delete_many({'key': {'$in': keys}})
+
     @contextmanager
-    def bulk(self, buffer_size: int = 500, do_upserts: bool = True):
+    def bulk(self, buffer_size: int = 500, do_upserts: bool = True, write_behind: bool = False,
+             max_in_flight: int = 2, target_bytes: int = None, target_latency: float = None):
         """
         Performs a bulk operation over the dictionary. It can be write and/or delete of elements.
         It is managed by a contextmanager. An example of use is:
@@ -228,13 +336,33 @@ class BasicMongoDict:
                     normal dictionary, but appending lot of new elements is notably slower.
                     If during the bulk, it is ensured that all the elements are new, set this parameter
                     to false to speed up the operation.
+                    If set to "auto", each buffer looks up which of its keys already exist with a single query:
+                    new keys are inserted and only the existing ones are replaced. Repeated keys in the same buffer
+                    are reduced to their last operation.
+
+        :param write_behind: if set, full buffers are written by a background thread while the next buffer is being
+                    filled. Errors are raised on the next operation or when the context is exited.
+
+        :param max_in_flight: maximum number of full buffers waiting to be written in write-behind mode. Once it is
+                    reached, writing to the bulk blocks until a buffer is written.
+
+        :param target_bytes: if set, the buffer is also flushed once its operations reach this BSON encoded size,
+                    and buffer_size is tuned after each commit towards the number of operations that fits in it.
+
+        :param target_latency: if set, buffer_size is tuned after each commit towards the number of operations that
+                    can be committed in these seconds. The chosen sizes and timings are given by stats() of the bulk.
 
         :return: context manager for the write and delete bulk operations.
         """
         m = BulkMongoDict(self._original_dict_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
-                          buffer_size=buffer_size, do_upserts=do_upserts)
-        yield m
-        m.commit()
+                          mongo_database=self._mongo_database, credentials=self._credentials,
+                          buffer_size=buffer_size, do_upserts=do_upserts, write_behind=write_behind,
+                          max_in_flight=max_in_flight, target_bytes=target_bytes, target_latency=target_latency)
+        try:
+            yield m
+            m.commit()
+        finally:
+            m.close()
 
     def keys(self):
         """
@@ -243,7 +371,7 @@ class BasicMongoDict:
 
         :return: list of keys.
         """
-        return list(self.__iter__())
+        return list(self.iter_keys())
 
     def __contains__(self, item):
         """
@@ -261,56 +389,512 @@ class BasicMongoDict:
     def __repr__(self):
         return "Mongo_Dict ({})".format(self._original_dict_id)
 
-    def values(self):
+    def values(self, batch_size: int=None, sort: bool=False, chunked: bool=False):
         """
         Returns the values of the dictionary. It must be forcefully iterated.
+        :param batch_size: number of entries retrieved from the backend on each round trip. None for the driver's
+                    default.
+        :param sort: if set, the entries are ordered by key. Otherwise they come in the order of the backend, which is
+                    cheaper.
+        :param chunked: if set, it yields lists of values (of batch_size elements) instead of single values.
+        """
+        return self._iterate(itemgetter('value'), {'value': 1}, batch_size=batch_size, sort=sort, chunked=chunked)
+
+    def iter_keys(self, batch_size: int=None, sort: bool=False, chunked: bool=False):
+        """
+        Returns the keys of the dictionary. It must be forcefully iterated. Parameters have the same meaning as in
+        values().
         """
-        for x in self._instance.find({}, {'_id':0, 'value': 1}):
-            yield x['value']
+        return self._iterate(itemgetter('key'), {'key': 1}, batch_size=batch_size, sort=sort, chunked=chunked)
 
     def __iter__(self):
-        for x in self._instance.find({}, {'_id':0, 'key': 1}):
-            yield x['key']
+        return self.iter_keys()
 
     def __delitem__(self, key):
         self._on_modified_callback()
-        result = self._instance.remove({'key': key})
+        self._instance.delete_one({'key': key})
+
+    def items(self, batch_size: int=None, sort: bool=False, chunked: bool=False, raw: bool=False):
+        """
+        Returns the (key, value) pairs of the dictionary. It must be forcefully iterated. Parameters have the same
+        meaning as in values().
+        :param raw: if set, it yields the documents of the backend ({'key': key, 'value': value}) instead of pairs,
+                    which saves building a tuple per entry.
+        """
+        transform = None if raw else itemgetter('key', 'value')
+        return self._iterate(transform, {'key': 1, 'value': 1}, batch_size=batch_size, sort=sort, chunked=chunked)
+
+    def _iterate(self, transform, projection: dict, batch_size: int=None, sort: bool=False, chunked: bool=False):
+        documents = self._find_documents(projection, batch_size=batch_size, sort=sort)
+
+        if transform is not None:
+            documents = map(transform, documents)
+
+        if chunked:
+            documents = self._chunks(documents, batch_size or ITERATION_CHUNK_SIZE)
+
+        return documents
+
+    @staticmethod
+    def _chunks(iterable, chunk_size: int):
+        iterator = iter(iterable)
+        chunk = list(islice(iterator, chunk_size))
+
+        while len(chunk) > 0:
+            yield chunk
+            chunk = list(islice(iterator, chunk_size))
+
+    def _find_documents(self, projection: dict, batch_size: int=None, sort: bool=False):
+        """
+        Iterates over the documents of the dictionary, without their _id.
+        :param projection: fields of the documents to retrieve.
+        """
+        cursor = self._instance.find({}, dict(projection, _id=0))
+
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+
+        if sort:
+            cursor = cursor.sort('key', pymongo.ASCENDING)
 
-    def items(self):
-        for x in self._instance.find({}, {'_id':0, 'key': 1, 'value': 1}):
-            yield x['key'], x['value']
+        return cursor
 
-    def __call__(self, query: str, count_only: bool=False):
+    def __call__(self, query, count_only: bool=False, fields: list=None, sort=None, limit: int=None, skip: int=None,
+                 **parameters):
         """
         Performs a query over the dictionary. It uses a simple query.
 
-        :param query: string query to perform
+            >>> for key, value, _id in dictionary("value.age > 40", fields=["value.name"], sort="value.ts desc",
+            ...                                   limit=100):
+            ...     print(key, value['name'])
+
+        :param query: string query to perform, or prepared query returned by prepare().
 
         :param count_only: if set to true, it will return the length of the query result.
 
+        :param fields: if set, only these fields are retrieved: "key", "value" or fields of the value, like
+                    "value.name". The yielded values only contain the requested fields (None if none of them is a
+                    field of the value).
+
+        :param sort: order of the results, as a string of comma separated fields, each one optionally followed by
+                    "asc" or "desc" (for example: "value.ts desc, key"). A list of (field, direction) pairs is
+                    accepted as well. Otherwise they come in the order of the backend.
+
+        :param limit: maximum number of results. None or 0 for no limit.
+
+        :param skip: number of results to skip before the first one.
+
+        :param parameters: values for the parameters of a prepared query.
+
         :return: iterator for the elements that satisfies the query, or the size of the elements set if count_only
         param is true.
         """
 
-        m = MongoQueryParser()
-        mongo_query = m.transform_request(query)
-        mongo_cursor = self._instance.find(mongo_query)
+        mongo_query = QUERY_PARSER.to_mongo_query(query, **parameters)
+        sort = self._query_sort(sort) if sort is not None else None
+        self._advise(mongo_query, sort)
 
         if count_only:
-            yield mongo_cursor.count()
-        else:
-            for result in mongo_cursor:
-                yield result['key'], result['value'], result['_id']
+            # Cursor.count() is gone since pymongo 4
+            options = {option: amount for option, amount in [('skip', skip), ('limit', limit)] if amount}
+            yield self._instance.count_documents(mongo_query, **options)
+            return
+
+        mongo_cursor = self._instance.find(mongo_query, self._query_projection(fields))
+
+        if sort is not None:
+            mongo_cursor = mongo_cursor.sort(sort)
+
+        if skip:
+            mongo_cursor = mongo_cursor.skip(skip)
+
+        if limit:
+            mongo_cursor = mongo_cursor.limit(limit)
+
+        for result in mongo_cursor:
+            yield result['key'], result.get('value'), result['_id']
+
+    def aggregate(self, query="", group_by=None, accumulators: dict=None, **parameters):
+        """
+        Computes accumulators over the entries that satisfy a query, grouped by some of their fields, in the backend:
+            >>> dictionary.aggregate("value.ts > :since", group_by="value.tenant",
+            ...                      accumulators={"bytes": "sum value.bytes", "entries": "count"}, since=123)
+            [{'value.tenant': 'acme', 'bytes': 3072, 'entries': 2}, {'value.tenant': 'foo', 'bytes': 10, 'entries': 1}]
+
+        In forks, entries are resolved as in queries: the overrides and removals of upper layers replace the entries
+        of the lower layers. Each layer is grouped by the backend without the keys that are in the layers above it,
+        and the partial results of the layers are combined.
+
+        :param query: string query or prepared query that filters the entries. Empty string for every entry.
+        :param group_by: field, or list of fields, whose values make the groups: "key", "value" or fields of the value.
+                    None for a single group with every entry.
+        :param accumulators: dict with the name of each accumulator and its operator, followed by a field for all of
+                    them but count: "count", "sum value.bytes", "avg value.bytes", "min value.ts" or "max value.ts".
+                    Like in MongoDB, sum and avg ignore values that are not numbers, and min and max ignore missing
+                    values.
+        :param parameters: values for the parameters of a prepared query.
+        :return: list with a dict per group, ordered by the values of the group fields, with those values and the
+                    result of each accumulator.
+        """
+        mongo_query = QUERY_PARSER.to_mongo_query(query, **parameters)
+        group_fields = [group_by] if type(group_by) is str else list(group_by or [])
+
+        for field in group_fields:
+            self._check_query_field(field, ["key", "value"])
+
+        accumulators = {name: self._parse_accumulator(name, spec, group_fields)
+                        for name, spec in (accumulators or {}).items()}
+        group_stage = {'_id': {'g{}'.format(index): '$' + field for index, field in enumerate(group_fields)} or None}
+
+        for name, (operator, field) in accumulators.items():
+            group_stage.update(self._partial_accumulators(name, operator, field))
+
+        layers = self._layers()
+
+        if any(layer._client is not self._client or layer._mongo_database != self._mongo_database
+               for layer in layers):
+            raise Exception("Aggregations require every layer of the dictionary to be in the same database")
+
+        match = {'$and': [mongo_query, {'___removed': None}]} if mongo_query else {'___removed': None}
+        groups = {}
+
+        for index, layer in enumerate(layers):
+            pipeline = [{'$match': match}]
+
+            for upper_layer in layers[:index]:
+                pipeline += [{'$lookup': {'from': upper_layer._instance.name, 'localField': 'key',
+                                          'foreignField': 'key', 'as': '___upper'}},
+                             {'$match': {'___upper.0': {'$exists': False}}}]
+
+            pipeline.append({'$group': group_stage})
+
+            for group in layer._instance.aggregate(pipeline, allowDiskUse=True):
+                identity = bson_identity(group['_id'])
+
+                if identity in groups:
+                    self._combine_partials(groups[identity], group, accumulators)
+                else:
+                    groups[identity] = group
+
+        result = []
+
+        for group in sorted(groups.values(), key=lambda group: bson_sort_key(group['_id'])):
+            row = {field: (group['_id'] or {}).get('g{}'.format(index)) for index, field in enumerate(group_fields)}
+
+            for name, (operator, _) in accumulators.items():
+                if operator == "avg":
+                    count = group['___count_' + name]
+                    row[name] = self._divide_sum(group[name], count) if count > 0 else None
+                else:
+                    row[name] = group[name]
+
+            result.append(row)
+
+        return result
+
+    @staticmethod
+    def _parse_accumulator(name: str, spec: str, group_fields: list):
+        if "." in name or name.startswith("$") or name.startswith("___") or name == "_id" or name in group_fields:
+            raise Exception("Invalid accumulator name {}".format(name))
+
+        words = spec.split() if type(spec) is str else []
+
+        if words == ["count"]:
+            return "count", None
+
+        if len(words) != 2 or words[0] not in AGGREGATION_OPERATORS[1:]:
+            raise Exception("Invalid accumulator {}: {}".format(name, spec))
+
+        BasicMongoDict._check_query_field(words[1], ["key", "value"])
+        return words[0], words[1]
+
+    @staticmethod
+    def _partial_accumulators(name: str, operator: str, field: str):
+        """
+        Builds the $group accumulators that compute the partial result of an accumulator over a layer.
+        """
+        if operator == "count":
+            return {name: {'$sum': 1}}
+
+        if operator in ["min", "max"]:
+            return {name: {'$' + operator: '$' + field}}
+
+        partials = {name: {'$sum': '$' + field}}
+
+        if operator == "avg":
+            # The average is computed once the layers are combined, from the sum and the number of numeric values
+            partials['___count_' + name] = {'$sum': {'$cond': [{'$in': [{'$type': '$' + field}, NUMERIC_TYPES]},
+                                                               1, 0]}}
+
+        return partials
+
+    @staticmethod
+    def _combine_partials(combined: dict, group: dict, accumulators: dict):
+        """
+        Adds the partial results of a layer to the ones of the previous layers, for the same group.
+        """
+        for name, (operator, _) in accumulators.items():
+            if operator in ["min", "max"]:
+                values = [value for value in [combined[name], group[name]] if value is not None]
+                choose = min if operator == "min" else max
+                combined[name] = choose(values, key=bson_sort_key) if len(values) > 0 else None
+            else:
+                combined[name] = BasicMongoDict._add_sums(combined[name], group[name])
+
+                if operator == "avg":
+                    combined['___count_' + name] += group['___count_' + name]
+
+    @staticmethod
+    def _add_sums(augend, addend):
+        """
+        Adds two partial sums. As in MongoDB, the result is a Decimal128 if any of them is.
+        """
+        if type(augend) is not Decimal128 and type(addend) is not Decimal128:
+            return augend + addend
+
+        with localcontext(DECIMAL128_CONTEXT):
+            return Decimal128(BasicMongoDict._to_decimal(augend) + BasicMongoDict._to_decimal(addend))
+
+    @staticmethod
+    def _divide_sum(total, count: int):
+        """
+        Divides a sum by the number of values added, keeping Decimal128 sums as Decimal128.
+        """
+        if type(total) is not Decimal128:
+            return total / count
+
+        with localcontext(DECIMAL128_CONTEXT):
+            return Decimal128(total.to_decimal() / count)
+
+    @staticmethod
+    def _to_decimal(value):
+        if type(value) is Decimal128:
+            return value.to_decimal()
+
+        # The shortest representation of a float, as MongoDB converts doubles to decimals
+        return Decimal(repr(value)) if type(value) is float else Decimal(value)
+
+    def _advise(self, mongo_query: dict, sort: list=None):
+        """
+        Records the query in the index advisor, if it is enabled.
+        """
+        if INDEX_ADVISOR.enabled:
+            INDEX_ADVISOR.record(self._original_dict_id, mongo_query, sort, list(self.value_indexes().values()))
+
+    def value_indexes(self):
+        """
+        Retrieves the indexes over fields of the values of the dictionary. Only MongoDict keeps track of them.
+        :return: dict with the name of each index and its list of (field, direction) pairs.
+        """
+        return {}
+
+    @staticmethod
+    def _check_query_field(field: str, allowed: list):
+        if field not in allowed and not field.startswith("value."):
+            raise Exception("Invalid field {}: only {} or fields of the value can be used".format(field, allowed))
+
+    @staticmethod
+    def _query_projection(fields: list):
+        """
+        Builds the projection of a query that retrieves only the given fields, besides the key and the _id.
+        """
+        if fields is None:
+            return None
+
+        for field in fields:
+            BasicMongoDict._check_query_field(field, ["key", "value"])
+
+        projection = {'_id': 1, 'key': 1}
+
+        # A field inside another requested field would collide with it
+        projection.update({field: 1 for field in fields
+                           if not any(field.startswith(other + ".") for other in fields)})
+
+        return projection
+
+    @staticmethod
+    def _query_sort(sort):
+        sort = QUERY_PARSER.transform_sort(sort)
+
+        for field, _ in sort:
+            BasicMongoDict._check_query_field(field, ["key", "value", "_id"])
+
+        return sort
+
+    def prepare(self, query: str):
+        """
+        Compiles a query with parameters, so that it can be performed many times with different values without being
+        parsed again:
+            >>> by_tenant = dictionary.prepare("value.tenant eq :t and value.ts > :since")
+            >>> for key, value, _ in dictionary(by_tenant, t="acme", since=123):
+            ...     print(key, value)
+
+        :param query: string query with :name parameters in place of the values.
+        :return: PreparedQuery instance.
+        """
+        return QUERY_PARSER.prepare(query)
 
     def __len__(self):
-        return self._instance.find().count()
+        return self._instance.estimated_document_count()
+
+    def scan(self, start_after: str=None, page_size: int=SCAN_PAGE_SIZE):
+        """
+        Iterates over the (key, value) pairs of the dictionary in pages, each one retrieved with its own short query.
+        Every page comes with a resume token, which allows to resume the scan after that page later, even from another
+        process:
+            >>> for page, token in dictionary.scan(page_size=1000):
+            ...     export(page)
+            ...     save_checkpoint(token)
+
+            >>> for page, token in dictionary.scan(start_after=load_checkpoint()):
+            ...     export(page)
+
+        Entries are paged by their _id, layer by layer in the case of forks. Entries written or removed while the scan
+        is running might be included or not.
+
+        :param start_after: resume token of the last page processed. None to start from the beginning.
+        :param page_size: number of entries read per page. Pages of forks might have less entries, since the ones
+                    overridden or removed in upper layers are skipped. Empty pages are not yielded.
+        :return: iterator of tuples (list of (key, value) pairs, resume token).
+        """
+        layer_names = [layer._instance.full_name for layer in self._layers()]
+        first_layer, last_id = 0, None
+
+        if start_after is not None:
+            layer_name, last_id = self._decode_scan_token(start_after)
+
+            if layer_name not in layer_names:
+                raise Exception("The resume token does not belong to this dictionary, or it has been compacted since "
+                                "the token was taken.")
+
+            first_layer = layer_names.index(layer_name)
+
+        yield from self._scan_pages(page_size, first_layer=first_layer, last_id=last_id)
+
+    def _scan_pages(self, page_size: int, first_layer: int=0, last_id=None, bounds: dict=None):
+        """
+        Iterates over the pages of the dictionary, starting after last_id of the first_layer.
+        :param bounds: optional dict of layer collection name -> (lowest _id, upper _id excluded) to restrict the scan
+                    to. None means no limit. Layers missing from the bounds are skipped.
+        """
+        layers = self._layers()
+        layer_names = [layer._instance.full_name for layer in layers]
+
+        for index in range(first_layer, len(layers)):
+            if bounds is not None and layer_names[index] not in bounds:
+                continue
+
+            lower, upper = (bounds or {}).get(layer_names[index], (None, None))
+
+            while True:
+                query = {'___removed': None}
+                id_range = {}
+
+                if last_id is not None:
+                    id_range['$gt'] = last_id
+                elif lower is not None:
+                    id_range['$gte'] = lower
+
+                if upper is not None:
+                    id_range['$lt'] = upper
+
+                if len(id_range) > 0:
+                    query['_id'] = id_range
+
+                documents = list(layers[index]._instance.find(query, {'key': 1, 'value': 1})
+                                 .sort('_id', pymongo.ASCENDING).limit(page_size))
+
+                if len(documents) == 0:
+                    break
+
+                last_id = documents[-1]['_id']
+                hidden_keys = self._keys_in_layers(layers[:index], [document['key'] for document in documents])
+                page = [(document['key'], document['value']) for document in documents
+                        if bson_identity(document['key']) not in hidden_keys]
+
+                if len(page) > 0:
+                    yield page, self._encode_scan_token(layer_names[index], last_id)
+
+                if len(documents) < page_size:
+                    break
 
-    def __del__(self):
+            last_id = None
+
+    def split_scan(self, partitions: int, page_size: int=SCAN_PAGE_SIZE):
+        """
+        Splits the dictionary into several partitions, that can be iterated in parallel from different threads or
+        processes. Each entry of the dictionary is in exactly one of the partitions:
+            >>> with multiprocessing.Pool(4) as pool:
+            ...     pool.map(process_partition, dictionary.split_scan(4))
+
+        Each layer of the dictionary is split into ranges of _id, sampled to hold a similar number of entries.
+        Partitions are iterators of (key, value) pairs; they only hold the location of the dictionary, so they can be
+        pickled and sent to other processes.
+
+        :param partitions: number of partitions to split the dictionary into. Dictionaries with few entries are split
+                    into less partitions, down to a single one when empty.
+        :param page_size: number of entries read per query when iterating a partition.
+        :return: list of ScanPartition.
+        """
+        layers_split_points = {layer._instance.full_name: self._split_points(layer._instance, partitions)
+                               for layer in self._layers()}
+        result = []
+
+        for index in range(1 + max(len(split_points) for split_points in layers_split_points.values())):
+            # Layers with less split points than the partition index are not part of the partition
+            bounds = {layer_name: (split_points[index - 1] if index > 0 else None,
+                                   split_points[index] if index < len(split_points) else None)
+                      for layer_name, split_points in layers_split_points.items() if index <= len(split_points)}
+
+            result.append(ScanPartition(self, bounds, page_size=page_size))
+
+        return result
+
+    @staticmethod
+    def _split_points(collection, partitions: int):
+        """
+        Finds the _id that split a collection into ranges of similar size, from a sample of its _id.
+        :return: list of up to partitions - 1 sorted and distinct _id. Empty if the collection is empty.
+        """
+        sampled_ids = sorted({document['_id'] for document in
+                              collection.aggregate([{'$sample': {'size': partitions * SPLIT_SAMPLES_PER_PARTITION}},
+                                                    {'$project': {'_id': 1}}])})
+
+        # The lowest sampled _id would only split off the entries not sampled below it
+        positions = {len(sampled_ids) * index // partitions for index in range(1, partitions)} - {0}
+
+        return [sampled_ids[position] for position in sorted(positions)]
+
+    def _keys_in_layers(self, layers: list, keys: list):
+        """
+        Retrieves which of the given keys are in any of the given layers, removed or not.
+        """
+        found = set()
+
+        if len(keys) > 0:
+            for layer in layers:
+                for document in layer._instance.find({'key': {'$in': keys}}, {'_id': 0, 'key': 1}):
+                    found.add(bson_identity(document['key']))
+
+        return found
+
+    @staticmethod
+    def _encode_scan_token(layer_name: str, last_id):
+        return urlsafe_b64encode(bson.BSON.encode({'layer': layer_name, 'after': last_id})).decode('ascii')
+
+    @staticmethod
+    def _decode_scan_token(token: str):
         try:
-            self._client.fsync()
-        except pymongo.errors.OperationFailure:
-            pass
-        self._client.close()
+            position = bson.BSON(urlsafe_b64decode(token.encode('ascii'))).decode()
+            return position['layer'], position['after']
+        except Exception:
+            raise Exception("Invalid resume token: {}".format(token))
+
+    def _layers(self):
+        """
+        Retrieves the dicts whose own collections back this dict, ordered by precedence.
+        """
+        return [self]
 
     def last_element_id(self):
         last_elements = list(self._instance.find().sort("_id", pymongo.DESCENDING).limit(1))
@@ -321,64 +905,165 @@ class BasicMongoDict:
     def _on_modified_callback(self):
         pass
 
+    def _get_dict_meta(self):
+        """
+        Retrieves the metadata dictionary that lives in the same backend as this dictionary. It shares the client
+        of this dictionary, so it is cheap to build.
+        """
+        return BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
+                              mongo_port=self._mongo_port, mongo_database=self._mongo_database,
+                              credentials=self._credentials)
+
     def _drop(self):
         self._instance.drop()
+        CLIENT_POOL.forget_key_index(self._instance)
 
     def get_my_id(self):
         return self._original_dict_id
 
     def update(self, ext_dict):
-        with self.bulk() as b:
-            for key, value in ext_dict.items():
-                b[key] = value
+        self.set_many(ext_dict)
 
 
 class MongoDict(BasicMongoDict):
     """
     This dictionary is special: keeps track of itself in a special collection ___MONGO_DICT_META___
     """
+
     def __init__(self, original_dict_id:str=None, mongo_host:str="localhost", mongo_port:int=27017,
                  mongo_database="mongo_dicts", credentials:tuple=None, version=None, allow_morph:bool=True,
-                 immutable_version=False):
+                 immutable_version=False, cache:LRUCache=None, metadata_chain:dict=None):
+        """
+        :param version: version of the dict to load. If None, it loads the latest one.
+        :param allow_morph: allows the dict to turn into a ForkedMongoDict when a new version is found.
+        :param immutable_version: if set, the dict does not track new versions.
+        :param cache: optional LRUCache to serve the reads of hot keys without going to the backend. It is updated
+                      by the writes done through this dict and cleared when a new version of the dict is detected.
+        :param metadata_chain: metadata of this dict and of the dicts it descends from, as returned by
+                      _read_metadata_chain(). Fathers are built with the chain already read by their children, so
+                      loading a fork does not query the metadata once per layer.
+        """
         BasicMongoDict.__init__(self, original_dict_id=original_dict_id, mongo_host=mongo_host, mongo_port=mongo_port,
                  mongo_database=mongo_database, credentials=credentials)
 
+        self._cache = cache
+        self._key_filter = None
+        self._missing_keys = None
         self._allow_morph = allow_morph
         self._version = version
         self._immutable_version = immutable_version
-        self._load_version(version)
+        self._load_version(version, metadata_chain)
         self._thread_lock = Lock()
         self._update_required = False
+        # Used once this dict is a fork, whether it is built as one or morphed into one
+        self._merge_threshold = FORK_MERGE_THRESHOLD
 
         if not immutable_version:
-            self._executor = PeriodicExecutor(1, 1, target=self._update_thread_checker)
-            self._executor.open()
+            VERSION_WATCHER.watch(self)
 
     def _on_modified_callback(self):
+        # Updated in place, so that concurrent updates of the length counters are not overwritten
+        self._get_dict_meta()._instance.update_one({'key': self._original_dict_id},
+                                                   {'$set': {'value.modified': True}})
 
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+    def _length_delta(self, changes:list):
+        """
+        Computes how many entries some changes add to this dict (negative if they remove entries), from the visibility
+        of their keys before the changes are applied. Only forks keep a length counter.
+        :param changes: list of tuples (key, visible), where visible tells whether the key is in the dict after the
+                    change. Only the last change of each key counts.
+        :return: the difference of length, or None if this dict does not keep a length counter.
+        """
+        if type(self) is not ForkedMongoDict or len(changes) == 0:
+            return None
 
-        metadata = dict_meta[self._original_dict_id]
-        metadata.update({'modified': True})
-        dict_meta[self._original_dict_id] = metadata
+        latest = {}
+        for key, visible in changes:
+            latest[bson_identity(key)] = (key, visible)
+
+        found = self._get_many_raw([key for key, _ in latest.values()])
+        previous = [found.get(identity) for identity in latest]
 
-    def _load_version(self, version=None):
+        return sum(int(visible) - int(document is not None and '___removed' not in document)
+                   for (_, visible), document in zip(latest.values(), previous))
+
+    def _add_length(self, delta):
+        """
+        Adds a delta to the length counter of this dict, if it keeps one.
+        """
+        if delta:
+            field = 'value.lengths.{}'.format(self._version)
+            self._get_dict_meta()._instance.update_one({'key': self._original_dict_id, field: {'$exists': True}},
+                                                       {'$inc': {field: delta}})
+
+    def _forget_length(self):
+        """
+        Discards the length counter of this dict, so that it is counted again the next time it is needed.
+        """
+        if type(self) is ForkedMongoDict:
+            self._get_dict_meta()._instance.update_one({'key': self._original_dict_id},
+                                                       {'$unset': {'value.lengths.{}'.format(self._version): ""}})
+
+    def recount(self):
+        """
+        Counts the entries of the dictionary from scratch. The length counter of forks is fixed with the result.
+        Counters might drift when a bulk write fails halfway, or when several processes write the same keys of a fork
+        at the same time.
+        :return: number of entries of the dictionary.
+        """
+        self._update_from_latest()
+
+        if type(self) is not ForkedMongoDict:
+            return self._instance.count_documents({})
+
+        length = sum(1 for _ in self._find_documents({}, sort=True))
+        self._get_dict_meta()._instance.update_one({'key': self._original_dict_id},
+                                                   {'$set': {'value.lengths.{}'.format(self._version): length}})
+        return length
+
+    def _read_metadata_chain(self):
+        """
+        Reads the metadata of this dict and of the dicts it descends from (following their ancestor forks) with a
+        single query.
+        :return: dict of dict id -> metadata. Dicts without metadata are not included.
+        """
+        fields = {'_id': 0, 'key': 1}
+        fields.update({'value.{}'.format(field): 1 for field in ['version', 'base_versions', 'ancestor_fork',
+                                                                  'ancestor_version', 'value_indexes']})
+        documents = self._get_dict_meta()._instance.aggregate([
+            {'$match': {'key': self._original_dict_id}},
+            {'$graphLookup': {'from': ___MONGO_DICT_META___, 'startWith': '$value.ancestor_fork',
+                              'connectFromField': 'value.ancestor_fork', 'connectToField': 'key',
+                              'as': 'ancestors'}},
+            {'$project': dict(fields, **{'ancestors.{}'.format(field): 1 for field in fields if field != '_id'})}
+        ])
+
+        chain = {}
+
+        for document in documents:
+            for metadata in [document] + document.get('ancestors', []):
+                chain[metadata['key']] = metadata['value']
+
+        return chain
+
+    def _load_version(self, version=None, metadata_chain:dict=None):
         """
         Loads a specific version of this dict.
         :param version: version to load (int number from 0 to N). If None specified, it will load the latest version.
+        :param metadata_chain: metadata of this dict and of its ancestors, if it has already been read.
         """
+        if metadata_chain is None or self._original_dict_id not in metadata_chain:
+            metadata_chain = self._read_metadata_chain()
 
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+        if self._original_dict_id not in metadata_chain:
+            dict_meta = self._get_dict_meta()
 
-        try:
-            metadata = dict_meta[self._original_dict_id]
-        except KeyError:
-            metadata = {'version': [], 'modified': True}
-            dict_meta[self._original_dict_id] = metadata
+            # Only inserted if no other process has created it meanwhile
+            dict_meta._instance.update_one({'key': self._original_dict_id},
+                                           {'$setOnInsert': {'value': {'version': [], 'modified': True}}}, upsert=True)
+            metadata_chain[self._original_dict_id] = dict_meta[self._original_dict_id]
+
+        metadata = metadata_chain[self._original_dict_id]
 
         if version is None:
             self._update_required = False
@@ -392,33 +1077,89 @@ class MongoDict(BasicMongoDict):
         else:
             self._version = version
 
-        if self._version > 0:
+        # Fathers are specific versions, so they are loaded as immutable, from the metadata already read. Dicts that
+        # cannot morph do not use them.
+        if self._version in metadata.get('base_versions', []):
+            # Compacted version, it has no fathers
+            self._morph_into_root()
+        elif self._version > 0:
             self._morph_into_fork(MongoDict(original_dict_id=self._original_dict_id, mongo_host=self._mongo_host,
                                             mongo_port=self._mongo_port, mongo_database=self._mongo_database,
-                                            credentials=self._credentials, version=self._version-1))
+                                            credentials=self._credentials, version=self._version-1,
+                                            immutable_version=True, metadata_chain=metadata_chain)
+                                  if self._allow_morph else None)
         elif 'ancestor_fork' in metadata:
             self._morph_into_fork(MongoDict(original_dict_id=metadata['ancestor_fork'], mongo_host=self._mongo_host,
                                             mongo_port=self._mongo_port, mongo_database=self._mongo_database,
-                                            credentials=self._credentials, version=metadata['ancestor_version']))
+                                            credentials=self._credentials, version=metadata['ancestor_version'],
+                                            immutable_version=True, metadata_chain=metadata_chain)
+                                  if self._allow_morph else None)
 
-    def _update_thread_checker(self):
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+        self._ensure_value_indexes(metadata)
 
-        if self._immutable_version or not self._allow_morph:
-            return False
+    def _ensure_value_indexes(self, metadata:dict):
+        """
+        Creates the value indexes recorded in the metadata of this dict on its own collection.
+        """
+        for index in metadata.get('value_indexes', []):
+            CLIENT_POOL.ensure_index(self._instance, [tuple(key) for key in index['keys']], index['name'])
 
-        try:
-            versions = dict_meta[self._original_dict_id]['version']
-            if len(versions) > 0 and versions[-1] != self._version:
-                with self._thread_lock:
-                    self._update_required = True
+    def create_value_index(self, fields):
+        """
+        Creates an index over fields of the values, so that queries that filter or sort by them do not need to scan
+        the whole dictionary:
+            >>> dictionary.create_value_index("value.age")
+            >>> dictionary.create_value_index("value.tenant, value.ts desc")
+
+        The index is recorded in the metadata of the dictionary. It is created on every collection of its fork and
+        version chain, and on the collections of the versions and forks created from it afterwards.
+
+        :param fields: fields of the index, with the same syntax as the sort of queries: comma separated fields of the
+                    value, each one optionally followed by "asc" or "desc". A list of (field, direction) pairs is
+                    accepted as well.
+        :return: name of the index.
+        """
+        self._update_from_latest()
+        keys = QUERY_PARSER.transform_sort(fields)
+
+        for field, _ in keys:
+            self._check_query_field(field, ["value"])
+
+        name = "_".join("{}_{}".format(field, direction) for field, direction in keys)
+        self._get_dict_meta()._instance.update_one({'key': self._original_dict_id}, {'$addToSet': {
+            'value.value_indexes': {'name': name, 'keys': [[field, direction] for field, direction in keys]}}})
 
+        for layer in self._layers():
+            CLIENT_POOL.ensure_index(layer._instance, keys, name)
+
+        return name
+
+    def value_indexes(self):
+        """
+        Retrieves the indexes over fields of the values of the dictionary, created with create_value_index().
+        :return: dict with the name of each index and its list of (field, direction) pairs.
+        """
+        try:
+            metadata = self._get_dict_meta()[self._original_dict_id]
         except KeyError:
-            pass
+            metadata = {}
+
+        return {index['name']: [tuple(key) for key in index['keys']] for index in metadata.get('value_indexes', [])}
+
+    def _check_versions(self, versions:list):
+        """
+        Called by the version watcher each time the metadata of this dict changes.
+        :param versions: list of versions of this dict, as stored in the metadata.
+        """
+        if self._immutable_version or not self._allow_morph:
+            return
 
-        return True
+        if len(versions) > 0 and versions[-1] != self._version:
+            with self._thread_lock:
+                self._update_required = True
+
+            if self._cache is not None:
+                self._cache.clear()
 
     def _morph_into_fork(self, father):
         """
@@ -451,41 +1192,173 @@ class MongoDict(BasicMongoDict):
             self._fork_father._immutable_version = True
 
         self._instance = self._storage[self._original_dict_id+("v{}".format(self._version) if self._version > 0 else "")]
-        self._instance.create_index([('key', pymongo.TEXT)], name='key_index')
+        CLIENT_POOL.ensure_key_index(self._instance)
 
-    def fork(self, new_id=None):
-        self._update_from_latest()
+    def _morph_into_root(self):
+        """
+        Morphs this dictionary back into a dictionary without fathers, if it is a fork dictionary.
+        """
+        if self._allow_morph and type(self) is ForkedMongoDict:
+            self.__class__ = MongoDict
 
-        if new_id is None:
-            new_id = str(ObjectId())
+            for attribute in ['__contains__', '__str__', '__repr__', '__len__', '__getitem__', '__delitem__',
+                              '__call__', '__iter__', 'items', 'bulk', '_fork_father']:
+                self.__dict__.pop(attribute, None)
 
-        if new_id == self._original_dict_id:
-            raise Exception("Fork cannot override father's ID")
+        self._instance = self._storage[self._original_dict_id+("v{}".format(self._version) if self._version > 0 else "")]
+        CLIENT_POOL.ensure_key_index(self._instance)
+
+    def compact(self, progress_callback=None):
+        """
+        Collapses the fork and version chain of this dictionary into a single new version, applying the overrides and
+        removals of every layer. Reads, iterations and queries on the compacted dictionary do not need to go through
+        the fathers anymore:
+            >>> fork = dictionary.fork()
+            >>> fork.compact(progress_callback=lambda done, total: print("{}/{}".format(done, total)))
+
+        The previous versions are kept, since other forks might rely on them. They can be removed with a DictDropper.
+        Writes done to this dictionary by other processes while it is being compacted might be lost.
+
+        :param progress_callback: optional function called as progress_callback(done, total) each time a step of the
+                    compaction is finished.
+        """
+        self._update_from_latest()
+
+        if self._immutable_version:
+            raise Exception("An immutable version cannot be compacted")
 
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+        if type(self) is not ForkedMongoDict:
+            return
 
+        dict_meta = self._get_dict_meta()
         metadata = dict_meta[self._original_dict_id]
+        new_version = max(metadata['version'] + [self._version]) + 1
 
-        if metadata['modified']:
-            metadata['version'].append(self._version + 1)
-            metadata['modified'] = False
-            dict_meta[self._original_dict_id] = metadata
+        target = self._storage["{}v{}".format(self._original_dict_id, new_version)]
+        target.drop()
+        CLIENT_POOL.forget_key_index(target)
+        CLIENT_POOL.ensure_key_index(target)
 
-        result = ForkedMongoDict(self, new_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
-                                 mongo_database=self._mongo_database, credentials=self._credentials)
+        layers = self._layers()
+        merged = False
 
-        # Reload the latest version
-        self._load_version()
+        # Layers in other backends cannot be merged by the server
+        if all(layer._client is self._client for layer in layers) and CLIENT_POOL.supports(self._client, '$merge'):
+            try:
+                self._compact_server_side(layers, target, progress_callback)
+                merged = True
+            except OperationFailure as ex:
+                # $merge is only available from MongoDB 4.2 onwards
+                if ex.code not in UNSUPPORTED_STAGE_ERROR_CODES:
+                    raise
 
-        return result
+                CLIENT_POOL.set_unsupported(self._client, '$merge')
 
-    @contextmanager
-    def bulk(self, buffer_size: int=500, do_upserts: bool=True):
-        """
-        Performs a bulk operation over the dictionary. It can be write and/or delete of elements.
-        It is managed by a contextmanager. An example of use is:
+        if not merged:
+            self._compact_client_side(target, progress_callback)
+
+        # Updated in place, so that concurrent updates of other fields, like the length counters, are not overwritten
+        dict_meta._instance.update_one({'key': self._original_dict_id},
+                                       {'$push': {'value.version': new_version, 'value.base_versions': new_version},
+                                        '$set': {'value.modified': False}})
+
+        self._load_version()
+
+    @staticmethod
+    def _compact_server_side(layers:list, target, progress_callback=None):
+        """
+        Merges the layers into the target collection with $merge, from the root of the chain to the top, so that
+        upper layers override lower ones. Tombstones are removed at the end.
+        """
+        total = len(layers) + 1
+
+        for index, layer in enumerate(reversed(layers)):
+            layer._instance.aggregate([
+                {'$project': {'_id': 0}},
+                {'$merge': {'into': {'db': target.database.name, 'coll': target.name}, 'on': 'key',
+                            'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+            ])
+
+            if progress_callback is not None:
+                progress_callback(index + 1, total)
+
+        target.delete_many({'___removed': 1})
+
+        if progress_callback is not None:
+            progress_callback(total, total)
+
+    def _compact_client_side(self, target, progress_callback=None):
+        """
+        Copies the effective view of this dict into the target collection, streaming it through the client.
+        """
+        target.delete_many({})
+        total = len(self)
+        done = 0
+        operations = []
+
+        for document in self.items(batch_size=COMPACT_BUFFER_SIZE, raw=True):
+            operations.append(InsertOne(document))
+
+            if len(operations) >= COMPACT_BUFFER_SIZE:
+                target.bulk_write(operations, ordered=False)
+                done += len(operations)
+                operations = []
+
+                if progress_callback is not None:
+                    progress_callback(done, max(done, total))
+
+        if len(operations) > 0:
+            target.bulk_write(operations, ordered=False)
+            done += len(operations)
+
+        if progress_callback is not None:
+            progress_callback(done, done)
+
+    def fork(self, new_id=None, merge_threshold: int=FORK_MERGE_THRESHOLD):
+        """
+        Forks the dictionary, without copying its content.
+        :param new_id: ID of the new dictionary. If None, a new one is generated.
+        :param merge_threshold: number of keys in the upper layers of the fork above which its iterations and queries
+                    merge the layers sorted by key, instead of keeping those keys in memory.
+        :return: ForkedMongoDict of the fork.
+        """
+        self._update_from_latest()
+
+        if new_id is None:
+            new_id = str(ObjectId())
+
+        if new_id == self._original_dict_id:
+            raise Exception("Fork cannot override father's ID")
+
+        dict_meta = self._get_dict_meta()
+
+        metadata = dict_meta[self._original_dict_id]
+
+        if metadata['modified']:
+            # The new version starts empty, on top of the current one. It is pushed only once, even if other processes
+            # fork the same version at the same time
+            new_version = self._version + 1
+            length = len(self)
+            dict_meta._instance.update_one({'key': self._original_dict_id, 'value.version': {'$ne': new_version}},
+                                           {'$push': {'value.version': new_version},
+                                            '$set': {'value.lengths.{}'.format(new_version): length,
+                                                     'value.modified': False}})
+
+        result = ForkedMongoDict(self, new_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
+                                 mongo_database=self._mongo_database, credentials=self._credentials,
+                                 cache=self._cache, merge_threshold=merge_threshold)
+
+        # Reload the latest version
+        self._load_version()
+
+        return result
+
+    @contextmanager
+    def bulk(self, buffer_size: int=500, do_upserts: bool=True, write_behind: bool=False, max_in_flight: int=2,
+             target_bytes: int=None, target_latency: float=None):
+        """
+        Performs a bulk operation over the dictionary. It can be write and/or delete of elements.
+        It is managed by a contextmanager. An example of use is:
             >>> with dictionary.bulk() as d:
             ...     d['k1'] = "v1"
             ...     d['k2'] = "v2"
@@ -518,14 +1391,73 @@ class MongoDict(BasicMongoDict):
                     normal dictionary, but appending lot of new elements is notably slower.
                     If during the bulk, it is ensured that all the elements are new, set this parameter
                     to false to speed up the operation.
+                    If set to "auto", each buffer looks up which of its keys already exist with a single query:
+                    new keys are inserted and only the existing ones are replaced. Repeated keys in the same buffer
+                    are reduced to their last operation.
+
+        :param write_behind: if set, full buffers are written by a background thread while the next buffer is being
+                    filled. Errors are raised on the next operation or when the context is exited.
+
+        :param max_in_flight: maximum number of full buffers waiting to be written in write-behind mode. Once it is
+                    reached, writing to the bulk blocks until a buffer is written.
+
+        :param target_bytes: if set, the buffer is also flushed once its operations reach this BSON encoded size,
+                    and buffer_size is tuned after each commit towards the number of operations that fits in it.
+
+        :param target_latency: if set, buffer_size is tuned after each commit towards the number of operations that
+                    can be committed in these seconds. The chosen sizes and timings are given by stats() of the bulk.
 
         :return: context manager for the write and delete bulk operations.
         """
         self._update_from_latest()
-        m = BulkMongoDict(self._original_dict_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
-                          buffer_size=buffer_size, version=self._version, do_upserts=do_upserts)
-        yield m
-        m.commit()
+        m = self._build_bulk(buffer_size=buffer_size, do_upserts=do_upserts, write_behind=write_behind,
+                             max_in_flight=max_in_flight, target_bytes=target_bytes, target_latency=target_latency)
+        try:
+            yield m
+            m.commit()
+        finally:
+            m.close()
+
+    @contextmanager
+    def parallel_bulk(self, workers: int=4, buffer_size: int=500, do_upserts: bool=True, max_in_flight: int=2,
+                      target_bytes: int=None, target_latency: float=None):
+        """
+        Performs a bulk operation over the dictionary, written by several threads in parallel. It is used as bulk():
+            >>> with dictionary.parallel_bulk(workers=8) as d:
+            ...     for x in range(10000000):
+            ...         d['key{}'.format(x)] = x
+
+        Operations are partitioned by the hash of their key into one buffer per worker, and each worker writes its
+        buffers in order. Within a buffer, only the last operation over each key is written. Hence, the final state of
+        each key is the one of the last operation done over it.
+
+        Workers are threads, not processes: pymongo releases the GIL while it waits for the backend, which is where the
+        time of a bulk goes. Worker processes would not take the encoding of large values off this process either,
+        since the values would have to be pickled to reach them, and the lengths and the cache of the dictionary are
+        kept by this process.
+
+        :param workers: number of buffers, each one written by its own thread.
+        :param buffer_size: size of the buffer of each worker.
+        :param do_upserts: same meaning as in bulk().
+        :param max_in_flight: maximum number of full buffers waiting to be written by each worker.
+        :param target_bytes: same meaning as in bulk(), for the buffer of each worker.
+        :param target_latency: same meaning as in bulk(), for the buffer of each worker.
+        :return: context manager for the write and delete bulk operations.
+        """
+        self._update_from_latest()
+        m = ParallelBulkMongoDict([self._build_bulk(buffer_size=buffer_size, do_upserts=do_upserts, write_behind=True,
+                                                    max_in_flight=max_in_flight, target_bytes=target_bytes,
+                                                    target_latency=target_latency) for _ in range(workers)])
+        try:
+            yield m
+            m.commit()
+        finally:
+            m.close()
+
+    def _build_bulk(self, **kwargs):
+        return BulkMongoDict(self._original_dict_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
+                             mongo_database=self._mongo_database, credentials=self._credentials,
+                             version=self._version, cache=self._cache, length_tracker=self, **kwargs)
 
     def _update_from_latest(self, force_update=False):
         """
@@ -542,21 +1474,290 @@ class MongoDict(BasicMongoDict):
         return hasattr(other, '_original_dict_id') and hasattr(other, '_version') and \
                self._original_dict_id == other._original_dict_id and self._version == other._version
 
+    def _build_key_filter(self):
+        """
+        Builds the Bloom filter with the keys (tombstones included) of the own collection of this dict, if this dict is
+        a frozen layer: an immutable version for which a newer version exists, so nobody writes into it anymore.
+        :return: BloomFilter instance, or False if this layer is not frozen.
+        """
+        try:
+            versions = self._get_dict_meta()[self._original_dict_id]['version']
+        except KeyError:
+            return False
+
+        if len(versions) == 0 or versions[-1] <= self._version:
+            return False
+
+        # Frozen collections do not change, unless they are dropped and created again: then their first _id changes
+        first_document = self._instance.find_one({}, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)])
+        filter_key = (self._mongo_host, self._mongo_port, self._instance.full_name,
+                      first_document['_id'] if first_document is not None else None)
+
+        with _key_filters_lock:
+            key_filter = _key_filters.get(filter_key)
+
+            if key_filter is not None:
+                _key_filters.move_to_end(filter_key)
+
+        if key_filter is None:
+            key_filter = BloomFilter(capacity=self._instance.estimated_document_count())
+
+            for document in self._instance.find({}, {'_id': 0, 'key': 1}):
+                key_filter.add(document['key'])
+
+            with _key_filters_lock:
+                _key_filters[filter_key] = key_filter
+
+                while len(_key_filters) > KEY_FILTERS_CACHE_SIZE:
+                    _key_filters.popitem(last=False)
+
+        self._missing_keys = LRUCache(max_entries=MISSING_KEYS_CACHE_SIZE)
+        return key_filter
+
+    def _layer_might_contain(self, key):
+        """
+        Checks whether the own collection of this dict (this layer of the fork and version chain) might contain a key.
+        Only frozen layers can tell that a key is certainly not there, thanks to a Bloom filter built the first time
+        they are asked and to a cache of the keys recently missed.
+        :param key: key to check.
+        :return: False if the key is certainly not in this layer, True otherwise.
+        """
+        if not self._immutable_version:
+            return True
+
+        if self._key_filter is None:
+            self._key_filter = self._build_key_filter()
+
+        if self._key_filter is False:
+            return True
+
+        try:
+            return key in self._key_filter and not self._missing_keys.get(bson_identity(key))[0]
+        except InvalidDocument:
+            return True
+
+    def _layer_missed(self, key):
+        """
+        Records a key that was not found in the own collection of this dict, so the next lookups skip this layer.
+        """
+        if self._key_filter:
+            try:
+                self._missing_keys.put(bson_identity(key), True)
+            except InvalidDocument:
+                pass
+
+    def _get_layer_raw(self, keys:list):
+        """
+        Retrieves the raw documents for the given keys from the own collection of this dict, without going through
+        its fathers.
+        """
+        keys = [key for key in keys if self._layer_might_contain(key)]
+
+        return BasicMongoDict._get_many_raw(self, keys) if len(keys) > 0 else {}
+
+    def _layers(self):
+        """
+        Retrieves the dicts whose own collections back this dict, ordered by precedence: from this dict to the root of
+        its fork and version chain.
+        """
+        layers = [self]
+
+        while type(layers[-1]) is ForkedMongoDict:
+            layers.append(layers[-1]._fork_father)
+
+        return layers
+
+    def _get_many_raw(self, keys:list):
+        """
+        Retrieves the raw documents for the given keys, resolved through the whole fork and version chain. Tombstones
+        of removed keys are included. When the backend supports it, the chain is resolved with a single aggregation
+        query.
+        :param keys: list of item keys to search for.
+        :return: dict of bson_identity() of the key -> document. Keys not found are not included.
+        """
+        layers = self._layers()
+        same_database = all(layer._client is self._client and layer._mongo_database == self._mongo_database
+                            for layer in layers)
+
+        if len(layers) > 1 and same_database and CLIENT_POOL.supports(self._client, '$unionWith'):
+            try:
+                return self._get_many_raw_aggregated(layers, keys)
+            except OperationFailure as ex:
+                # $unionWith is only available from MongoDB 4.4 onwards
+                if ex.code not in UNSUPPORTED_STAGE_ERROR_CODES:
+                    raise
+
+                CLIENT_POOL.set_unsupported(self._client, '$unionWith')
+
+        result = {}
+
+        for layer in layers:
+            pending_keys = [key for key in keys if bson_identity(key) not in result]
+
+            if len(pending_keys) == 0:
+                break
+
+            found = layer._get_layer_raw(pending_keys)
+
+            for key in pending_keys:
+                if bson_identity(key) not in found:
+                    layer._layer_missed(key)
+
+            result.update(found)
+
+        return result
+
+    @staticmethod
+    def _get_many_raw_aggregated(layers:list, keys:list):
+        """
+        Resolves the raw documents for the given keys with a single aggregation over the collections of the given
+        layers. Each document is tagged with the precedence of its layer, and the one with the highest precedence wins.
+        Layers that certainly do not contain a key are not asked for it.
+        """
+        plan = []
+
+        for index, layer in enumerate(layers):
+            layer_keys = [key for key in keys if layer._layer_might_contain(key)]
+
+            if len(layer_keys) > 0:
+                plan.append((index, layer, layer_keys))
+
+        if len(plan) == 0:
+            return {}
+
+        def layer_stages(index, layer_keys):
+            return [{'$match': {'key': {'$in': layer_keys}}}, {'$addFields': {'___layer': index}}]
+
+        pipeline = layer_stages(plan[0][0], plan[0][2])
+
+        for index, layer, layer_keys in plan[1:]:
+            pipeline.append({'$unionWith': {'coll': layer._instance.name, 'pipeline': layer_stages(index, layer_keys)}})
+
+        pipeline += [
+            {'$sort': {'___layer': 1}},
+            {'$group': {'_id': '$key', 'document': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$document'}}
+        ]
+
+        result = {bson_identity(document['key']): document for document in plan[0][1]._instance.aggregate(pipeline)}
+
+        for index, layer, layer_keys in plan:
+            for key in layer_keys:
+                document = result.get(bson_identity(key))
+
+                if document is None or document['___layer'] > index:
+                    layer._layer_missed(key)
+
+        for document in result.values():
+            del document['___layer']
+
+        return result
+
+    def _cache_key(self, key):
+        # Keys are identified as MongoDB matches them: True and 1 are different keys, even if Python hashes them equally,
+        # and so are 2 ** 53 and 2 ** 53 + 1, even if they are equal as floats
+        return self._instance.full_name, self._version, bson_identity(key)
+
+    def _cache_get(self, key):
+        if self._cache is None:
+            return False, None
+
+        return self._cache.get(self._cache_key(key))
+
+    def _cache_put(self, key, value):
+        if self._cache is not None:
+            self._cache.put(self._cache_key(key), value)
+
+    def _cache_invalidate(self, key):
+        if self._cache is not None:
+            self._cache.invalidate(self._cache_key(key))
+
     def __setitem__(self, key, value):
         self._update_from_latest()
-        return BasicMongoDict.__setitem__(self, key, value)
+        delta = self._length_delta([(key, True)])
+        BasicMongoDict.__setitem__(self, key, value)
+        self._add_length(delta)
+        self._cache_put(key, value)
+
+    def get_many(self, keys, default=None):
+        self._update_from_latest()
+
+        if self._cache is None:
+            return BasicMongoDict.get_many(self, keys, default=default)
+
+        keys = list(keys)
+        cached = {}
+
+        for key in keys:
+            found, value = self._cache_get(key)
+            if found:
+                cached[bson_identity(key)] = value
+
+        found = self._get_many_raw([key for key in keys if bson_identity(key) not in cached])
+
+        result = {}
+        for key in keys:
+            document = found.get(bson_identity(key))
+
+            if bson_identity(key) in cached:
+                result[key] = cached[bson_identity(key)]
+            elif document is not None and '___removed' not in document:
+                result[key] = document['value']
+                self._cache_put(key, result[key])
+            else:
+                result[key] = default
+
+        return result
+
+    def set_many(self, mapping):
+        self._update_from_latest()
+        delta = self._length_delta([(key, True) for key in mapping])
+        BasicMongoDict.set_many(self, mapping)
+        self._add_length(delta)
+
+        for key, value in mapping.items():
+            self._cache_put(key, value)
+
+    def delete_many(self, keys):
+        self._update_from_latest()
+        keys = list(keys)
+        BasicMongoDict.delete_many(self, keys)
+
+        for key in keys:
+            self._cache_invalidate(key)
 
     def __getitem__(self, item):
         self._update_from_latest()
-        return BasicMongoDict.__getitem__(self, item)
+
+        if type(item) is tuple:
+            if not self._layer_might_contain(item[0]):
+                raise KeyError(item[0])
+
+            try:
+                return BasicMongoDict.__getitem__(self, item)
+            except KeyError:
+                self._layer_missed(item[0])
+                raise
+
+        found, result = self._cache_get(item)
+
+        if not found:
+            result = BasicMongoDict.__getitem__(self, item)
+            self._cache_put(item, result)
+
+        return result
 
     def __delitem__(self, key):
         self._update_from_latest()
-        return BasicMongoDict.__delitem__(self, key)
+        BasicMongoDict.__delitem__(self, key)
+        self._cache_invalidate(key)
 
     def __contains__(self, item):
         self._update_from_latest()
-        return BasicMongoDict.__contains__(self, item)
+        if self._cache_get(item)[0]:
+            return True
+
+        return self._layer_might_contain(item) and BasicMongoDict.__contains__(self, item)
 
     def __len__(self):
         self._update_from_latest()
@@ -566,22 +1767,34 @@ class MongoDict(BasicMongoDict):
         self._update_from_latest()
         return BasicMongoDict.keys(self)
 
-    def values(self):
+    def values(self, *args, **kwargs):
         self._update_from_latest()
-        return BasicMongoDict.values(self)
+        return BasicMongoDict.values(self, *args, **kwargs)
 
-    def items(self):
+    def items(self, *args, **kwargs):
         self._update_from_latest()
-        return BasicMongoDict.items(self)
+        return BasicMongoDict.items(self, *args, **kwargs)
 
-    def __iter__(self):
+    def iter_keys(self, *args, **kwargs):
+        self._update_from_latest()
+        return BasicMongoDict.iter_keys(self, *args, **kwargs)
+
+    def scan(self, *args, **kwargs):
+        self._update_from_latest()
+        return BasicMongoDict.scan(self, *args, **kwargs)
+
+    def split_scan(self, *args, **kwargs):
         self._update_from_latest()
-        return BasicMongoDict.__iter__(self)
+        return BasicMongoDict.split_scan(self, *args, **kwargs)
 
     def __call__(self, *args, **kwargs):
         self._update_from_latest()
         return BasicMongoDict.__call__(self, *args, **kwargs)
 
+    def aggregate(self, *args, **kwargs):
+        self._update_from_latest()
+        return BasicMongoDict.aggregate(self, *args, **kwargs)
+
 
 class ForkedMongoDict(MongoDict):
     """
@@ -589,20 +1802,39 @@ class ForkedMongoDict(MongoDict):
     """
 
     def __init__(self, father:MongoDict, original_dict_id:str=None, mongo_host:str="localhost", mongo_port:int=27017,
-                 mongo_database="mongo_dicts", credentials:tuple=None, version=None):
+                 mongo_database="mongo_dicts", credentials:tuple=None, version=None, cache:LRUCache=None,
+                 merge_threshold: int=FORK_MERGE_THRESHOLD):
+        """
+        :param merge_threshold: same meaning as in MongoDict.fork().
+        """
         MongoDict.__init__(self, original_dict_id=original_dict_id, mongo_host=mongo_host, mongo_port=mongo_port,
-                           mongo_database=mongo_database, credentials=credentials, version=version)
+                           mongo_database=mongo_database, credentials=credentials, version=version, cache=cache)
+        self._merge_threshold = merge_threshold
         self._fork_father = MongoDict(father._original_dict_id, version=father._version, mongo_host=father._mongo_host,
                                       mongo_port=father._mongo_port, mongo_database=father._mongo_database,
                                       credentials=father._credentials, immutable_version=True)
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+        dict_meta = self._get_dict_meta()
 
         metadata = dict_meta[self._original_dict_id]
-        metadata['ancestor_fork'] = father._original_dict_id
-        metadata['ancestor_version'] = father._version
-        dict_meta[self._original_dict_id] = metadata
+        created = 'ancestor_fork' not in metadata
+        field = 'value.lengths.{}'.format(self._version)
+
+        # Forks inherit the value indexes of their father
+        dict_meta._instance.update_one({'key': self._original_dict_id}, {
+            '$set': {'value.ancestor_fork': father._original_dict_id, 'value.ancestor_version': father._version},
+            '$addToSet': {'value.value_indexes': {
+                '$each': dict_meta[father._original_dict_id].get('value_indexes', [])}}})
+
+        # A new fork has the entries of its father. A fork moved on top of another father keeps its own entries, so
+        # it is counted from scratch the next time its length is needed
+        if created and self._instance.find_one({}, {'_id': 1}) is None:
+            dict_meta._instance.update_one({'key': self._original_dict_id, field: {'$exists': False}},
+                                           {'$set': {field: len(self._fork_father)}})
+        elif not created and (metadata['ancestor_fork'], metadata['ancestor_version']) != \
+                (father._original_dict_id, father._version):
+            self._forget_length()
+
+        self._ensure_value_indexes(dict_meta[self._original_dict_id])
 
     def __contains__(self, item):
         """
@@ -612,21 +1844,12 @@ class ForkedMongoDict(MongoDict):
         """
         self._update_from_latest()
 
-        i = self._instance.find_one({'key': item})
+        if self._cache_get(item)[0]:
+            return True
 
-        if i is None:
-            return item in self._fork_father
-        else:
-            return "___removed" not in i
+        i = self._get_raw(item)
 
-    def keys(self):
-        self._update_from_latest()
-        current_keys = list(self._instance.find())
-        removed_keys = set([k['key'] for k in current_keys if '___removed' in k])
-
-        father_keys = self._fork_father.keys()
-        total_keys = set(father_keys + [k['key'] for k in current_keys])
-        return [r for r in total_keys if r not in removed_keys]
+        return i is not None and "___removed" not in i
 
     def __str__(self):
         return "Mongo_Dict ({}) -- father: {} (v{})".format(self._original_dict_id, self._fork_father, self._fork_father._version)
@@ -635,37 +1858,70 @@ class ForkedMongoDict(MongoDict):
         return "Mongo_Dict ({}) -- father: {} (v{})".format(self._original_dict_id, self._fork_father, self._fork_father._version)
 
     def __len__(self):
+        """
+        Retrieves the number of entries of the fork, from the length counter kept in its metadata. If there is no
+        counter, it is counted from scratch.
+        """
         self._update_from_latest()
-        new_elements = self._instance.find({'___removed': None}).count()
-        removed_elements = self._instance.find({'___removed': 1}).count()
+        length = self._get_dict_meta()[self._original_dict_id].get('lengths', {}).get(str(self._version))
+
+        if length is None:
+            length = self.recount()
 
-        return max(0, len(self._fork_father) - removed_elements) + new_elements
+        return length
 
     def __getitem__(self, item):
         self._update_from_latest()
-        try:
-            result = MongoDict.__getitem__(self, (item, ) if type(item) is not tuple else item)
-        except KeyError:
-            try:
-                result = self._fork_father[(item, ) if type(item) is not tuple else item]
-            except KeyError as e:
-                raise e from None
 
-        if result is None or (result is not None and '___removed' in result):
+        if type(item) is not tuple:
+            found, result = self._cache_get(item)
+            if found:
+                return result
+
+        result = self._get_raw(item[0] if type(item) is tuple else item)
+
+        if result is None or '___removed' in result:
             raise KeyError(item)
 
         if type(item) is not tuple:
             result = result['value']
+            self._cache_put(item, result)
 
         return result
 
+    def _get_raw(self, key):
+        """
+        Retrieves the raw document for the given key, resolved through the whole fork and version chain.
+        :return: the document (it might be a tombstone), or None if not found.
+        """
+        return self._get_many_raw([key]).get(bson_identity(key))
+
     def __delitem__(self, key):
         self._update_from_latest()
+        delta = self._length_delta([(key, False)])
         self._on_modified_callback()
         self._instance.replace_one({'key': key}, {'key': key, 'value': None, '___removed': 1}, upsert=True)
+        self._add_length(delta)
+        self._cache_invalidate(key)
+
+    def delete_many(self, keys):
+        self._update_from_latest()
+        keys = list(keys)
+        operations = [ReplaceOne({'key': key}, {'key': key, 'value': None, '___removed': 1}, upsert=True)
+                      for key in keys]
+
+        if len(operations) > 0:
+            delta = self._length_delta([(key, False) for key in keys])
+            self._on_modified_callback()
+            self._instance.bulk_write(operations, ordered=False)
+            self._add_length(delta)
+
+        for key in keys:
+            self._cache_invalidate(key)
 
     @contextmanager
-    def bulk(self, buffer_size=500, do_upserts: bool=True):
+    def bulk(self, buffer_size=500, do_upserts: bool=True, write_behind: bool=False, max_in_flight: int=2,
+             target_bytes: int=None, target_latency: float=None):
         """
         Performs a bulk operation over the dictionary. It can be write and/or delete of elements.
         It is managed by a contextmanager. An example of use is:
@@ -701,131 +1957,602 @@ class ForkedMongoDict(MongoDict):
                     normal dictionary, but appending lot of new elements is notably slower.
                     If during the bulk, it is ensured that all the elements are new, set this parameter
                     to false to speed up the operation.
+                    If set to "auto", each buffer looks up which of its keys already exist with a single query:
+                    new keys are inserted and only the existing ones are replaced. Repeated keys in the same buffer
+                    are reduced to their last operation.
+
+        :param write_behind: if set, full buffers are written by a background thread while the next buffer is being
+                    filled. Errors are raised on the next operation or when the context is exited.
+
+        :param max_in_flight: maximum number of full buffers waiting to be written in write-behind mode. Once it is
+                    reached, writing to the bulk blocks until a buffer is written.
+
+        :param target_bytes: if set, the buffer is also flushed once its operations reach this BSON encoded size,
+                    and buffer_size is tuned after each commit towards the number of operations that fits in it.
+
+        :param target_latency: if set, buffer_size is tuned after each commit towards the number of operations that
+                    can be committed in these seconds. The chosen sizes and timings are given by stats() of the bulk.
 
         :return: context manager for the write and delete bulk operations.
         """
-        m = BulkMongoDictForked(original_dict_id=self._original_dict_id, mongo_host=self._mongo_host,
-                                mongo_port=self._mongo_port, mongo_database=self._mongo_database,
-                                credentials=self._credentials, buffer_size=buffer_size, version=self._version,
-                                do_upserts=do_upserts)
-        yield m
-        self._on_modified_callback()
-        m.commit()
+        m = self._build_bulk(buffer_size=buffer_size, do_upserts=do_upserts, write_behind=write_behind,
+                             max_in_flight=max_in_flight, target_bytes=target_bytes, target_latency=target_latency)
+        try:
+            yield m
+            self._on_modified_callback()
+            m.commit()
+        finally:
+            m.close()
+
+    def _build_bulk(self, **kwargs):
+        return BulkMongoDictForked(original_dict_id=self._original_dict_id, mongo_host=self._mongo_host,
+                                   mongo_port=self._mongo_port, mongo_database=self._mongo_database,
+                                   credentials=self._credentials, version=self._version, cache=self._cache,
+                                   length_tracker=self, **kwargs)
+
+    def iter_keys(self, batch_size: int=None, sort: bool=True, chunked: bool=False):
+        """
+        Returns the keys of the fork. It must be forcefully iterated. Unlike other iterations, keys are ordered by
+        default: the layers are read by key through their index and merged, so memory does not grow with the size of
+        the fork. With sort=False, keys come in the order of the backend, and the keys of the upper layers are kept in
+        memory to hide the same keys of the lower layers.
+        """
+        return MongoDict.iter_keys(self, batch_size=batch_size, sort=sort, chunked=chunked)
 
-    def items(self):
-        self._update_from_latest()
+    def _find_documents(self, projection: dict, batch_size: int=None, sort: bool=False, mongo_query: dict=None):
+        """
+        Iterates over the documents of the dictionary, resolved through the whole fork and version chain: documents
+        of upper layers hide the ones of the same key in lower layers, and removed keys are skipped.
+        :param mongo_query: optional filter of the documents.
+        """
+        if sort or self._upper_layers_size() > self._merge_threshold:
+            return self._merged_documents(projection, batch_size=batch_size, mongo_query=mongo_query)
 
-        for key, value, _id in self(""):
-            yield key, value
+        return self._layered_documents(projection, batch_size=batch_size, mongo_query=mongo_query)
 
-    def __iter__(self):
-        self._update_from_latest()
+    def _upper_layers_size(self):
+        """
+        Estimates the number of keys that hide the keys of the root of the chain.
+        """
+        return sum(layer._instance.estimated_document_count() for layer in self._layers()[:-1])
+
+    def _layered_documents(self, projection: dict, batch_size: int=None, mongo_query: dict=None):
+        """
+        Reads the layers one after the other, in the order of the backend. The keys of each layer are kept in memory
+        to hide the same keys of the lower layers.
+        """
+        layers = self._layers()
+        projection = dict({'_id': 0}, **projection)
+        projection['key'] = 1
+        query = {'$and': [mongo_query, {'___removed': None}]} if mongo_query else {'___removed': None}
+        hidden_keys = set()
+
+        for index, layer in enumerate(layers):
+            cursor = layer._instance.find(query, projection)
+
+            if batch_size is not None:
+                cursor = cursor.batch_size(batch_size)
+
+            for document in cursor:
+                if index == 0 or bson_identity(document['key']) not in hidden_keys:
+                    yield document
+
+            if index < len(layers) - 1:
+                # Every key of this layer (matching or not, removed or not) hides the same key in the lower layers
+                for document in layer._instance.find({}, {'_id': 0, 'key': 1}):
+                    hidden_keys.add(bson_identity(document['key']))
+
+    def _merged_documents(self, projection: dict, batch_size: int=None, mongo_query: dict=None):
+        """
+        Same as _layered_documents(), ordered by key. Layers are read sorted by key and merged, so no key needs to be
+        kept in memory. When there is a filter, the keys of the upper layers are read apart from the documents that
+        satisfy it, since they hide the lower layers even if they do not satisfy it.
+        """
+        layers = self._layers()
+        projection = dict({'_id': 0}, **projection)
+        projection.update({'key': 1, '___removed': 1})
+
+        def layer_entries(index, kind, query, fields):
+            cursor = layer_collections[index].find(query, fields).sort('key', pymongo.ASCENDING)
+
+            if batch_size is not None:
+                cursor = cursor.batch_size(batch_size)
+
+            for document in cursor:
+                yield bson_sort_key(document['key']), index, kind, document
+
+        layer_collections = [layer._instance for layer in layers]
+        streams = []
+
+        for index in range(len(layers)):
+            if mongo_query:
+                streams.append(layer_entries(index, 0, {'$and': [mongo_query, {'___removed': None}]}, projection))
+
+                if index < len(layers) - 1:
+                    streams.append(layer_entries(index, 1, {}, {'_id': 0, 'key': 1}))
+            else:
+                streams.append(layer_entries(index, 0, {}, projection))
+
+        entries = merge(*streams, key=itemgetter(0, 1, 2))
+
+        # Entries with the same sort key come in layer order, so the first one of each key is the visible one. Entries
+        # of kind 1 only tell that the key is in the layer
+        for _, same_sort_key_entries in groupby(entries, key=itemgetter(0)):
+            seen_keys = set()
 
-        for key, _, _ in self(""):
-            yield key
+            for _, _, kind, document in same_sort_key_entries:
+                identity = bson_identity(document['key'])
 
-    def __call__(self, query:str, count_only:bool=False):
+                if identity not in seen_keys:
+                    seen_keys.add(identity)
+
+                    if kind == 0 and '___removed' not in document:
+                        yield document
+
+    def __call__(self, query, count_only:bool=False, fields:list=None, sort=None, limit:int=None, skip:int=None,
+                 **parameters):
         """
         Performs a query over the dictionary. It uses a simple query.
-        :param query: string query to perform
+
+        Overrides and removals of the fork hide the entries of its fathers. If the upper layers of the fork have more
+        keys than the merge_threshold given to fork(), the layers are merged sorted by key instead of keeping those
+        keys in memory.
+        When a sort is given, each layer is sorted by the backend and the layers are merged, so a limited query only
+        transfers the entries that come before its last result.
+
+        :param query: string query to perform, or prepared query returned by prepare().
         :param count_only: if set to true, it will return the length of the query result.
+        :param fields: if set, only these fields are retrieved. Same as in MongoDict.
+        :param sort: order of the results. Same as in MongoDict.
+        :param limit: maximum number of results. None or 0 for no limit.
+        :param skip: number of results to skip before the first one.
+        :param parameters: values for the parameters of a prepared query.
         :return: iterator for the elements that satisfies the query, or the size of the elements set if count_only
         param is true.
         """
         self._update_from_latest()
 
-        RETRIEVE_BUFFER = 500
-        # We perform a call this way we run through each element:
+        mongo_query = QUERY_PARSER.to_mongo_query(query, **parameters)
+        sort = self._query_sort(sort) if sort is not None else None
+        self._advise(mongo_query, sort)
+        skip = skip or 0
+
+        if count_only and len(mongo_query) == 0 and not skip and not limit:
+            yield len(self)
+            return
+
+        if count_only:
+            projection = {'key': 1}
+        else:
+            projection = self._query_projection(fields) or {'_id': 1, 'key': 1, 'value': 1}
 
-        m = MongoQueryParser()
-        mongo_query = m.transform_request(query)
-        mongo_query_for_removed = {'___removed': 1}
-        mongo_query_for_edited_added = {'$and': [mongo_query, {'___removed': None}]}
+        if sort is None or (count_only and not skip and not limit):
+            documents = self._find_documents(projection, mongo_query=mongo_query)
+        else:
+            chunk_size = min(ITERATION_CHUNK_SIZE, skip + limit) if limit else ITERATION_CHUNK_SIZE
+            documents = self._sorted_documents(projection, sort, chunk_size, mongo_query=mongo_query)
 
-        mongo_cursor_removed = self._instance.find(mongo_query_for_removed, {'key': 1, '_id': 0})
-        mongo_cursor_edited = self._instance.find(mongo_query_for_edited_added)
+        if skip or limit:
+            documents = islice(documents, skip, skip + limit if limit else None)
 
         if count_only:
-            yield max(0, self._fork_father(query, count_only=True) - mongo_cursor_removed.count()) + mongo_cursor_edited.count()
+            yield sum(1 for _ in documents)
         else:
+            for result in documents:
+                yield result['key'], result.get('value'), result['_id']
+
+    def _sorted_documents(self, projection: dict, sort: list, chunk_size: int, mongo_query: dict=None):
+        """
+        Iterates over the visible documents of the fork, ordered by the given sort. Each layer is read sorted by the
+        backend in chunks, whose keys are looked up in the upper layers to skip the hidden ones, and the layers are
+        merged. Hence, documents are only read up to the point that the iteration reaches.
+        :param sort: list of (field, direction) pairs.
+        :param chunk_size: number of documents of a layer read and looked up at once.
+        """
+        layers = self._layers()
+        query = {'$and': [mongo_query, {'___removed': None}]} if mongo_query else {'___removed': None}
+        fields = dict({'_id': 0}, **projection)
+        fields['key'] = 1
+
+        # Sort fields that were not requested are retrieved for the merge, and removed afterwards
+        extra_fields = [field for field, _ in sort if not any(fields.get(prefix) == 1 for prefix in
+                                                              self._field_prefixes(field))]
+        fields.update({field: 1 for field in extra_fields})
+        sort_key = document_sort_key(sort)
+
+        def layer_entries(index):
+            cursor = layers[index]._instance.find(query, fields).sort(sort).batch_size(chunk_size)
+
+            for chunk in self._chunks(cursor, chunk_size):
+                hidden_keys = self._keys_in_layers(layers[:index], [document['key'] for document in chunk])
+
+                for document in chunk:
+                    if bson_identity(document['key']) not in hidden_keys:
+                        yield sort_key(document), index, document
+
+        for _, _, document in merge(*[layer_entries(index) for index in range(len(layers))], key=itemgetter(0, 1)):
+            for field in extra_fields:
+                self._remove_field(document, field)
+
+            yield document
+
+    @staticmethod
+    def _field_prefixes(field: str):
+        names = field.split(".")
+        return [".".join(names[:length]) for length in range(1, len(names) + 1)]
 
-            mongo_used = set()
+    @staticmethod
+    def _remove_field(document: dict, field: str):
+        """
+        Removes a dotted field from a document, and the embedded documents that become empty by it.
+        """
+        names = field.split(".")
+        parents = [document]
+
+        for name in names[:-1]:
+            child = parents[-1].get(name)
 
-            # First we yield the edited and added
-            for result in mongo_cursor_edited:
-                mongo_used.add(result['key'])
-                yield result['key'], result['value'], result['_id']
+            if type(child) is not dict:
+                return
 
-                # Meanwhile we get RETRIEVE_BUFFER of removed elements
-                for index, removed in zip(range(RETRIEVE_BUFFER), mongo_cursor_removed):
-                    mongo_used.add(removed['key'])
+            parents.append(child)
 
-            # Let's add the rest of the removed elements (if any yet) to the set
-            for removed in mongo_cursor_removed:
-                mongo_used.add(removed['key'])
+        parents[-1].pop(names[-1], None)
 
-            # Then we yield from the father's if it is not in the used list,
-            mongo_cursor = self._fork_father(query)
+        for parent, name in zip(reversed(parents[:-1]), reversed(names[:-1])):
+            if len(parent[name]) > 0:
+                break
 
-            for key, value, _id in mongo_cursor:
-                if key not in mongo_used:
-                    yield key, value, _id
+            del parent[name]
 
 
 class BulkMongoDict(MongoDict):
     """
     Dictionary that allows bulk operations on a mongo dictionary.
+
+    In write-behind mode, full buffers are handed to a background thread that writes them in order, while the
+    producer keeps filling the next buffer. At most max_in_flight buffers wait to be written; when there are more, the
+    producer is blocked until one of them is written. Errors of the background writes are raised on the next operation
+    or on commit().
+
+    In adaptive mode (when target_bytes or target_latency are set), the buffer size is tuned after each commit from the
+    encoded size of the operations and the time that the commit took.
     """
     def __init__(self, original_dict_id: str=None, mongo_host: str="localhost", mongo_port: int=27017,
                  mongo_database: str="mongo_dicts", credentials: tuple=None, buffer_size: int=100,
-                 version: int=None, do_upserts: bool=True):
+                 version: int=None, do_upserts: bool=True, cache: LRUCache=None, write_behind: bool=False,
+                 max_in_flight: int=2, target_bytes: int=None, target_latency: float=None,
+                 length_tracker: MongoDict=None):
+        """
+        :param length_tracker: dict whose length counter is updated with the writes of this bulk.
+        """
         MongoDict.__init__(self, original_dict_id=original_dict_id, mongo_host=mongo_host,
                            mongo_port=mongo_port, mongo_database=mongo_database, credentials=credentials,
-                           version=version, allow_morph=False, immutable_version=True)
+                           version=version, allow_morph=False, immutable_version=True, cache=cache)
         self._buffer_size = buffer_size
         self._operations = []
+        self._operation_keys = []
+        self._operation_documents = []
+        self._operations_bytes = 0
         self.do_upserts = do_upserts
 
+        self._target_bytes = target_bytes
+        self._target_latency = target_latency
+        self._length_tracker = length_tracker
+        self._commits = deque(maxlen=BULK_COMMIT_HISTORY_SIZE)
+
+        self._write_behind = write_behind
+        self._in_flight = Queue(maxsize=max_in_flight) if write_behind else None
+        self._writer = None
+        self._writer_error = None
+
     def __setitem__(self, key, value):
 
-        if self.do_upserts:
-            operation = UpdateOne({"key": key}, {"$set": {"value": value}}, upsert=True)
+        document = {"key": key, "value": value}
+
+        if self.do_upserts == "auto":
+            operation = ReplaceOne({"key": key}, document, upsert=True)
+        elif self.do_upserts:
+            # A previous removal in a fork must not survive the new value
+            operation = UpdateOne({"key": key}, {"$set": {"value": value}, "$unset": {"___removed": ""}}, upsert=True)
         else:
-            operation = InsertOne({"key": key, "value": value})
+            operation = InsertOne(document)
+
+        self._append(operation, key, document)
+
+    def __delitem__(self, key):
+        self._append(DeleteOne({"key": key}), key)
+
+    def _append(self, operation, key, document:dict=None):
+        """
+        Buffers an operation, flushing the buffer if it is full.
+        :param operation: pymongo write operation.
+        :param key: key of the dictionary affected by the operation.
+        :param document: document written by the operation, to account its size. None if it only carries the key.
+        """
+        self._raise_writer_error()
 
         self._operations.append(operation)
+        self._operation_keys.append(key)
+        self._operation_documents.append(document)
 
-        if len(self._operations) > self._buffer_size:
-            self.commit()
+        # Encoding is only paid for when the sizes are going to be used
+        if self._target_bytes is not None:
+            self._operations_bytes += len(bson.BSON.encode(document if document is not None else {"key": key}))
 
-    def __delitem__(self, key):
-        self._operations.append(
-            DeleteOne({"key": key})
-        )
+        if len(self._operations) > self._buffer_size or \
+                (self._target_bytes is not None and self._operations_bytes >= self._target_bytes):
+            self._flush()
 
-        if len(self._operations) > self._buffer_size:
+    def _flush(self):
+        if not self._write_behind:
             self.commit()
+            return
+
+        if self._writer is None:
+            self._writer = Thread(target=self._write_behind_loop, daemon=True)
+            self._writer.start()
+
+        # Blocks while there are max_in_flight buffers waiting to be written
+        self._in_flight.put((self._operations, self._operation_keys, self._operation_documents,
+                             self._operations_bytes))
+        self._operations = []
+        self._operation_keys = []
+        self._operation_documents = []
+        self._operations_bytes = 0
+
+    def _write_behind_loop(self):
+        while True:
+            batch = self._in_flight.get()
 
-    def commit(self):
-        if len(self._operations) > 0:
             try:
-                self._instance.bulk_write(self._operations, ordered=False)
-                self._operations = []
-                self._on_modified_callback()
-            except BulkWriteError as ex:
-                print("Could not write the bulk operations: {}".format(ex.details))
+                if batch is None:
+                    return
+
+                # Once a write fails, the rest are discarded until the error is raised to the producer
+                if self._writer_error is None:
+                    self._write(*batch)
+
+            except Exception as ex:
+                self._writer_error = ex
+
+            finally:
+                self._in_flight.task_done()
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            error = self._writer_error
+            self._writer_error = None
+            raise error
+
+    def _write(self, operations:list, operation_keys:list, operation_documents:list, operations_bytes:int):
+        delta = None
+
+        if self._length_tracker is not None:
+            delta = self._length_tracker._length_delta(
+                [(key, document is not None and '___removed' not in document)
+                 for key, document in zip(operation_keys, operation_documents)])
+
+        try:
+            start = monotonic()
+
+            if self.do_upserts == "auto":
+                self._write_auto(operations, operation_keys, operation_documents)
+            else:
+                # Unordered bulks group the operations by type, so several operations over a key could be reordered
+                self._instance.bulk_write([operations[index] for index in self._latest_indexes(operation_keys)],
+                                          ordered=False)
+
+            elapsed = monotonic() - start
+
+            self._commits.append({'operations': len(operations), 'bytes': operations_bytes, 'seconds': elapsed,
+                                  'buffer_size': self._buffer_size})
+            self._tune_buffer_size(len(operations), operations_bytes, elapsed)
+            self._on_modified_callback()
+
+            if self._length_tracker is not None:
+                self._length_tracker._add_length(delta)
+        except BulkWriteError:
+            # Part of the operations might have been written, so the length counter cannot be trusted anymore
+            if self._length_tracker is not None:
+                self._length_tracker._forget_length()
+
+            raise
+        finally:
+            # Even a failed bulk might have written part of the operations
+            for key in operation_keys:
+                self._cache_invalidate(key)
+
+    @staticmethod
+    def _latest_indexes(operation_keys:list):
+        """
+        Retrieves the positions of the last operation of each key. Last write wins, so the rest can be discarded.
+        """
+        latest = {}
+        for index, key in enumerate(operation_keys):
+            latest[bson_identity(key)] = index
+
+        return sorted(latest.values())
+
+    def _write_auto(self, operations:list, operation_keys:list, operation_documents:list):
+        """
+        Writes a buffer inserting the documents whose keys do not exist yet, instead of upserting them.
+        """
+        indexes = self._latest_indexes(operation_keys)
+        written_keys = [operation_keys[index] for index in indexes if operation_documents[index] is not None]
+        existing_keys = set()
+
+        if len(written_keys) > 0:
+            for document in self._instance.find({'key': {'$in': written_keys}}, {'_id': 0, 'key': 1}):
+                existing_keys.add(bson_identity(document['key']))
+
+        operations = [InsertOne(operation_documents[index])
+                      if operation_documents[index] is not None and
+                      bson_identity(operation_keys[index]) not in existing_keys
+                      else operations[index] for index in indexes]
+
+        try:
+            self._instance.bulk_write(operations, ordered=False)
+        except BulkWriteError as ex:
+            # Keys inserted by others since they were looked up are retried as replacements
+            retries = []
+
+            for error in ex.details['writeErrors']:
+                index = indexes[error['index']]
+
+                if error['code'] == 11000 and type(operations[error['index']]) is InsertOne:
+                    # The failed insert assigned an _id to the document, which cannot replace the existing one
+                    document = {k: v for k, v in operation_documents[index].items() if k != '_id'}
+                    retries.append(ReplaceOne({'key': operation_keys[index]}, document, upsert=True))
+
+            if len(retries) < len(ex.details['writeErrors']):
                 raise
 
+            self._instance.bulk_write(retries, ordered=False)
+
+    def _tune_buffer_size(self, operations:int, operations_bytes:int, elapsed:float):
+        """
+        Moves the buffer size towards the number of operations that fits in the target bytes and target latency, as
+        measured in the last commit.
+        """
+        targets = []
+
+        if self._target_bytes is not None and operations_bytes > 0:
+            targets.append(self._target_bytes * operations / operations_bytes)
+
+        if self._target_latency is not None and elapsed > 0:
+            targets.append(self._target_latency * operations / elapsed)
+
+        if len(targets) == 0:
+            return
+
+        # Only halfway, so that a single slow commit does not collapse the buffer
+        buffer_size = (self._buffer_size + min(targets)) / 2
+        self._buffer_size = int(min(MAX_ADAPTIVE_BUFFER_SIZE, max(1, buffer_size)))
+
+    def stats(self):
+        """
+        Retrieves the buffer size in use and the timings of the last commits, useful to size the buffers.
+        :return: dict with the current buffer size and a list with the operations, bytes (0 if they are not
+        accounted), seconds and buffer size of each commit.
+        """
+        return {'buffer_size': self._buffer_size, 'commits': list(self._commits)}
+
+    def commit(self):
+        """
+        Writes the buffered operations. In write-behind mode, it waits for the buffers in flight to be written first,
+        and raises the error of any of them.
+        """
+        if self._writer is not None:
+            self._in_flight.join()
+
+        self._raise_writer_error()
+
+        if len(self._operations) > 0:
+            self._write(self._operations, self._operation_keys, self._operation_documents, self._operations_bytes)
+            self._operations = []
+            self._operation_keys = []
+            self._operation_documents = []
+            self._operations_bytes = 0
+
+    def close(self):
+        """
+        Stops the background writer, if any, once the buffers in flight are written.
+        """
+        if self._writer is not None:
+            self._in_flight.put(None)
+            self._writer.join()
+            self._writer = None
+
 
 class BulkMongoDictForked(BulkMongoDict):
 
     def __delitem__(self, key):
-        self._operations.append(
-            UpdateOne({"key": key}, {"$set": {"value": None, "___removed": 1}}, upsert=True)
-        )
+        document = {"key": key, "value": None, "___removed": 1}
 
-        if len(self._operations) > self._buffer_size:
-            self.commit()
+        if self.do_upserts == "auto":
+            operation = ReplaceOne({"key": key}, document, upsert=True)
+        else:
+            operation = UpdateOne({"key": key}, {"$set": {"value": None, "___removed": 1}}, upsert=True)
+
+        self._append(operation, key, document)
+
+
+class ParallelBulkMongoDict:
+    """
+    Bulk that partitions the operations by the hash of their key among several write-behind bulks.
+    """
+    def __init__(self, bulks: list):
+        self._bulks = bulks
+
+    def stats(self):
+        """
+        Retrieves the buffer size in use and the timings of the last commits of each worker.
+        :return: list with the stats of the bulk of each worker, as retrieved by BulkMongoDict.stats().
+        """
+        return [bulk.stats() for bulk in self._bulks]
+
+    def _bulk_for(self, key):
+        return self._bulks[hash(bson_identity(key)) % len(self._bulks)]
+
+    def __setitem__(self, key, value):
+        self._bulk_for(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._bulk_for(key)[key]
+
+    def commit(self):
+        """
+        Writes the buffered operations of every worker, and waits for them to finish. Raises the first error found.
+        """
+        # Remaining operations are handed to the workers first, so they are written in parallel too
+        for bulk in self._bulks:
+            if len(bulk._operations) > 0:
+                bulk._flush()
+
+        errors = []
+        for bulk in self._bulks:
+            try:
+                bulk.commit()
+            except Exception as ex:
+                errors.append(ex)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def close(self):
+        for bulk in self._bulks:
+            bulk.close()
+
+
+class ScanPartition:
+    """
+    Partition of a dictionary made by split_scan(). Iterating over it yields the (key, value) pairs of the partition.
+    """
+    def __init__(self, dictionary: BasicMongoDict, bounds: dict, page_size: int=SCAN_PAGE_SIZE):
+        self._dict_class = MongoDict if isinstance(dictionary, MongoDict) else BasicMongoDict
+        self._original_dict_id = dictionary._original_dict_id
+        self._mongo_host = dictionary._mongo_host
+        self._mongo_port = dictionary._mongo_port
+        self._mongo_database = dictionary._mongo_database
+        self._credentials = dictionary._credentials
+        self._version = getattr(dictionary, '_version', None)
+        self._bounds = bounds
+        self._page_size = page_size
+
+    def _get_dict(self):
+        kwargs = dict(mongo_host=self._mongo_host, mongo_port=self._mongo_port, mongo_database=self._mongo_database,
+                      credentials=self._credentials)
+
+        if self._dict_class is MongoDict:
+            # Same version that was split, even if new ones have been created since then
+            kwargs.update(version=self._version, immutable_version=True)
+
+        return self._dict_class(self._original_dict_id, **kwargs)
+
+    def __iter__(self):
+        for page, _ in self._get_dict()._scan_pages(self._page_size, bounds=self._bounds):
+            yield from page
 
 
 class DictDropper:
@@ -846,33 +2573,87 @@ class DictDropper:
         self._mongo_database = mongo_database
         self._credentials = credentials
 
+    def _get_dict_meta(self):
+        return BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
+                              mongo_port=self._mongo_port, mongo_database=self._mongo_database,
+                              credentials=self._credentials)
+
     def drop_dict(self, dict_id, remove_all_versions=True):
-        dict_meta = BasicMongoDict(original_dict_id=___MONGO_DICT_META___, mongo_host=self._mongo_host,
-                                   mongo_port=self._mongo_port,
-                                   mongo_database=self._mongo_database, credentials=self._credentials)
+        dict_meta = self._get_dict_meta()
 
         metadata = dict_meta[dict_id]
 
         versions = metadata['version']
 
         if remove_all_versions:
-            for version in versions:
-                BasicMongoDict(original_dict_id="{}v{}".format(dict_id, version), mongo_host=self._mongo_host,
-                               mongo_port=self._mongo_port, mongo_database=self._mongo_database,
-                               credentials=self._credentials)._drop()
-
-            BasicMongoDict(original_dict_id=dict_id, mongo_host=self._mongo_host,
-                           mongo_port=self._mongo_port,
-                           mongo_database=self._mongo_database, credentials=self._credentials)._drop()
+            # Dropped without building a dict over them, since they might not have a key index yet
+            for version in [0] + versions:
+                collection = self._get_collection(dict_id, version)
+                collection.drop()
+                CLIENT_POOL.forget_key_index(collection)
+
             del dict_meta[dict_id]
         else:
             MongoDict(original_dict_id=dict_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
                       mongo_database=self._mongo_database, credentials=self._credentials)._drop()
 
             if len(metadata['version']) > 0:
-                metadata['version'] = metadata['version'][:-1]
-                dict_meta[dict_id] = metadata
+                dict_meta._instance.update_one({'key': dict_id},
+                                               {'$pull': {'value.base_versions': metadata['version'][-1]},
+                                                '$pop': {'value.version': 1}})
             else:
                 del dict_meta[dict_id]
 
         return len(versions) + 1
+
+    def _get_collection(self, dict_id, version):
+        client = CLIENT_POOL.get_client(self._mongo_host, self._mongo_port, self._mongo_database, self._credentials)
+        return client[self._mongo_database][dict_id + ("v{}".format(version) if version > 0 else "")]
+
+    def migrate_key_index(self, dict_id, remove_duplicates=False):
+        """
+        Builds the unique index over the keys of every version of a dictionary, replacing the text index of older
+        versions of pymdict. Dictionaries build it when they are loaded, but it cannot be built while a collection
+        holds duplicated keys (bulks without upserts could insert them): an exception is raised then.
+
+        :param dict_id: ID of the dictionary to migrate.
+        :param remove_duplicates: if set, only the last document written of each duplicated key is kept, and the rest
+                    are removed. Otherwise, collections with duplicated keys raise an exception.
+        :return: number of documents removed.
+        """
+        removed = 0
+
+        for version in [0] + self._get_dict_meta()[dict_id]['version']:
+            collection = self._get_collection(dict_id, version)
+            CLIENT_POOL.forget_key_index(collection)
+
+            if remove_duplicates:
+                removed += CLIENT_POOL.remove_duplicated_keys(collection)
+
+            CLIENT_POOL.ensure_key_index(collection)
+
+        return removed
+
+    def compact_dict(self, dict_id, drop_previous_versions=False, progress_callback=None):
+        """
+        Compacts the latest version of a dictionary into a single collection. See MongoDict.compact().
+
+        :param dict_id: ID of the dictionary to compact.
+        :param drop_previous_versions: if set, the collections of the versions previous to the compacted one are
+                    removed. Forks pointing to those versions will lose their content!
+        :param progress_callback: optional function called as progress_callback(done, total) each time a step of the
+                    compaction is finished.
+        :return: the compacted dictionary.
+        """
+        compacted = MongoDict(original_dict_id=dict_id, mongo_host=self._mongo_host, mongo_port=self._mongo_port,
+                              mongo_database=self._mongo_database, credentials=self._credentials)
+        compacted.compact(progress_callback=progress_callback)
+
+        if drop_previous_versions:
+            for version in [0] + self._get_dict_meta()[dict_id]['version']:
+                if version < compacted._version:
+                    BasicMongoDict(original_dict_id=dict_id + ("v{}".format(version) if version > 0 else ""),
+                                   mongo_host=self._mongo_host, mongo_port=self._mongo_port,
+                                   mongo_database=self._mongo_database, credentials=self._credentials)._drop()
+
+        return compacted
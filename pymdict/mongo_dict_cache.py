@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from time import monotonic
+
+import bson
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with least-recently-used eviction.
+
+    It can be attached to a MongoDict (or a ForkedMongoDict) to serve the reads of hot keys without going to the
+    backend:
+
+        >>> cache = LRUCache(max_entries=10000, ttl=60)
+        >>> dictionary = MongoDict("my_dict", cache=cache)
+        >>> dictionary['k1']    # Goes to the backend
+        >>> dictionary['k1']    # Served by the cache
+        >>> cache.stats()
+        {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 0}
+
+    The cache is thread-safe and it can be shared between several dictionaries, since the entries are keyed by
+    (collection, version, key). Values are copied on the way in and out, so modifying a returned value does not
+    modify the cached one.
+    """
+
+    def __init__(self, max_entries:int=10000, max_bytes:int=None, ttl:float=None):
+        """
+        :param max_entries: maximum number of entries to keep.
+        :param max_bytes: maximum size of the cached values, measured as their BSON encoded size. None for no limit.
+        :param ttl: seconds that an entry is valid since it was cached. None for no expiration.
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Retrieves an entry from the cache.
+        :param key: key of the entry.
+        :return: tuple (found, value). If not found, value is None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and self._ttl is not None and entry[2] < monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return True, deepcopy(entry[0])
+
+    def put(self, key, value):
+        """
+        Stores an entry in the cache, evicting the least recently used entries if the cache is full.
+        :param key: key of the entry.
+        :param value: value to store.
+        """
+        size = len(bson.BSON.encode({'value': value})) if self._max_bytes is not None else 0
+
+        if self._max_bytes is not None and size > self._max_bytes:
+            self.invalidate(key)
+            return
+
+        expiration = monotonic() + self._ttl if self._ttl is not None else None
+        value = deepcopy(value)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size, expiration)
+            self._bytes += size
+
+            while len(self._entries) > self._max_entries or \
+                    (self._max_bytes is not None and self._bytes > self._max_bytes):
+                evicted_key = next(iter(self._entries))
+                self._remove(evicted_key)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes an entry from the cache, if present.
+        :param key: key of the entry.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """
+        Removes every entry from the cache. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Retrieves the counters of the cache, useful to size it.
+        :return: dict with the hits, misses, evictions, number of entries and bytes in use.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def __len__(self):
+        return len(self._entries)
@@ -23,7 +23,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+
 import re
+from copy import deepcopy
+
+from pymdict.mongo_dict_cache import LRUCache
+
+# Number of compiled queries kept by a parser, so that repeated query strings are not parsed again.
+QUERY_CACHE_SIZE = 1000
+
+COMPARISON_OPERATORS = [">", "<", "=", "!=", ">=", "<=", "eq", "!eq", "in", "%", "!%"]
+SORT_DIRECTIONS = {"asc": 1, "desc": -1}
+QUOTES = "'\""
+ESCAPE_CHAR = '\\'
+
+_WORD = re.compile(r"\S+")
+_LIST_ITEM = re.compile(r"[^,\]]*")
+_PARAMETER = re.compile(r":([A-Za-z_]\w*)$")
 
 
 class MongoQueryParser():
@@ -31,9 +47,11 @@ class MongoQueryParser():
     Allows to process a string query and to convert it into a mongo query.
     """
 
-    def __init__(self):
-        pass
-
+    def __init__(self, cache_size:int=QUERY_CACHE_SIZE):
+        """
+        :param cache_size: number of compiled queries to keep, keyed by the query string. 0 disables the cache.
+        """
+        self._cache = LRUCache(max_entries=cache_size) if cache_size > 0 else None
 
     def transform_request(self, str_query:str):
         """
@@ -77,178 +95,98 @@ class MongoQueryParser():
             or               To join two conditions in OR
             and              To join two conditions in AND
 
+        "and" takes precedence over "or". Texts with spaces can be enclosed in single or double quotes.
+
         :return: JSON query for a MongoDB
         """
-        if str_query == "":
-            return {}
+        if self._cache is None:
+            return _QueryCompiler(str_query).compile()
+
+        found, mongo = self._cache.get(str_query)
 
-        splits = self._do_split(str_query, open_splits=["(", "[", "'"], close_splits=[")", "]", "'"],
-                                special_separators="[")
-        ops = self._retrieve_ops_tree(splits, open_splits=["(", "[", "'"], close_splits=[")", "[", "'"])
-        mongo = self._to_mongo_query_dict(ops)
+        if not found:
+            mongo = _QueryCompiler(str_query).compile()
+            self._cache.put(str_query, mongo)
 
         return mongo
 
-    @staticmethod
-    def _do_split(text:str, separator:str=" ", open_splits:list=None, close_splits:list=None, special_separators:list=None):
+    def prepare(self, str_query:str):
         """
-        Splits a text into chunks. Same functionality as string.split() but it allows to split text in a more complex
-        way.
+        Compiles a query with parameters, so that it can be performed many times with different values without being
+        parsed again. Parameters are written as :name in place of the values:
 
+            >>> prepared = parser.prepare("value.tenant eq :t and value.ts > :since")
+            >>> prepared.bind(t="acme", since=123)
+            {'$and': [{'value.tenant': {'$eq': 'acme'}}, {'value.ts': {'$gt': 123.0}}]}
 
-        :param text: text to split
-        :param separator: separator to use. For example, a " " will split the text in chunks separated by spaces.
-        :param open_splits:  If a more complex separation is required, for example those between brackets, then here
-        it can be specified the open token
-        :param close_splits:
-        :param special_separators:
-        :return:
+        :param str_query: String containing the query, with the same syntax as transform_request().
+        :return: PreparedQuery instance.
         """
+        return PreparedQuery(str_query, _QueryCompiler(str_query, parameters=True).compile())
 
-        if open_splits is None:
-            open_splits = []
-
-        if close_splits is None:
-            close_splits = []
-
-        if special_separators is None:
-            special_separators = []
-
-        segments = []
-        segment = ""
-
-        l_2 = ""
-        index = 0
-
-        while index < len(text):
-            l_1 = l_2
-            l_2 = text[index]
-
-            if l_2 in open_splits and (l_1 == '' or l_1 == separator or separator == ""):
-                open_split_index = open_splits.index(l_2)
-
-                segment = MongoQueryParser._do_encapsulated_split(text[index:], sep_init=l_2, sep_end=close_splits[open_split_index], include_separators=l_2 in special_separators)
-                segments.append(segment)
-                index += len(segment) + 2
-                segment = ""
-            elif l_2 == separator:
-                segments.append(segment)
-                segment = ""
-            else:
-                segment += l_2
-
-            index += 1
-
-        if len(segment) > 0:
-            segments.append(segment)
-
-        return segments
-
-    @staticmethod
-    def _do_encapsulated_split(text:str, sep_init="(", sep_end=")", include_separators=False):
+    def to_mongo_query(self, query, **parameters):
         """
-        Splits by text between tokens.
-        :param text: text to split
-        :param sep_init: token that specifies the start of the segment
-        :param sep_end: token that specifies the end of the segment
-        :param include_separators: boolean flag that specifies if the token separators should be included in the
-        segment or not.
-        :return: split segments
-        """
-        segment = ""
-        open = False
-        ESCAPE_CHAR = '\\'
-        previous = ""
-        for index, l in enumerate(text):
-
-            if l == sep_init and not open and previous != ESCAPE_CHAR:
-                open = True
+        Transforms a string query or a prepared query in a mongo query.
 
-            elif l == sep_end and previous != ESCAPE_CHAR:
-                break
-
-            elif open:
-                segment += l
-            previous = l
-
-        return segment if not include_separators else sep_init + segment + sep_end
-
-
-    def _retrieve_ops2_tree(splits:list):
-        """
-        Retrieves the ops tree for second level operations.
-        :return:
+        :param query: string query, or PreparedQuery instance returned by prepare().
+        :param parameters: values for the parameters of the prepared query.
+        :return: JSON query for a MongoDB
         """
-        first_level_operators = [">", "<", "=", "!=", ">=", "<=", "eq", "!eq", "in", "%", "!%"]
-
-        # splits should be a 3 elements list : operand1 operator operand2
-        if len(splits) < 3:
-            raise Exception("Invalid syntax on {}".format(" ".join(splits)))
+        if type(query) is PreparedQuery:
+            return query.bind(**parameters)
 
-        operator = splits[1]
-        if operator not in first_level_operators:
-            raise Exception("Invalid operator on {}".format(" ".join(splits)))
+        if len(parameters) > 0:
+            raise Exception("Parameters {} can only be bound to prepared queries".format(sorted(parameters)))
 
-        previous_oper = splits[0:1]
-        next_oper = splits[2:]
-        return [operator, previous_oper, next_oper]
+        return self.transform_request(query)
 
     @staticmethod
-    def _retrieve_ops_tree(splits:list, open_splits:list=None, close_splits:list=None):
+    def transform_sort(sort):
         """
-        Retrieves the ops tree from a split query.
-        :param splits: split segments from the query.
-        :param open_splits: token that specifies the open of the splits, forwarded to the 'do_split' function.
-        :param close_splits: token that specifies the close of the splits, forwarded to the 'do_split' function.
-        :return:
-        """
-        second_level_operators = ["and", "or"]
-
-        operators = {operator: [] for operator in second_level_operators+ [None]}
+        Transforms a sort specification in a mongo sort.
 
-        previous_index = 0
-        last_operand = None
+        :param sort: string with comma separated fields, each one optionally followed by "asc" or "desc" (ascending
+        by default). For example: "value.ts desc, key". A list of (field, direction) pairs is accepted as well, with
+        direction being 1 or -1.
+        :return: list of (field, direction) pairs, with direction 1 for ascending and -1 for descending.
+        """
+        if type(sort) is not str:
+            result = [(field, direction) for field, direction in sort]
 
-        for index, operand in enumerate(splits):
-            if operand in operators:
-                last_operand = operand
-                previous_oper = splits[previous_index:index]
+            if any(direction not in SORT_DIRECTIONS.values() for _, direction in result):
+                raise Exception("Invalid sort on {}".format(sort))
 
-                if len(previous_oper) > 1:
-                    previous_oper = MongoQueryParser._retrieve_ops2_tree(previous_oper)
+            return result
 
-                elif len(previous_oper) == 1 and previous_oper[0][0] != "[":
-                        previous_oper = MongoQueryParser._retrieve_ops_tree(MongoQueryParser._do_split(previous_oper[0].strip(), open_splits=open_splits, close_splits=close_splits))
+        result = []
 
-                operators[operand].append(previous_oper)
-                previous_index = index + 1
+        for field_sort in sort.split(","):
+            words = field_sort.split()
 
-        if previous_index < index + 1:
-            previous_oper = splits[previous_index:]
+            if len(words) == 0 or len(words) > 2 or (len(words) == 2 and words[1].lower() not in SORT_DIRECTIONS):
+                raise Exception("Invalid sort on {}".format(sort))
 
-            if len(previous_oper) > 1:
-                previous_oper = MongoQueryParser._retrieve_ops2_tree(previous_oper)
-            else:
-                previous_oper = MongoQueryParser._retrieve_ops_tree(MongoQueryParser._do_split(previous_oper[0], open_splits=open_splits, close_splits=close_splits))
+            result.append((words[0], SORT_DIRECTIONS[words[1].lower()] if len(words) == 2 else 1))
 
-            operators[last_operand].append(previous_oper)
+        return result
 
-        return operators
+    def cache_stats(self):
+        """
+        Retrieves the counters of the cache of compiled queries.
+        :return: dict with the hits, misses, evictions, number of entries and bytes in use. None if there is no cache.
+        """
+        return self._cache.stats() if self._cache is not None else None
 
     @staticmethod
-    def _to_mongo_query_list(ops_list:list):
+    def _to_mongo_condition(operation:str, operand1:str, operand2):
         """
-        Converts a list of operations into a Mongo query.
-        This method is recursively called by the method _to_mongo_query_dict() if it finds any
+        Converts a single comparison into a Mongo query.
 
-        :param ops_list: list of mongo operations to convert.
+        :param operation: comparison operator.
+        :param operand1: field to compare.
+        :param operand2: text to compare the field with, or list of values for the "in" operator.
         :return: Mongo query.
         """
-
-        [operation, operand1, operand2] = ops_list
-        operand1 = operand1[0]
-        operand2 = operand2[0]
-
         result = {}
 
         if operation == "eq":
@@ -272,61 +210,315 @@ class MongoQueryParser():
         elif operation == "!%":
             result[operand1] = {"$not": re.compile(operand2)}
         elif operation == "in":
-            splits = MongoQueryParser._do_split(operand2[1:-1], separator="", open_splits=["'"], close_splits=["'"])
-            if len(splits) == 1:
-                try:
-                    splits = [float(x) for x in MongoQueryParser._do_split(operand2[1:-1], separator=",")]
-                except:
-                    pass
+            result[operand1] = {"$in": list(operand2)}
+
+        return result
+
+
+class PreparedQuery():
+    """
+    Query compiled once by MongoQueryParser.prepare(). Binding the values of its parameters copies the filter template
+    with the values in place, so the query is not parsed again. Values are converted as if they were written in the
+    query: for example, bound values of numeric comparisons are converted to float, and values of "in" must be lists.
+    Bound values are always compared as values, so a dict like {'$ne': None} cannot inject an operator in the query.
+    """
+
+    def __init__(self, query:str, template):
+        """
+        :param query: query string that was compiled.
+        :param template: Mongo query with _Parameter conditions in place of the parameterized conditions.
+        """
+        self.query = query
+        self._template = template
+        self.parameters = frozenset(self._parameter_names(template))
+
+    @staticmethod
+    def _parameter_names(node):
+        if type(node) is _Parameter:
+            yield node.name
+        elif type(node) is _Group:
+            for child in node.terms:
+                yield from PreparedQuery._parameter_names(child)
+
+    def bind(self, **parameters):
+        """
+        Builds the mongo query with the given values for the parameters.
+        :param parameters: values for every parameter of the query, by name. Values of "in" must be lists, tuples or
+                    sets; otherwise, ValueError is raised.
+        :return: JSON query for a MongoDB
+        """
+        if parameters.keys() != self.parameters:
+            raise Exception("Query {} expects the parameters {}, but {} were given".format(
+                self.query, sorted(self.parameters), sorted(parameters)))
+
+        return self._bind(self._template, parameters)
+
+    @staticmethod
+    def _bind(node, parameters):
+        if type(node) is _Parameter:
+            value = parameters[node.name]
+
+            # Any other iterable, like a string, would be silently turned into a list of its items
+            if node.operation == "in" and type(value) not in (list, tuple, set):
+                raise ValueError("Parameter {} of the \"in\" operator must be a list, tuple or set, not {}".format(
+                    node.name, type(value).__name__))
+
+            # A bound dict like {'$ne': None} must be compared as a value, not read as an operator
+            if node.operation == "eq":
+                return {node.field: {"$eq": value}}
+
+            return MongoQueryParser._to_mongo_condition(node.operation, node.field, value)
+
+        if type(node) is _Group:
+            return {node.operator: [PreparedQuery._bind(child, parameters) for child in node.terms]}
+
+        return deepcopy(node)
+
+    def __repr__(self):
+        return "PreparedQuery({!r})".format(self.query)
+
+
+class _Parameter():
+    """
+    Condition of a prepared query whose value is bound later.
+    """
+
+    def __init__(self, operation:str, field:str, name:str):
+        self.operation = operation
+        self.field = field
+        self.name = name
 
-            result[operand1] = {"$in": splits}
+
+class _Group():
+    """
+    Conditions of a prepared query joined by $and or $or, some of them with parameters.
+    """
+
+    def __init__(self, operator:str, terms:list):
+        self.operator = operator
+        self.terms = terms
+
+
+class _QueryCompiler():
+    """
+    Recursive descent parser of a single query string. It reads the text once, from left to right:
+
+        query      := and_query ("or" and_query)*
+        and_query  := term ("and" term)*
+        term       := "(" query ")" | field operator operand
+    """
+
+    def __init__(self, text:str, parameters:bool=False):
+        """
+        :param text: query string to compile.
+        :param parameters: whether :name operands are parameters. If so, the conditions and groups with parameters
+        are compiled to _Parameter and _Group instances.
+        """
+        self._text = text
+        self._length = len(text)
+        self._position = 0
+        self._depth = 0
+        self._parameters = parameters
+
+    def compile(self):
+        self._skip_spaces()
+
+        if self._position == self._length:
+            return {}
+
+        result = self._parse_or()
+        self._skip_spaces()
+
+        if self._position < self._length:
+            raise Exception("Invalid syntax on {}".format(self._text[self._position:]))
 
         return result
 
+    def _syntax_error(self):
+        return Exception("Invalid syntax on {}".format(self._text))
+
+    def _skip_spaces(self):
+        while self._position < self._length and self._text[self._position].isspace():
+            self._position += 1
+
+    def _accept_keyword(self, keyword:str):
+        self._skip_spaces()
+        end = self._position + len(keyword)
+
+        if self._text.startswith(keyword, self._position) and \
+                (end == self._length or self._text[end].isspace() or self._text[end] == "("):
+            self._position = end
+            return True
+
+        return False
+
+    def _parse_or(self):
+        terms = [self._parse_and()]
+
+        while self._accept_keyword("or"):
+            terms.append(self._parse_and())
+
+        return self._join("$or", terms)
+
+    def _parse_and(self):
+        terms = [self._parse_term()]
+
+        while self._accept_keyword("and"):
+            terms.append(self._parse_term())
+
+        return self._join("$and", terms)
+
     @staticmethod
-    def _to_mongo_query_dict(ops_dict):
+    def _join(operator:str, terms:list):
+        if len(terms) == 1:
+            return terms[0]
+
+        if any(type(term) in [_Parameter, _Group] for term in terms):
+            return _Group(operator, terms)
+
+        return {operator: terms}
+
+    def _parse_term(self):
+        self._skip_spaces()
+
+        if self._position < self._length and self._text[self._position] == "(":
+            self._position += 1
+            self._depth += 1
+            result = self._parse_or()
+            self._skip_spaces()
+
+            if self._position == self._length or self._text[self._position] != ")":
+                raise self._syntax_error()
+
+            self._position += 1
+            self._depth -= 1
+            return result
+
+        field = self._read_word()
+        operator = self._read_word()
+
+        if operator not in COMPARISON_OPERATORS:
+            raise Exception("Invalid operator on {} {}".format(field, operator))
+
+        operand = self._read_list() if operator == "in" else self._read_operand()
+
+        if type(operand) is _Parameter:
+            operand.operation = operator
+            operand.field = field
+            return operand
+
+        return MongoQueryParser._to_mongo_condition(operator, field, operand)
+
+    def _read_word(self):
         """
-        Converts an ops tree into a Mongo query.
-        :param ops_dict: Ops tree, extracted from the _retrieve_ops_tree()
-        :return: Mongo query.
+        Reads the text until the next space. Closing parenthesis that are not balanced within the word close the
+        groups opened before it.
         """
+        self._skip_spaces()
+        match = _WORD.match(self._text, self._position)
 
-        ors = ops_dict['or']
-        ands = ops_dict['and']
-        base = ops_dict[None]
+        if match is None:
+            raise self._syntax_error()
 
-        result = {}
-        if len(ors) > 0:
-            list_ors = []
-
-            for op in ors:
-                if type(op) is list:
-                    l = MongoQueryParser._to_mongo_query_list(op)
-                elif type(op) is dict:
-                    l = MongoQueryParser._to_mongo_query_dict(op)
-
-                list_ors += [l]
-
-            result['$or'] = list_ors
-
-        if len(ands) > 0:
-            list_ands = []
-            for op in ands:
-                if type(op) is list:
-                    l = MongoQueryParser._to_mongo_query_list(op)
-                elif type(op) is dict:
-                    l = MongoQueryParser._to_mongo_query_dict(op)
-                list_ands += [l]
-
-            if len(result) > 0:
-                result['$or'] += list_ands
+        word = match.group()
+
+        if self._depth > 0 and word.endswith(")"):
+            unbalanced = word.count(")") - word.count("(")
+            trailing = len(word) - len(word.rstrip(")"))
+            word = word[:len(word) - max(0, min(unbalanced, trailing, self._depth))]
+
+        if len(word) == 0:
+            raise self._syntax_error()
+
+        self._position = match.start() + len(word)
+        return word
+
+    def _read_quoted(self):
+        """
+        Reads a text enclosed in quotes. The quote can be escaped inside it with a backslash.
+        """
+        quote = self._text[self._position]
+        start = self._position + 1
+        pieces = []
+
+        while True:
+            end = self._text.find(quote, start)
+
+            if end == -1:
+                raise self._syntax_error()
+
+            if self._text[end - 1] == ESCAPE_CHAR and end - 1 >= start:
+                pieces.append(self._text[start:end - 1] + quote)
+                start = end + 1
+                continue
+
+            pieces.append(self._text[start:end])
+            self._position = end + 1
+            return "".join(pieces)
+
+    def _read_operand(self):
+        self._skip_spaces()
+
+        if self._position < self._length and self._text[self._position] in QUOTES:
+            return self._read_quoted()
+
+        word = self._read_word()
+        parameter = _PARAMETER.match(word) if self._parameters else None
+
+        return _Parameter(None, None, parameter.group(1)) if parameter is not None else word
+
+    def _read_list(self):
+        """
+        Reads a list of values enclosed in brackets. Quoted values are texts; the rest are numbers, or texts if they
+        are not numbers.
+        """
+        self._skip_spaces()
+
+        if self._parameters and self._text.startswith(":", self._position):
+            return self._read_operand()
+
+        if self._position == self._length or self._text[self._position] != "[":
+            raise self._syntax_error()
+
+        self._position += 1
+        values = []
+
+        while True:
+            self._skip_spaces()
+
+            if self._position == self._length:
+                raise self._syntax_error()
+
+            if self._text[self._position] == "]" and len(values) == 0:
+                self._position += 1
+                return values
+
+            if self._text[self._position] in QUOTES:
+                values.append(self._read_quoted())
             else:
-                result['$and'] = list_ands
+                match = _LIST_ITEM.match(self._text, self._position)
+                value = match.group().strip()
+                self._position = match.end()
+
+                try:
+                    values.append(float(value))
+                except ValueError:
+                    values.append(value)
 
-        if len(base) > 0:
-            result = MongoQueryParser._to_mongo_query_list(base[0])
+            self._skip_spaces()
 
-        return result
+            if self._position == self._length:
+                raise self._syntax_error()
+
+            separator = self._text[self._position]
+            self._position += 1
+
+            if separator == "]":
+                return values
 
+            if separator != ",":
+                raise self._syntax_error()
 
 
+# Process-wide parser used by the dictionaries, so that they share the cache of compiled queries.
+QUERY_PARSER = MongoQueryParser()
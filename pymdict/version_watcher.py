@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2018 Iván de Paz Centeno
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+from threading import Thread, Lock
+from time import sleep
+from weakref import WeakValueDictionary
+
+from pymongo.errors import InvalidOperation, OperationFailure, PyMongoError
+
+from pymdict.mongo_client_pool import CLIENT_POOL
+
+
+# Change stream pipeline over the metadata collection. Only the events that may change the list of versions of a
+# dictionary get through: inserts, replaces and updates touching 'value' or 'value.version' ($push reports the pushed
+# element as 'value.version.<index>'). Events are reduced to the fields read by the watcher; '_id' is the resume
+# token and must be kept.
+VERSION_CHANGES_PIPELINE = [
+    {'$match': {'$expr': {'$or': [
+        {'$in': ['$operationType', ['insert', 'replace']]},
+        {'$and': [
+            {'$eq': ['$operationType', 'update']},
+            {'$anyElementTrue': [{'$map': {
+                'input': {'$objectToArray': {'$ifNull': ['$updateDescription.updatedFields', {}]}},
+                'as': 'field',
+                'in': {'$regexMatch': {'input': '$$field.k', 'regex': r'^value(\.version(\..*)?)?$'}}
+            }}]}
+        ]}
+    ]}}},
+    {'$project': {'fullDocument.key': 1, 'fullDocument.value.version': 1}}
+]
+
+
+class _MetadataWatcher(Thread):
+    """
+    Thread that follows the metadata collection of a database and notifies the watched dictionaries of it when their
+    versions change. It stops when it is not watching any dictionary anymore, or when its client is closed.
+    """
+
+    def __init__(self, meta_collection, interval:float, on_stop=None):
+        """
+        :param meta_collection: metadata collection to follow.
+        :param interval: seconds between polls, and maximum time to notice that the watcher must stop.
+        :param on_stop: optional function called with the watcher when its thread stops.
+        """
+        Thread.__init__(self, name="pymdict-version-watcher-{}".format(meta_collection.full_name), daemon=True)
+        self._meta_collection = meta_collection
+        self._interval = interval
+        self._on_stop = on_stop
+        self._dicts = {}
+        self._stopped = False
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        return self._meta_collection.database.client
+
+    def watch(self, mongo_dict):
+        """
+        Starts notifying a dictionary.
+        :return: False if the watcher has already stopped, so the dictionary needs another watcher.
+        """
+        with self._lock:
+            if self._stopped:
+                return False
+
+            self._dicts.setdefault(mongo_dict.get_my_id(), WeakValueDictionary())[id(mongo_dict)] = mongo_dict
+
+        return True
+
+    def unwatch(self, mongo_dict):
+        with self._lock:
+            instances = self._dicts.get(mongo_dict.get_my_id())
+
+            if instances is not None:
+                instances.pop(id(mongo_dict), None)
+
+    def stop(self):
+        """
+        Asks the thread to stop. It stops within the polling interval.
+        """
+        with self._lock:
+            self._stopped = True
+
+    def _should_stop(self):
+        """
+        Checks whether the thread must stop. Once there are no dictionaries left to watch, the watcher does not accept
+        new ones.
+        """
+        with self._lock:
+            self._prune()
+
+            if len(self._dicts) == 0:
+                self._stopped = True
+
+            return self._stopped
+
+    def _prune(self):
+        for dict_id in [dict_id for dict_id, instances in self._dicts.items() if len(instances) == 0]:
+            del self._dicts[dict_id]
+
+    def _notify(self, dict_id, metadata):
+        with self._lock:
+            instances = list(self._dicts.get(dict_id, {}).values())
+
+        for instance in instances:
+            instance._check_versions(metadata.get('version', []))
+
+    def _watched_ids(self):
+        with self._lock:
+            self._prune()
+            return list(self._dicts.keys())
+
+    def _poll(self):
+        """
+        Reads the metadata of every watched dictionary with a single query.
+        """
+        dict_ids = self._watched_ids()
+
+        if len(dict_ids) == 0:
+            return
+
+        for document in self._meta_collection.find({'key': {'$in': dict_ids}}, {'_id': 0, 'key': 1, 'value.version': 1}):
+            self._notify(document['key'], document['value'])
+
+    def _follow_change_stream(self):
+        """
+        Notifies the changes of the metadata as soon as they happen. It blocks until the stream fails or the watcher
+        must stop.
+        """
+        with self._meta_collection.watch(VERSION_CHANGES_PIPELINE, full_document='updateLookup',
+                                         max_await_time_ms=int(self._interval * 1000)) as stream:
+            # Changes that happened before the stream was opened
+            self._poll()
+
+            # try_next() returns None once the interval passes without changes, so that the loop can stop
+            while stream.alive and not self._should_stop():
+                change = stream.try_next()
+                document = change.get('fullDocument') if change is not None else None
+
+                if document is not None:
+                    self._notify(document['key'], document['value'])
+
+    def run(self):
+        use_change_stream = True
+
+        try:
+            while not self._should_stop():
+                try:
+                    if use_change_stream:
+                        self._follow_change_stream()
+                    else:
+                        self._poll()
+                except InvalidOperation:
+                    # The client has been closed
+                    break
+                except OperationFailure:
+                    # Change streams are only available on replica sets
+                    use_change_stream = False
+                except PyMongoError:
+                    pass
+
+                if not self._should_stop():
+                    sleep(self._interval)
+        finally:
+            self.stop()
+
+            if self._on_stop is not None:
+                self._on_stop(self)
+
+
+class VersionWatcher:
+    """
+    Process-wide watcher of dictionary versions.
+
+    Mutable MongoDict instances register themselves here, so they know when a new version of them has been created
+    (for example, because they have been forked by other instance or process). A single thread per metadata collection
+    follows a change stream on it, or polls the metadata of all the watched dictionaries at once if change streams are
+    not available. Dictionaries are referenced weakly, so they stop being tracked when they go out of scope. A thread
+    stops once it has no dictionaries left to watch, or when the client pool closes its client.
+
+    Threads do not survive a fork of the process, so a forked child process starts its own watcher threads.
+    """
+
+    def __init__(self, interval:float=1):
+        """
+        :param interval: seconds between polls, when change streams are not available.
+        """
+        self._interval = interval
+        self._pid = os.getpid()
+        self._watchers = {}
+        self._lock = Lock()
+
+    def _check_process(self):
+        """
+        Forgets the watchers inherited from the parent process, if this process is a fork of it.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._watchers = {}
+            self._lock = Lock()
+
+    def watch(self, mongo_dict):
+        """
+        Starts tracking the versions of a dictionary. Its _check_versions() method is called with the list of
+        versions each time the metadata of the dictionary changes.
+        :param mongo_dict: MongoDict instance to watch.
+        """
+        self._check_process()
+        meta_collection = mongo_dict._get_dict_meta()._instance
+        key = (id(meta_collection.database.client), meta_collection.full_name)
+
+        with self._lock:
+            watcher = self._watchers.get(key)
+
+            # Watchers that have stopped, or are stopping because they had nothing left to watch, are replaced
+            if watcher is None or not watcher.is_alive() or not watcher.watch(mongo_dict):
+                watcher = _MetadataWatcher(meta_collection, self._interval, on_stop=self._forget_watcher)
+                watcher.watch(mongo_dict)
+                self._watchers[key] = watcher
+                watcher.start()
+
+    def unwatch(self, mongo_dict):
+        """
+        Stops tracking the versions of a dictionary.
+        :param mongo_dict: MongoDict instance to stop watching.
+        """
+        self._check_process()
+
+        with self._lock:
+            watchers = list(self._watchers.values())
+
+        for watcher in watchers:
+            watcher.unwatch(mongo_dict)
+
+    def forget_client(self, client):
+        """
+        Stops the watchers that use the given client. Called by the client pool when it closes the client.
+        :param client: MongoClient being closed.
+        """
+        self._check_process()
+
+        with self._lock:
+            watchers = [watcher for watcher in self._watchers.values() if watcher.client is client]
+
+        for watcher in watchers:
+            watcher.stop()
+            self._forget_watcher(watcher)
+
+    def _forget_watcher(self, watcher):
+        with self._lock:
+            for key in [key for key, registered in self._watchers.items() if registered is watcher]:
+                del self._watchers[key]
+
+
+# Process-wide watcher used by every mutable dictionary.
+VERSION_WATCHER = VersionWatcher()
+CLIENT_POOL.add_close_listener(VERSION_WATCHER.forget_client)
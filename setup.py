@@ -50,8 +50,11 @@ setup(name='pymdict',
       license='MIT',
       packages=setuptools.find_packages(),
       install_requires=[
-          "pymongo"
+          "pymongo>=3.8"
       ],
+      extras_require={
+          "async": ["motor>=2.0"]
+      },
       classifiers=[
           'Environment :: Console',
           'Intended Audience :: Developers',
@@ -0,0 +1,251 @@
+import asyncio
+import gc
+import unittest
+
+from pymongo.errors import BulkWriteError
+
+from pymdict import async_mongo_dict
+from pymdict.async_mongo_dict import AsyncMongoDict, AsyncIOMotorClient
+from pymdict.mongo_client_pool import KEY_INDEX
+from pymdict.mongo_dict import DictDropper, MongoDict
+
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+async def collect(async_iterator):
+    return [x async for x in async_iterator]
+
+
+@unittest.skipIf(AsyncIOMotorClient is None, "motor is not installed")
+class AsyncMongoDictTests(unittest.TestCase):
+
+    def setUp(self):
+        self._drop_db()
+        self.d = AsyncMongoDict("async_original", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+    def test_write_read(self):
+        run(self.d.set("1", "my value"))
+
+        self.assertEqual(run(self.d["1"]), "my value")
+        self.assertEqual(run(self.d.get("5", default=0)), 0)
+        self.assertTrue(run(self.d.contains("1")))
+
+        with self.assertRaises(KeyError):
+            run(self.d["5"])
+
+    def test_items_and_query(self):
+        run(self.d.update({"1": 22, "2": "foo", "3": 33}))
+
+        self.assertEqual(sorted(run(collect(self.d.items()))), [("1", 22), ("2", "foo"), ("3", 33)])
+        self.assertEqual([(k, v) for k, v, _ in run(collect(self.d("value > 30")))], [("3", 33)])
+        self.assertEqual(run(collect(self.d("value > 20", count_only=True))), [2])
+        self.assertEqual(run(collect(self.d(self.d.prepare("value > :v"), count_only=True, v=20))), [2])
+        self.assertEqual(run(self.d.length()), 3)
+
+    def test_fork(self):
+        run(self.d.update({"1": 22, "2": "foo"}))
+        fork = run(self.d.fork("async_fork"))
+
+        run(fork.delete("1"))
+        run(fork.set("2", "bar"))
+        run(fork.set("3", 33))
+
+        self.assertEqual(run(fork.get_many(["1", "2", "3"])), {"1": None, "2": "bar", "3": 33})
+        self.assertEqual(sorted(run(collect(fork.keys()))), ["2", "3"])
+        self.assertEqual(run(fork.length()), 2)
+        self.assertEqual(run(self.d.get_many(["1", "2", "3"])), {"1": 22, "2": "foo", "3": None})
+
+        sync_fork = MongoDict("async_fork", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+        self.assertEqual(sync_fork["2"], "bar")
+
+    def test_fork_onto_existing_fork(self):
+        run(self.d.update({"1": 1, "2": 2}))
+        fork = run(self.d.fork("async_fork"))
+        run(fork.delete("1"))
+        run(fork.delete("2"))
+        run(fork.set("3", 3))
+        self.assertEqual(run(fork.length()), 1)
+
+        # Forking again moves the fork on top of the new version of its father, with its overrides and removals
+        run(self.d.set("4", 4))
+        fork = run(self.d.fork("async_fork"))
+        self.assertEqual(sorted(run(collect(fork.keys()))), ["3", "4"])
+        self.assertEqual(run(fork.length()), 2)
+
+    def test_new_versions_are_picked(self):
+        run(self.d.set("1", 1))
+        other = AsyncMongoDict("async_original", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT, version_check_interval=0)
+        self.assertEqual(run(other["1"]), 1)
+
+        # Forking creates a new version of the father, written by this instance only
+        run(self.d.fork("async_fork"))
+        run(self.d.set("1", 2))
+        self.assertEqual(run(other["1"]), 2)
+
+        throttled = AsyncMongoDict("async_original", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT,
+                                   version_check_interval=3600)
+        self.assertEqual(run(throttled["1"]), 2)
+        run(self.d.fork("async_fork"))
+        run(self.d.set("1", 3))
+        self.assertEqual(run(throttled["1"]), 2)
+
+        run(throttled.reload())
+        self.assertEqual(run(throttled["1"]), 3)
+
+    def test_query_options(self):
+        run(self.d.update({"1": {"n": 1, "tag": "a"}, "2": {"n": 5, "tag": "b"}, "3": {"n": 3, "tag": "c"}}))
+        fork = run(self.d.fork("async_fork"))
+        run(fork.set("4", {"n": 4, "tag": "d"}))
+        run(fork.set("1", {"n": 6, "tag": "e"}))
+        run(fork.delete("2"))
+
+        for d, keys, tags in [(self.d, ["2", "3", "1"], ["a", "b", "c"]), (fork, ["1", "4", "3"], ["c", "d", "e"])]:
+            self.assertEqual([key for key, _, _ in run(collect(d("", sort="value.n desc")))], keys)
+            self.assertEqual([key for key, _, _ in run(collect(d("", sort="value.n desc", skip=1, limit=1)))],
+                             keys[1:2])
+            self.assertEqual(run(collect(d("value.n > 0", count_only=True, skip=1, limit=5))), [2])
+            self.assertEqual(sorted(value["tag"] for _, value, _ in run(collect(d("", fields=["value.tag"])))), tags)
+            self.assertTrue(all("n" not in value for _, value, _ in run(collect(d("", fields=["value.tag"],
+                                                                                sort="value.n")))))
+
+    def test_value_indexes(self):
+        run(self.d.set("1", {"n": 1}))
+        name = run(self.d.create_value_index("value.n desc"))
+        fork = run(self.d.fork("async_fork"))
+
+        self.assertEqual(run(self.d.value_indexes()), {name: [("value.n", -1)]})
+        self.assertEqual(run(fork.value_indexes()), {name: [("value.n", -1)]})
+        self.assertIn(name, run(fork._instance.index_information()))
+        self.assertIn(name, run(self.d._instance.index_information()))
+        self.assertEqual(MongoDict("async_fork", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT).value_indexes(),
+                         {name: [("value.n", -1)]})
+
+        with self.assertRaises(Exception):
+            run(self.d.create_value_index("key"))
+
+    def test_unhashable_and_bool_keys(self):
+        run(self.d.update({1: "int", ("a", 1): "list"}))
+        run(self.d.set({"a": 1}, "dict"))
+        fork = run(self.d.fork("async_fork"))
+        run(fork.set(True, "bool"))
+        run(fork.delete(("a", 1)))
+
+        self.assertEqual(run(fork.get(1)), "int")
+        self.assertEqual(run(fork.get(True)), "bool")
+        self.assertEqual(run(fork[{"a": 1}]), "dict")
+        self.assertFalse(run(fork.contains(["a", 1])))
+        self.assertEqual(len(run(collect(fork.items()))), 3)
+        self.assertEqual(run(collect(fork("value eq 'dict'", count_only=True))), [1])
+        self.assertEqual(run(collect(fork("", count_only=True))), [3])
+
+    def test_bulk(self):
+        async def fill():
+            async with self.d.bulk(buffer_size=10) as b:
+                for x in range(100):
+                    await b.set("key{}".format(x), x)
+
+        run(fill())
+        self.assertEqual(run(self.d.length()), 100)
+        self.assertEqual(run(self.d["key55"]), 55)
+
+    def test_bulk_operations_over_a_key(self):
+        run(self.d.set("k1", 0))
+
+        async def write(d):
+            async with d.bulk() as b:
+                await b.delete("k1")
+                await b.set("k1", 1)
+                await b.set("k2", 1)
+                await b.set("k2", 2)
+                await b.set("k3", 3)
+                await b.delete("k3")
+
+        run(write(self.d))
+        self.assertEqual(run(self.d.get_many(["k1", "k2", "k3"])), {"k1": 1, "k2": 2, "k3": None})
+        self.assertEqual(run(self.d.length()), 2)
+
+        fork = run(self.d.fork("async_fork"))
+        run(fork.delete("k1"))
+        run(write(fork))
+        self.assertEqual(run(fork.get_many(["k1", "k2", "k3"])), {"k1": 1, "k2": 2, "k3": None})
+        self.assertEqual(run(fork.length()), 2)
+
+    def test_bulk_auto_upserts(self):
+        run(self.d.set("k1", 0))
+
+        async def write(d):
+            async with d.bulk(do_upserts="auto") as b:
+                await b.set("k1", 1)
+                await b.set("k2", 2)
+                await b.set(2 ** 53, "a")
+                await b.set(2 ** 53 + 1, "b")
+                await b.delete("k3")
+
+        run(write(self.d))
+        self.assertEqual(run(self.d.get_many(["k1", "k2", 2 ** 53, 2 ** 53 + 1])),
+                         {"k1": 1, "k2": 2, 2 ** 53: "a", 2 ** 53 + 1: "b"})
+        self.assertEqual(run(self.d.length()), 4)
+
+        fork = run(self.d.fork("async_fork"))
+        run(fork.set("k3", 3))
+
+        async def remove(d):
+            async with d.bulk(do_upserts="auto") as b:
+                await b.delete("k1")
+                await b.delete("k3")
+                await b.set("k2", "new")
+
+        run(remove(fork))
+        self.assertEqual(run(fork.get_many(["k1", "k2", "k3"])), {"k1": None, "k2": "new", "k3": None})
+        self.assertEqual(run(fork.length()), 3)
+        self.assertEqual(run(self.d["k1"]), 1)
+
+    def test_bulk_write_errors_are_raised(self):
+        run(self.d.set("k1", 0))
+        # The collection might have been dropped since the key index was requested
+        run(self.d._instance.create_index([("key", 1)], name=KEY_INDEX, unique=True))
+
+        async def write():
+            async with self.d.bulk(do_upserts=False) as b:
+                await b.set("k1", 1)
+
+        with self.assertRaises(BulkWriteError):
+            run(write())
+
+        self.assertEqual(run(self.d["k1"]), 0)
+
+    def test_clients_are_released_with_their_loop(self):
+        async def get_client():
+            return async_mongo_dict._get_client(MONGO_HOST, MONGO_PORT, "pymdict")
+
+        loop = asyncio.new_event_loop()
+        client = loop.run_until_complete(get_client())
+        self.assertIs(loop.run_until_complete(get_client()), client)
+        self.assertIsNot(run(get_client()), client)
+        self.assertIn(loop, async_mongo_dict._clients)
+
+        loop.close()
+        del loop, client
+        gc.collect()
+        self.assertEqual(len(async_mongo_dict._clients), 1)
+
+    def tearDown(self):
+        self._drop_db()
+
+    def _drop_db(self):
+        dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+        for dict_id in ["async_original", "async_fork"]:
+            try:
+                dropper.drop_dict(dict_id)
+            except KeyError:
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
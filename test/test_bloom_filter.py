@@ -0,0 +1,44 @@
+import unittest
+
+from pymdict.bloom_filter import BloomFilter
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        f = BloomFilter(capacity=1000)
+        keys = ["key{}".format(x) for x in range(1000)] + list(range(100)) + [("a", 1), {"foo": "bar"}]
+
+        for key in keys:
+            f.add(key)
+
+        for key in keys:
+            self.assertIn(key, f)
+
+    def test_false_positive_rate(self):
+        f = BloomFilter(capacity=1000, error_rate=0.01)
+
+        for x in range(1000):
+            f.add("key{}".format(x))
+
+        false_positives = sum(1 for x in range(10000) if "other{}".format(x) in f)
+        self.assertLess(false_positives, 300)
+
+    def test_numbers_equal_for_mongo(self):
+        f = BloomFilter(capacity=10)
+        f.add(4)
+
+        self.assertIn(4.0, f)
+        self.assertNotIn("4", f)
+
+        f.add({"a": [4, 5]})
+        self.assertIn({"a": [4.0, 5]}, f)
+
+    def test_empty(self):
+        f = BloomFilter(capacity=0)
+
+        self.assertNotIn("foo", f)
+
+
+if __name__ == '__main__':
+    unittest.main()
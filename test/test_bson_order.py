@@ -0,0 +1,64 @@
+import unittest
+from datetime import datetime
+
+from bson import ObjectId, Decimal128
+
+from pymdict.bson_order import bson_sort_key, bson_identity, document_sort_key
+
+
+class BsonOrderTests(unittest.TestCase):
+
+    def test_types_order(self):
+        oid = ObjectId()
+        date = datetime(2018, 1, 1)
+        values = [date, True, oid, b"bytes", [3], {"a": 1}, "b", 2, None, []]
+
+        self.assertEqual(sorted(values, key=bson_sort_key), [[], None, 2, [3], "b", {"a": 1}, b"bytes", oid, True,
+                                                             date])
+
+    def test_numbers_order(self):
+        self.assertEqual(sorted([3, 1.5, float('nan'), -2], key=bson_sort_key)[1:], [-2, 1.5, 3])
+        self.assertEqual(bson_sort_key(4), bson_sort_key(4.0))
+
+    def test_strings_order(self):
+        self.assertEqual(sorted(["b", "B", "a", "ab"], key=bson_sort_key), ["B", "a", "ab", "b"])
+
+    def test_objects_order(self):
+        self.assertEqual(sorted([{"b": 1}, {"a": 2}, {"a": 1, "b": 1}, {"a": 1}], key=bson_sort_key),
+                         [{"a": 1}, {"a": 1, "b": 1}, {"a": 2}, {"b": 1}])
+
+    def test_arrays_by_lowest_element(self):
+        self.assertEqual(sorted([[5, 1], 3, [2]], key=bson_sort_key), [[5, 1], [2], 3])
+        self.assertEqual(bson_sort_key(1), bson_sort_key([1, 2]))
+
+    def test_document_sort_key(self):
+        documents = [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}, {"b": "w"}, {"a": 2, "b": "z"}, {"a": [0, 5], "b": "v"}]
+
+        self.assertEqual(sorted(documents, key=document_sort_key([("a", -1), ("b", 1)])),
+                         [{"a": [0, 5], "b": "v"}, {"a": 2, "b": "y"}, {"a": 2, "b": "z"}, {"a": 1, "b": "x"},
+                          {"b": "w"}])
+        self.assertEqual(sorted(documents, key=document_sort_key([("a", 1), ("b", -1)])),
+                         [{"b": "w"}, {"a": [0, 5], "b": "v"}, {"a": 1, "b": "x"}, {"a": 2, "b": "z"},
+                          {"a": 2, "b": "y"}])
+        self.assertEqual(document_sort_key([("value.ts", 1)])({"value": {"ts": 4}}), (bson_sort_key(4),))
+
+    def test_identity(self):
+        self.assertEqual(bson_identity(4), bson_identity(4.0))
+        self.assertNotEqual(bson_identity(1), bson_identity([1, 2]))
+        self.assertNotEqual(bson_identity("4"), bson_identity(4))
+        self.assertNotEqual(bson_identity(True), bson_identity(1))
+        self.assertEqual(bson_identity({"a": [1, 2]}), bson_identity({"a": [1.0, 2]}))
+        self.assertNotEqual(bson_identity({"a": True}), bson_identity({"a": 1}))
+
+    def test_identity_of_large_and_decimal_numbers(self):
+        self.assertNotEqual(bson_identity(2 ** 53), bson_identity(2 ** 53 + 1))
+        self.assertNotEqual(bson_identity([2 ** 53]), bson_identity([2 ** 53 + 1]))
+        self.assertEqual(bson_identity(2 ** 53), bson_identity(float(2 ** 53)))
+        self.assertEqual(bson_identity(4), bson_identity(Decimal128("4.00")))
+        self.assertEqual(bson_identity(0.5), bson_identity(Decimal128("0.5")))
+        self.assertEqual(bson_identity(Decimal128("1.5")), bson_identity(Decimal128("1.50")))
+        self.assertNotEqual(bson_identity(0.1), bson_identity(Decimal128("0.1")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from pymdict.index_advisor import IndexAdvisor
+from pymdict.mongo_query_parser import MongoQueryParser
+
+
+class IndexAdvisorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.advisor = IndexAdvisor()
+        self.parser = MongoQueryParser()
+
+    def _suggest(self, query, sort=None):
+        return IndexAdvisor.suggest(self.parser.transform_request(query), sort)
+
+    def test_equality_sort_range(self):
+        self.assertEqual(self._suggest("value.age > 40"), [[("value.age", 1)]])
+        self.assertEqual(self._suggest("value.ts > 3 and value.tenant eq acme", [("value.name", -1)]),
+                         [[("value.tenant", 1), ("value.name", -1), ("value.ts", 1)]])
+        self.assertEqual(self._suggest("", [("value.ts", 1)]), [[("value.ts", 1)]])
+
+    def test_branches(self):
+        self.assertEqual(self._suggest("value.a = 1 or (value.b % ^x and value.c eq y)"),
+                         [[("value.a", 1)], [("value.c", 1), ("value.b", 1)]])
+
+    def test_unhelpful_queries(self):
+        # Served by the key index, or not served by any index
+        self.assertEqual(self._suggest("key eq foo and value.age > 40"), [])
+        self.assertEqual(self._suggest("value.name !eq foo"), [])
+        self.assertEqual(self._suggest("value.name % foo"), [])
+
+    def test_report(self):
+        self.advisor.record("d", self.parser.transform_request("value.age > 40"))
+        self.advisor.record("d", self.parser.transform_request("value.age < 20"))
+        self.advisor.record("d", self.parser.transform_request("value.x = 1"))
+        self.advisor.record("d", self.parser.transform_request("value.x = 1"), indexes=[[("value.x", 1)]])
+
+        self.assertEqual(self.advisor.report(), [{'dict': "d", 'index': [("value.age", 1)], 'queries': 2},
+                                                 {'dict': "d", 'index': [("value.x", 1)], 'queries': 1}])
+
+        self.advisor.reset()
+        self.assertEqual(self.advisor.report(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
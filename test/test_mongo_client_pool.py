@@ -0,0 +1,77 @@
+import os
+import unittest
+
+from pymdict.mongo_client_pool import MongoClientPool
+
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+
+
+class MongoClientPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = MongoClientPool()
+
+    def test_same_parameters_share_client(self):
+        client1 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        client2 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        client3 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts", credentials=["user", "pass"])
+        client4 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts", credentials=("user", "pass"))
+
+        self.assertIs(client1, client2)
+        self.assertIsNot(client1, client3)
+        self.assertIs(client3, client4)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_close(self):
+        client1 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        self.pool.get_client(MONGO_HOST, MONGO_PORT, "other_db")
+
+        self.pool.close(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        self.assertEqual(len(self.pool), 1)
+        self.assertIsNot(self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts"), client1)
+
+        self.pool.close_all()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_unsupported_features_are_kept_per_client(self):
+        client1 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        client2 = self.pool.get_client(MONGO_HOST, MONGO_PORT, "other_db")
+
+        self.pool.set_unsupported(client1, "$unionWith")
+        self.assertFalse(self.pool.supports(client1, "$unionWith"))
+        self.assertTrue(self.pool.supports(client2, "$unionWith"))
+        self.assertTrue(self.pool.supports(client1, "$merge"))
+
+        self.pool.close_all()
+        self.assertTrue(self.pool.supports(client1, "$unionWith"))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "os.fork() is not available")
+    def test_forked_process_gets_its_own_client(self):
+        client = self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                result = b"1" if self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts") is not client else b"0"
+            except Exception:
+                result = b"E"
+
+            os.write(write_fd, result)
+            os._exit(0)
+
+        os.close(write_fd)
+        result = os.read(read_fd, 1)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(result, b"1")
+        self.assertIs(self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts"), client)
+
+    def tearDown(self):
+        self.pool.close_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from time import sleep
+
+from pymdict.mongo_dict_cache import LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = LRUCache()
+
+        self.assertEqual(cache.get("k1"), (False, None))
+        cache.put("k1", {"foo": ["bar"]})
+        self.assertEqual(cache.get("k1"), (True, {"foo": ["bar"]}))
+
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 0})
+
+    def test_values_are_copied(self):
+        cache = LRUCache()
+        value = ["bar"]
+
+        cache.put("k1", value)
+        value.append("foo")
+        cache.get("k1")[1].append("foo")
+
+        self.assertEqual(cache.get("k1"), (True, ["bar"]))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+
+        cache.put("k1", 1)
+        cache.put("k2", 2)
+        cache.get("k1")
+        cache.put("k3", 3)
+
+        self.assertEqual(cache.get("k2"), (False, None))
+        self.assertEqual(cache.get("k1"), (True, 1))
+        self.assertEqual(cache.get("k3"), (True, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=100)
+
+        cache.put("k1", "a" * 40)
+        cache.put("k2", "b" * 40)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("k2"), (True, "b" * 40))
+
+        cache.put("k3", "c" * 200)
+        self.assertEqual(cache.get("k3"), (False, None))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.1)
+
+        cache.put("k1", 1)
+        self.assertEqual(cache.get("k1"), (True, 1))
+        sleep(0.15)
+        self.assertEqual(cache.get("k1"), (False, None))
+
+    def test_invalidate_clear(self):
+        cache = LRUCache()
+
+        cache.put("k1", 1)
+        cache.put("k2", 2)
+        cache.invalidate("k1")
+        self.assertEqual(cache.get("k1"), (False, None))
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
+import os
 import re
+import subprocess
 import unittest
+from time import perf_counter
+from unittest.mock import patch
 
-from pymdict.mongo_query_parser import MongoQueryParser
+from pymdict import mongo_query_parser
+from pymdict.mongo_query_parser import MongoQueryParser, _QueryCompiler
 
 
 class MongoQueryParserTests(unittest.TestCase):
@@ -31,5 +36,182 @@ class MongoQueryParserTests(unittest.TestCase):
         self.assertEqual(m.transform_request("(val.hola = 22 and val.pepe > 44) or val.juan < 44"), {'$or': [{'$and':[{'val.hola': 22.0}, {'val.pepe': {'$gt': 44.0}}]}, {'val.juan': {'$lt': 44.0}}]})
 
 
+    def test_mongo_precedence_and_grouping(self):
+        m = MongoQueryParser()
+
+        self.assertEqual(m.transform_request("val.a = 1 and val.b = 2 or val.c = 3"), {'$or': [{'$and': [{'val.a': 1.0}, {'val.b': 2.0}]}, {'val.c': 3.0}]})
+        self.assertEqual(m.transform_request("((val.a = 1 or val.b = 2) and val.c = 3)"), {'$and': [{'$or': [{'val.a': 1.0}, {'val.b': 2.0}]}, {'val.c': 3.0}]})
+        self.assertEqual(m.transform_request("(key % ^(a|b)$) or val.c = 3"), {'$or': [{'key': {'$regex': '^(a|b)$'}}, {'val.c': 3.0}]})
+        self.assertEqual(m.transform_request("val.hola in [33, 44] and val.name eq \"foo bar\""), {'$and': [{'val.hola': {'$in': [33.0, 44.0]}}, {'val.name': 'foo bar'}]})
+        self.assertEqual(m.transform_request("val.name eq 'it\\'s'"), {'val.name': "it's"})
+        self.assertEqual(m.transform_request(""), {})
+
+        with self.assertRaises(Exception):
+            m.transform_request("val.hola ~ 33")
+
+        with self.assertRaises(Exception):
+            m.transform_request("(val.hola = 33")
+
+        with self.assertRaises(Exception):
+            m.transform_request("val.hola in [33, 44")
+
+    def test_mongo_query_cache(self):
+        m = MongoQueryParser(cache_size=2)
+
+        query = m.transform_request("val.hola in [33, 44]")
+        query['val.hola']['$in'].append(55)
+
+        self.assertEqual(m.transform_request("val.hola in [33, 44]"), {'val.hola': {'$in': [33, 44]}})
+        self.assertEqual(m.cache_stats()['hits'], 1)
+
+        m.transform_request("val.hola = 1")
+        m.transform_request("val.hola = 2")
+        self.assertEqual(m.cache_stats()['entries'], 2)
+        self.assertEqual(m.cache_stats()['evictions'], 1)
+
+        self.assertIsNone(MongoQueryParser(cache_size=0).cache_stats())
+
+    def test_mongo_prepared_query(self):
+        m = MongoQueryParser()
+
+        prepared = m.prepare("val.tenant eq :t and (val.ts > :since or key in :keys) and val.kind eq 'a b'")
+        self.assertEqual(prepared.parameters, {'t', 'since', 'keys'})
+
+        self.assertEqual(prepared.bind(t="acme", since=123, keys=["1", "2"]),
+                         {'$and': [{'val.tenant': {'$eq': 'acme'}}, {'$or': [{'val.ts': {'$gt': 123.0}}, {'key': {'$in': ['1', '2']}}]}, {'val.kind': 'a b'}]})
+        self.assertEqual(prepared.bind(t="it's", since=0, keys=[]),
+                         {'$and': [{'val.tenant': {'$eq': "it's"}}, {'$or': [{'val.ts': {'$gt': 0.0}}, {'key': {'$in': []}}]}, {'val.kind': 'a b'}]})
+        self.assertEqual(m.to_mongo_query(m.prepare("val.hola >= :n"), n=33), m.transform_request("val.hola >= 33"))
+
+        # Parameters are only recognized in prepared queries
+        self.assertEqual(m.transform_request("val.hola eq :t"), {'val.hola': ':t'})
+
+        with self.assertRaises(Exception):
+            prepared.bind(t="acme", since=123)
+
+        self.assertEqual(prepared.bind(t="acme", since=1, keys=("1",))['$and'][1]['$or'][1], {'key': {'$in': ['1']}})
+
+        for keys in ["12", 12, {"1": 1}, None]:
+            with self.assertRaises(ValueError):
+                prepared.bind(t="acme", since=123, keys=keys)
+
+        with self.assertRaises(Exception):
+            m.to_mongo_query("val.hola eq foo", t="acme")
+
+    def test_mongo_prepared_query_operator_injection(self):
+        m = MongoQueryParser()
+
+        self.assertEqual(m.prepare("value.tenant eq :t").bind(t={'$ne': None}),
+                         {'value.tenant': {'$eq': {'$ne': None}}})
+        self.assertEqual(m.prepare("value.tenant !eq :t").bind(t={'$gt': ''}),
+                         {'value.tenant': {'$ne': {'$gt': ''}}})
+        self.assertEqual(m.prepare("key in :keys").bind(keys=[{'$ne': None}]), {'key': {'$in': [{'$ne': None}]}})
+
+    def test_mongo_sort(self):
+        m = MongoQueryParser()
+
+        self.assertEqual(m.transform_sort("value.ts desc, key"), [('value.ts', -1), ('key', 1)])
+        self.assertEqual(m.transform_sort("value.ts ASC"), [('value.ts', 1)])
+        self.assertEqual(m.transform_sort([('value.ts', -1)]), [('value.ts', -1)])
+
+        with self.assertRaises(Exception):
+            m.transform_sort("value.ts up")
+
+        with self.assertRaises(Exception):
+            m.transform_sort("value.ts,")
+
+    def test_mongo_parse_steps_are_linear(self):
+        for size in [10, 1000, 10000]:
+            query = "key in [{}] and value.name eq 'a b' or (value.ts > 3)".format(
+                ", ".join("'id_{}'".format(x) if x % 2 else str(x) for x in range(size)))
+            text = _CountingText(query)
+
+            with patch.object(mongo_query_parser, "_WORD", _CountingPattern(mongo_query_parser._WORD)), \
+                    patch.object(mongo_query_parser, "_LIST_ITEM", _CountingPattern(mongo_query_parser._LIST_ITEM)):
+                result = _QueryCompiler(text).compile()
+
+            self.assertEqual(len(result['$or'][0]['$and'][0]['key']['$in']), size)
+
+            # A single pass reads each character a few times at most, whatever the length of the query. A quadratic
+            # parser reads a number of characters proportional to the length of the query for each of them.
+            self.assertLess(text.reads, len(query) * 3)
+
+
+@unittest.skipUnless(os.environ.get("PYMDICT_BENCHMARK"), "Set PYMDICT_BENCHMARK=1 to run the benchmarks")
+class MongoQueryParserBenchmark(unittest.TestCase):
+    """
+    Prints the parse time of queries of growing length. If PYMDICT_BENCHMARK_BASELINE names a git revision, the parser
+    of that revision is timed too:
+
+        PYMDICT_BENCHMARK=1 PYMDICT_BENCHMARK_BASELINE=<revision> python -m unittest test.test_mongo_query_parser
+    """
+
+    def test_parse_time(self):
+        parsers = [("current", MongoQueryParser(cache_size=0))]
+        baseline = os.environ.get("PYMDICT_BENCHMARK_BASELINE")
+
+        if baseline:
+            parsers.append((baseline, _load_parser(baseline)))
+
+        for size in [10, 1000, 10000, 100000]:
+            query = "key in [{}]".format(", ".join("'id_{}'".format(x) for x in range(size)))
+
+            for name, parser in parsers:
+                start = perf_counter()
+                parser.transform_request(query)
+                print("{} ids, {} parser: {:.4f}s".format(size, name, perf_counter() - start))
+
+
+def _load_parser(revision):
+    """
+    Builds a MongoQueryParser from the source of the given git revision.
+    """
+    source = subprocess.check_output(["git", "show", "{}:pymdict/mongo_query_parser.py".format(revision)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    namespace = {'__name__': "mongo_query_parser_{}".format(revision)}
+    exec(compile(source, "mongo_query_parser.py", "exec"), namespace)
+    return namespace['MongoQueryParser']()
+
+
+class _CountingText(str):
+    """
+    Query text that counts the characters read from it by the compiler.
+    """
+
+    def __new__(cls, text):
+        result = str.__new__(cls, text)
+        result.reads = 0
+        return result
+
+    def __getitem__(self, item):
+        result = str.__getitem__(self, item)
+        self.reads += len(result)
+        return result
+
+    def find(self, sub, start=None, end=None):
+        result = str.find(self, sub, start, end)
+        self.reads += (result if result != -1 else len(self)) - (start or 0) + len(sub)
+        return result
+
+    def startswith(self, prefix, start=None, end=None):
+        self.reads += len(prefix)
+        return str.startswith(self, prefix, start, end)
+
+
+class _CountingPattern():
+    """
+    Regular expression that counts the characters it reads from a _CountingText: the ones it matches, plus the one
+    that stops the match.
+    """
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+
+    def match(self, text, position=0):
+        result = self._pattern.match(text, position)
+        text.reads += (result.end() if result is not None else position) - position + 1
+        return result
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,19 @@
+import pickle
 import unittest
+from decimal import Decimal
 from time import sleep, time
+from unittest.mock import patch
 
 from bson import ObjectId
+from bson.decimal128 import Decimal128
+from pymongo.errors import BulkWriteError, OperationFailure
 
+from pymdict import mongo_dict
+from pymdict.bson_order import bson_identity
+from pymdict.index_advisor import INDEX_ADVISOR
+from pymdict.mongo_client_pool import CLIENT_POOL, KEY_INDEX, LEGACY_KEY_INDEX
 from pymdict.mongo_dict import MongoDict, DictDropper, ForkedMongoDict
+from pymdict.mongo_dict_cache import LRUCache
 
 MONGO_HOST = "localhost"
 MONGO_PORT = 27017
@@ -109,6 +119,64 @@ class CheckDict:
         for key, value in d.items():
             self._testcase_instance.assertEqual(value, normal_dict[key])
 
+    def test_iteration_options(self):
+        d = self._dict_to_test
+
+        d.update({"b": 2, "a": 1, "d": 4, "c": 3, "e": 5})
+        del d["d"]
+
+        self._testcase_instance.assertEqual(list(d.items(sort=True)), [("a", 1), ("b", 2), ("c", 3), ("e", 5)])
+        self._testcase_instance.assertEqual(list(d.iter_keys(sort=True)), ["a", "b", "c", "e"])
+        self._testcase_instance.assertEqual(list(d.values(sort=True, batch_size=2)), [1, 2, 3, 5])
+        self._testcase_instance.assertEqual(list(d.items(sort=True, chunked=True, batch_size=3)),
+                                            [[("a", 1), ("b", 2), ("c", 3)], [("e", 5)]])
+        self._testcase_instance.assertEqual(sorted(value for chunk in d.values(chunked=True) for value in chunk),
+                                            [1, 2, 3, 5])
+        self._testcase_instance.assertEqual(sorted(document['key'] for document in d.items(raw=True)),
+                                            ["a", "b", "c", "e"])
+        self._testcase_instance.assertTrue(all('_id' not in document for document in d.items(raw=True)))
+
+    def test_scan(self):
+        d = self._dict_to_test
+
+        d.update({"key{}".format(x): x for x in range(25)})
+        del d["key3"]
+
+        pages = list(d.scan(page_size=10))
+        self._testcase_instance.assertEqual(sorted(value for page, _ in pages for _, value in page),
+                                            [x for x in range(25) if x != 3])
+
+        resumed = list(d.scan(start_after=pages[0][1], page_size=10))
+        self._testcase_instance.assertEqual(resumed, pages[1:])
+
+        with self._testcase_instance.assertRaises(Exception):
+            list(d.scan(start_after="foo"))
+
+    def test_split_scan(self):
+        d = self._dict_to_test
+
+        d.update({"key{}".format(x): x for x in range(50)})
+        del d["key3"]
+
+        partitions = d.split_scan(4, page_size=7)
+        self._testcase_instance.assertEqual(len(partitions), 4)
+
+        values = [value for partition in pickle.loads(pickle.dumps(partitions)) for _, value in partition]
+        self._testcase_instance.assertEqual(sorted(values), [x for x in range(50) if x != 3])
+
+    def test_split_scan_few_entries(self):
+        d = self._dict_to_test
+
+        partitions = d.split_scan(4)
+        self._testcase_instance.assertLessEqual(len(partitions), 4)
+        self._testcase_instance.assertEqual([entry for partition in partitions for entry in partition], [])
+
+        d["1"] = 1
+
+        partitions = d.split_scan(4)
+        self._testcase_instance.assertLessEqual(len(partitions), 4)
+        self._testcase_instance.assertEqual([entry for partition in partitions for entry in partition], [("1", 1)])
+
     def test_update(self):
         d = self._dict_to_test
 
@@ -150,6 +218,93 @@ class CheckDict:
             self._testcase_instance.assertEqual(key, "1")
             self._testcase_instance.assertEqual(value, normal_dict[key])
 
+    def test_prepared_query(self):
+        d = self._dict_to_test
+
+        d["1"] = {"tenant": "acme", "ts": 10}
+        d["2"] = {"tenant": "acme", "ts": 20}
+        d["3"] = {"tenant": "acme corp", "ts": 30}
+
+        prepared = d.prepare("value.tenant eq :t and value.ts > :since")
+
+        self._testcase_instance.assertEqual(sorted(key for key, _, _ in d(prepared, t="acme", since=15)), ["2"])
+        self._testcase_instance.assertEqual(sorted(key for key, _, _ in d(prepared, t="acme corp", since=0)), ["3"])
+        self._testcase_instance.assertEqual(list(d(prepared, count_only=True, t="acme", since=0)), [2])
+        self._testcase_instance.assertEqual(list(d(prepared, t={"$ne": None}, since=0)), [])
+
+        by_keys = d.prepare("key in :keys")
+        self._testcase_instance.assertEqual(sorted(key for key, _, _ in d(by_keys, keys=["1", "3", "5"])), ["1", "3"])
+
+        with self._testcase_instance.assertRaises(Exception):
+            list(d(prepared, t="acme"))
+
+    def test_query_options(self):
+        d = self._dict_to_test
+
+        d["1"] = {"name": "foo", "ts": 3, "blob": "large"}
+        d["2"] = {"name": "bar", "ts": 1, "blob": "large"}
+        d["3"] = {"name": "baz", "ts": 2, "blob": "large"}
+
+        results = [(key, value) for key, value, _ in d("value.ts > 0", fields=["value.name"], sort="value.ts desc",
+                                                        limit=2)]
+        self._testcase_instance.assertEqual(results, [("1", {"name": "foo"}), ("3", {"name": "baz"})])
+
+        self._testcase_instance.assertEqual([key for key, _, _ in d("value.ts > 1", sort="key", skip=1)], ["3"])
+        self._testcase_instance.assertEqual([value for _, value, _ in d("value.ts = 2", fields=["key"])], [None])
+        self._testcase_instance.assertEqual(list(d("value.ts > 0", count_only=True, limit=2)), [2])
+        self._testcase_instance.assertEqual(list(d("value.ts > 0", count_only=True, skip=2, limit=5)), [1])
+
+        with self._testcase_instance.assertRaises(Exception):
+            list(d("value.ts > 0", fields=["___removed"]))
+
+    def test_aggregate(self):
+        d = self._dict_to_test
+
+        d["1"] = {"tenant": "acme", "bytes": 10}
+        d["2"] = {"tenant": "acme", "bytes": 20}
+        d["3"] = {"tenant": "foo", "bytes": 5}
+
+        result = d.aggregate("value.bytes > 0", group_by="value.tenant",
+                             accumulators={"bytes": "sum value.bytes", "entries": "count", "avg": "avg value.bytes"})
+        self._testcase_instance.assertEqual(result, [{"value.tenant": "acme", "bytes": 30, "entries": 2, "avg": 15},
+                                                     {"value.tenant": "foo", "bytes": 5, "entries": 1, "avg": 5}])
+
+        result = d.aggregate(d.prepare("value.bytes > :b"), accumulators={"max": "max value.bytes"}, b=5)
+        self._testcase_instance.assertEqual(result, [{"max": 20}])
+
+        with self._testcase_instance.assertRaises(Exception):
+            d.aggregate("", accumulators={"bytes": "median value.bytes"})
+
+    def test_get_many(self):
+        d = self._dict_to_test
+
+        d["1"] = 22
+        d["2"] = "foo"
+        d[3] = ["bar"]
+
+        self._testcase_instance.assertEqual(d.get_many(["1", "2", 3, "5"]), {"1": 22, "2": "foo", 3: ["bar"], "5": None})
+        self._testcase_instance.assertEqual(d.get_many(["5"], default=0), {"5": 0})
+
+        del d["1"]
+        self._testcase_instance.assertEqual(d.get_many(["1", "2"], default=0), {"1": 0, "2": "foo"})
+
+    def test_set_many_delete_many(self):
+        d = self._dict_to_test
+
+        self._testcase_instance.assertEqual(len(d), 0)
+        d["1"] = 11
+        d.set_many({"1": 22, "2": "foo", "3": ["bar"]})
+
+        self._testcase_instance.assertEqual(len(d), 3)
+        self._testcase_instance.assertEqual(d["1"], 22)
+        self._testcase_instance.assertEqual(d["3"], ["bar"])
+
+        d.delete_many(["1", "3", "5"])
+
+        self._testcase_instance.assertEqual(len(d), 1)
+        self._testcase_instance.assertFalse("1" in d)
+        self._testcase_instance.assertEqual(d["2"], "foo")
+
 
 class MongoDictTests(unittest.TestCase):
 
@@ -188,6 +343,35 @@ class MongoDictTests(unittest.TestCase):
         test = CheckDict(self, self.m)
         test.test_items()
 
+    def test_set_many_delete_many(self):
+        test = CheckDict(self, self.m)
+        test.test_set_many_delete_many()
+
+    def test_get_many(self):
+        test = CheckDict(self, self.m)
+        test.test_get_many()
+
+    def test_iteration_options(self):
+        test = CheckDict(self, self.m)
+        test.test_iteration_options()
+
+    def test_scan(self):
+        test = CheckDict(self, self.m)
+        test.test_scan()
+
+    def test_split_scan(self):
+        test = CheckDict(self, self.m)
+        test.test_split_scan()
+
+    def test_split_scan_few_entries(self):
+        test = CheckDict(self, self.m)
+        test.test_split_scan_few_entries()
+
+    def test_split_scan_empty_dict(self):
+        self.assertEqual(len(self.m.split_scan(4)), 1)
+        self.m["1"] = 1
+        self.assertEqual(len(self.m.split_scan(4)), 1)
+
     def test_update(self):
         test = CheckDict(self, self.m)
         test.test_update()
@@ -196,6 +380,50 @@ class MongoDictTests(unittest.TestCase):
         test = CheckDict(self, self.m)
         test.test_query()
 
+    def test_prepared_query(self):
+        test = CheckDict(self, self.m)
+        test.test_prepared_query()
+
+    def test_query_options(self):
+        test = CheckDict(self, self.m)
+        test.test_query_options()
+
+    def test_aggregate(self):
+        test = CheckDict(self, self.m)
+        test.test_aggregate()
+
+    def test_key_index(self):
+        indexes = self.m._instance.index_information()
+
+        self.assertNotIn(LEGACY_KEY_INDEX, indexes)
+        self.assertEqual(indexes[KEY_INDEX]['key'], [('key', 1)])
+        self.assertTrue(indexes[KEY_INDEX]['unique'])
+
+    def test_key_index_over_duplicated_keys(self):
+        collection = self.m._instance
+        collection.drop_index(KEY_INDEX)
+        collection.insert_many([{'key': "a", 'value': 1}, {'key': "b", 'value': 2}, {'key': "a", 'value': 3},
+                                {'key': 1, 'value': 4}, {'key': 1.0, 'value': 5}, {'key': True, 'value': 6}])
+        CLIENT_POOL.forget_key_index(collection)
+
+        # Loading a dict never removes documents
+        with self.assertRaises(Exception):
+            MongoDict(self.m.get_my_id(), mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+        dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+        with self.assertRaises(Exception):
+            dropper.migrate_key_index(self.m.get_my_id())
+
+        self.assertEqual(collection.count_documents({}), 6)
+        self.assertEqual(dropper.migrate_key_index(self.m.get_my_id(), remove_duplicates=True), 2)
+
+        self.assertTrue(collection.index_information()[KEY_INDEX]['unique'])
+        self.assertEqual(collection.count_documents({}), 4)
+        self.assertEqual(self.m["a"], 3)
+        self.assertEqual(self.m[1], 5)
+        self.assertEqual(self.m[True], 6)
+
     def tearDown(self):
         self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
         self.dropper.drop_dict(self.m.get_my_id())
@@ -239,6 +467,30 @@ class ForkedMongoDictTests(unittest.TestCase):
         test = CheckDict(self, self.fork)
         test.test_items()
 
+    def test_set_many_delete_many(self):
+        test = CheckDict(self, self.fork)
+        test.test_set_many_delete_many()
+
+    def test_get_many(self):
+        test = CheckDict(self, self.fork)
+        test.test_get_many()
+
+    def test_iteration_options(self):
+        test = CheckDict(self, self.fork)
+        test.test_iteration_options()
+
+    def test_scan(self):
+        test = CheckDict(self, self.fork)
+        test.test_scan()
+
+    def test_split_scan(self):
+        test = CheckDict(self, self.fork)
+        test.test_split_scan()
+
+    def test_split_scan_few_entries(self):
+        test = CheckDict(self, self.fork)
+        test.test_split_scan_few_entries()
+
     def test_update(self):
         test = CheckDict(self, self.fork)
         test.test_update()
@@ -247,6 +499,18 @@ class ForkedMongoDictTests(unittest.TestCase):
         test = CheckDict(self, self.fork)
         test.test_query()
 
+    def test_prepared_query(self):
+        test = CheckDict(self, self.fork)
+        test.test_prepared_query()
+
+    def test_query_options(self):
+        test = CheckDict(self, self.fork)
+        test.test_query_options()
+
+    def test_aggregate(self):
+        test = CheckDict(self, self.fork)
+        test.test_aggregate()
+
     def tearDown(self):
         self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
         self.dropper.drop_dict(self.original.get_my_id())
@@ -309,6 +573,16 @@ class ForkedMongoDictTests2(unittest.TestCase):
         test.test_items()
         self._assert_original_kept()
 
+    def test_set_many_delete_many(self):
+        test = CheckDict(self, self.fork)
+        test.test_set_many_delete_many()
+        self._assert_original_kept()
+
+    def test_get_many(self):
+        test = CheckDict(self, self.fork)
+        test.test_get_many()
+        self._assert_original_kept()
+
     def test_update(self):
         test = CheckDict(self, self.fork)
         test.test_update()
@@ -319,6 +593,21 @@ class ForkedMongoDictTests2(unittest.TestCase):
         test.test_query()
         self._assert_original_kept()
 
+    def test_prepared_query(self):
+        test = CheckDict(self, self.fork)
+        test.test_prepared_query()
+        self._assert_original_kept()
+
+    def test_query_options(self):
+        test = CheckDict(self, self.fork)
+        test.test_query_options()
+        self._assert_original_kept()
+
+    def test_aggregate(self):
+        test = CheckDict(self, self.fork)
+        test.test_aggregate()
+        self._assert_original_kept()
+
     def _drop(self):
         self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
         try:
@@ -399,6 +688,249 @@ class ForkedMongoDictTests3(unittest.TestCase):
         test.test_items()
         self._assert_original_kept()
 
+    def test_query_hides_overrides(self):
+        self.fork1["val1"] = 99
+        self.fork1["val4"] = 55
+
+        for threshold in [mongo_dict.FORK_MERGE_THRESHOLD, 0]:
+            fork = self.fork1.fork("fork3", merge_threshold=threshold)
+
+            with patch.object(fork, "_merged_documents", wraps=fork._merged_documents) as merged_documents:
+                self.assertEqual([key for key, _, _ in fork("value = 55")], ["val4"])
+                self.assertEqual(list(fork("value = 55", count_only=True)), [1])
+                self.assertEqual(sorted(key for key, _, _ in fork("")), ["val1", "val2", "val3", "val4"])
+
+            self.assertEqual(merged_documents.called, threshold == 0)
+
+    def test_sorted_query_across_layers(self):
+        self.fork1["val1"] = 60
+        self.fork1["val4"] = 1
+        del self.fork1["val2"]
+
+        self.assertEqual([(key, value) for key, value, _ in self.fork1("", sort="value desc")],
+                         [("val3", 65), ("val1", 60), ("val4", 1)])
+        self.assertEqual([key for key, _, _ in self.fork1("", sort="value desc", skip=1, limit=2)], ["val1", "val4"])
+        self.assertEqual([(key, value) for key, value, _ in self.fork1("value > 50", sort="value", limit=1)],
+                         [("val1", 60)])
+        self.assertEqual(list(self.fork1("value > 50", count_only=True, sort="value", skip=1)), [1])
+
+    def test_aggregate_across_layers(self):
+        self.fork1["val1"] = 5
+        del self.fork1["val2"]
+
+        accumulators = {"total": "sum value", "entries": "count", "min": "min value", "max": "max value",
+                        "avg": "avg value"}
+
+        self.assertEqual(self.fork1.aggregate("", accumulators=accumulators),
+                         [{"total": 70, "entries": 2, "min": 5, "max": 65, "avg": 35}])
+        self.assertEqual(self.fork1.aggregate("value > 50", accumulators={"entries": "count"}), [{"entries": 1}])
+        self.assertEqual(self.fork1.aggregate("", group_by="key", accumulators={"total": "sum value"}),
+                         [{"key": "val1", "total": 5}, {"key": "val3", "total": 65}])
+
+        # The father still counts its own entries
+        self.assertEqual(self.original.aggregate("", accumulators=accumulators),
+                         [{"total": 55, "entries": 2, "min": 55, "max": "hello", "avg": 55}])
+
+    def test_aggregate_decimal128_across_layers(self):
+        self.fork1["val1"] = Decimal128("1.5")
+        fork3 = self.fork1.fork("fork3")
+        fork3["val4"] = Decimal128("2.25")
+        fork3["val5"] = 1
+
+        [row] = fork3.aggregate("", accumulators={"total": "sum value", "avg": "avg value"})
+
+        # Sums of different layers are combined as Decimal128, like MongoDB does
+        self.assertIs(type(row["total"]), Decimal128)
+        self.assertEqual(row["total"].to_decimal(), Decimal("69.75"))
+        self.assertEqual(row["avg"].to_decimal(), Decimal("17.4375"))
+
+    def test_value_index(self):
+        name = self.fork1.create_value_index("value.age, value.ts desc")
+
+        self.assertEqual(name, "value.age_1_value.ts_-1")
+        self.assertEqual(self.fork1.value_indexes(), {name: [("value.age", 1), ("value.ts", -1)]})
+
+        for layer in self.fork1._layers():
+            self.assertIn(name, layer._instance.index_information())
+
+        # Forks and new versions get the index too
+        fork3 = self.fork1.fork("fork3")
+        self.assertIn(name, fork3.value_indexes())
+        self.assertIn(name, fork3._instance.index_information())
+        self.assertIn(name, self.fork1._instance.index_information())
+
+        with self.assertRaises(Exception):
+            self.fork1.create_value_index("key")
+
+    def test_index_advisor(self):
+        INDEX_ADVISOR.reset()
+        INDEX_ADVISOR.enable()
+
+        try:
+            list(self.fork1("value > 40"))
+            list(self.fork1("value > 50", sort="key"))
+            self.assertEqual(INDEX_ADVISOR.report(), [{'dict': "fork1", 'index': [("value", 1)], 'queries': 2}])
+
+            self.fork1.create_value_index("value")
+            list(self.fork1("value > 40"))
+            self.assertEqual(INDEX_ADVISOR.report()[0]['queries'], 2)
+        finally:
+            INDEX_ADVISOR.disable()
+            INDEX_ADVISOR.reset()
+
+    def test_keys_merge(self):
+        self.fork1["val1"] = "overridden"
+        self.fork1[0] = "number"
+
+        self.assertEqual(self.fork1.keys(), [0, "val1", "val2", "val3"])
+        self.assertEqual(list(self.fork1), [0, "val1", "val2", "val3"])
+        self.assertEqual(sorted(self.fork1.iter_keys(sort=False), key=str), [0, "val1", "val2", "val3"])
+        self.assertEqual(list(self.fork2.iter_keys(chunked=True)), [])
+
+    def test_length_counter(self):
+        self.fork1["val1"] = "overridden"
+        del self.fork1["missing"]
+        self.fork1.set_many({"val4": 4, "val2": "overridden"})
+        self.assertEqual(len(self.fork1), 4)
+
+        with self.fork1.bulk() as b:
+            b["val5"] = 5
+            del b["val1"]
+            del b["val6"]
+
+        self.assertEqual(len(self.fork1), 4)
+        self.assertEqual(self.fork1.recount(), 4)
+
+        self.fork2["val1"] = 1
+        self.assertEqual(len(self.fork2), 1)
+
+        self.fork2._forget_length()
+        self.assertEqual(len(self.fork2), 1)
+        self.assertEqual(len(self.original), 2)
+
+        # Forking again into an existing fork does not reset its counter to the length of the father
+        reforked = self.fork1.fork("fork2")
+        self.assertEqual(len(reforked), reforked.recount())
+
+    def test_layers(self):
+        self.assertEqual([layer._instance.name for layer in self.fork2._layers()], ["fork2", "fork1", "original"])
+        self.assertEqual([layer._instance.name for layer in self.fork1._layers()], ["fork1v1", "fork1", "original"])
+        self.assertEqual(self.fork2._get_many_raw(["val1", "val3"])[bson_identity("val3")]["value"], None)
+        self.assertEqual(self.fork1._get_many_raw(["val1", "val3"])[bson_identity("val3")]["value"], 65)
+
+    def test_metadata_chain(self):
+        self.assertEqual(sorted(self.fork2._read_metadata_chain()), ["fork1", "fork2", "original"])
+        self.assertEqual(self.fork2._read_metadata_chain()["fork2"]["ancestor_fork"], "fork1")
+
+        # The whole chain is loaded from a single read of the metadata
+        chain = self.fork2._read_metadata_chain()
+        reopened = MongoDict("fork2", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT, metadata_chain=chain)
+        self.assertEqual([layer._instance.name for layer in reopened._layers()], ["fork2", "fork1", "original"])
+        self.assertFalse("val1" in reopened)
+        self.assertEqual(reopened._fork_father["val3"], 65)
+
+    def test_compact(self):
+        progress = []
+        self.fork2["val4"] = 75
+        self.fork2.compact(progress_callback=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(type(self.fork2), MongoDict)
+        self.assertEqual(len(self.fork2._layers()), 1)
+        self.assertEqual(self.fork2.keys(), ["val4"])
+        self.assertEqual(self.fork2["val4"], 75)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self._assert_original_kept()
+
+        reopened = MongoDict("fork2", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+        self.assertEqual(reopened["val4"], 75)
+        self.assertFalse("val1" in reopened)
+
+        self.fork1.compact()
+        self.assertEqual(len(self.fork1), 3)
+        self.assertEqual(self.fork1["val3"], 65)
+
+    def test_compact_does_not_hide_server_errors(self):
+        if not CLIENT_POOL.supports(self.fork2._client, '$merge'):
+            self.skipTest("The backend does not support $merge")
+
+        def fail(*args, **kwargs):
+            raise OperationFailure("not authorized", code=13)
+
+        self.fork2._compact_server_side = fail
+
+        with self.assertRaises(OperationFailure):
+            self.fork2.compact()
+
+        self.assertTrue(CLIENT_POOL.supports(self.fork2._client, '$merge'))
+
+    def test_frozen_layers_skip_lookups(self):
+        # fork1 moved to a new version when fork2 was created: its layers are fork1v1, fork1 and original
+        frozen_original = self.fork1._layers()[-1]
+        self.assertEqual(frozen_original._instance.name, "original")
+
+        self.assertTrue(frozen_original._layer_might_contain("val1"))
+        self.assertFalse(frozen_original._layer_might_contain("val3"))
+
+        with self.assertRaises(KeyError):
+            self.fork1["val4"]
+
+        self.assertFalse(frozen_original._layer_might_contain("val4"))
+        self.assertEqual(self.fork1.get_many(["val1", "val3", "val4"]), {"val1": 55, "val3": 65, "val4": None})
+
+    def test_frozen_layer_filters_are_shared(self):
+        frozen_original = self.fork1._layers()[-1]
+        self.assertFalse(frozen_original._layer_might_contain("val3"))
+
+        # Dicts opened later reuse the Bloom filter instead of scanning the layer again
+        reopened = MongoDict("fork1", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)._layers()[-1]
+        self.assertTrue(reopened._layer_might_contain("val1"))
+        self.assertIs(reopened._key_filter, frozen_original._key_filter)
+
+    def test_frozen_layers_match_keys_like_mongodb(self):
+        self.fork1[1] = "int"
+        self.fork1[{"a": 4}] = "dict"
+        fork3 = self.fork1.fork("fork3")
+        frozen_fork1 = fork3._layers()[1]
+        self.assertEqual(frozen_fork1._instance.name, "fork1v1")
+
+        # A miss of True must not skip the layer for 1
+        with self.assertRaises(KeyError):
+            fork3[True]
+
+        self.assertTrue(frozen_fork1._layer_might_contain(1))
+        self.assertEqual(fork3[1], "int")
+        self.assertEqual(fork3[{"a": 4.0}], "dict")
+
+    def test_set_many_delete_many(self):
+        test = CheckDict(self, self.fork2)
+        test.test_set_many_delete_many()
+        self._assert_original_kept()
+
+    def test_get_many(self):
+        test = CheckDict(self, self.fork2)
+        test.test_get_many()
+        self._assert_original_kept()
+
+    def test_iteration_options(self):
+        test = CheckDict(self, self.fork2)
+        test.test_iteration_options()
+        self._assert_original_kept()
+
+    def test_scan(self):
+        test = CheckDict(self, self.fork2)
+        test.test_scan()
+        self._assert_original_kept()
+
+    def test_split_scan(self):
+        test = CheckDict(self, self.fork2)
+        test.test_split_scan()
+        self._assert_original_kept()
+
+    def test_split_scan_few_entries(self):
+        test = CheckDict(self, self.fork2)
+        test.test_split_scan_few_entries()
+        self._assert_original_kept()
+
     def test_update(self):
         test = CheckDict(self, self.fork2)
         test.test_update()
@@ -409,12 +941,55 @@ class ForkedMongoDictTests3(unittest.TestCase):
         test.test_query()
         self._assert_original_kept()
 
+    def test_prepared_query(self):
+        test = CheckDict(self, self.fork2)
+        test.test_prepared_query()
+        self._assert_original_kept()
+
+    def test_query_options(self):
+        test = CheckDict(self, self.fork2)
+        test.test_query_options()
+        self._assert_original_kept()
+
+    def test_aggregate(self):
+        test = CheckDict(self, self.fork2)
+        test.test_aggregate()
+        self._assert_original_kept()
+
+    def test_bool_int_and_dict_keys_lookups(self):
+        self.fork1[1] = "int"
+        self.fork1[{"a": 1}] = "dict"
+        fork3 = self.fork1.fork("fork3")
+        fork3[True] = "bool"
+        fork3[{"a": 1.0}] = "dict2"
+
+        self.assertEqual(fork3.get_many([1, "val1"]), {1: "int", "val1": 55})
+        self.assertEqual(fork3.get_many([True]), {True: "bool"})
+        self.assertEqual(fork3[{"a": 1}], "dict2")
+        self.assertEqual(len(fork3), 6)
+        self.assertEqual(fork3.recount(), 6)
+
+    def test_bool_and_int_keys_across_layers(self):
+        self.fork1[1] = "int"
+        self.fork1[True] = "bool"
+        fork3 = self.fork1.fork("fork3")
+        del fork3[True]
+
+        # True and 1 are equal for Python, but the removal of True must not hide 1
+        expected = [(1, "int"), ("val1", 55), ("val2", "hello"), ("val3", 65)]
+        self.assertEqual(sorted((key, value) for key, value, _ in fork3("") if key is not True), expected)
+        self.assertEqual(len(list(fork3(""))), 4)
+        self.assertEqual([key for key, _, _ in fork3("value = 'int'", sort="key")], [1])
+        self.assertEqual(len([entry for page, _ in fork3.scan(page_size=2) for entry in page]), 4)
+        self.assertNotIn(True, fork3)
+
     def _drop_db(self):
         try:
             self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
             self.dropper.drop_dict("original")
             self.dropper.drop_dict("fork1")
             self.dropper.drop_dict("fork2")
+            self.dropper.drop_dict("fork3")
 
         except:
             pass
@@ -455,6 +1030,201 @@ class ForkSituationsTest(unittest.TestCase):
             pass
 
 
+class MongoDictCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(max_entries=100)
+        self.m = MongoDict(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT, cache=self.cache)
+
+    def test_reads_are_cached(self):
+        self.m["1"] = "foo"
+        self.m._instance.replace_one({'key': "1"}, {'key': "1", 'value': "changed outside"})
+
+        self.assertEqual(self.m["1"], "foo")
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_writes_update_cache(self):
+        self.m["1"] = "foo"
+        self.m["1"] = "bar"
+        self.assertEqual(self.m["1"], "bar")
+
+        del self.m["1"]
+        with self.assertRaises(KeyError):
+            self.m["1"]
+
+        with self.m.bulk() as b:
+            b["2"] = "foo"
+
+        self.assertEqual(self.m["2"], "foo")
+
+    def test_bool_and_int_keys_are_cached_apart(self):
+        self.m[True] = "bool"
+        self.m[1] = "int"
+
+        self.assertEqual(self.m[True], "bool")
+        self.assertEqual(self.m[1], "int")
+
+        del self.m[1]
+        self.assertEqual(self.m[True], "bool")
+
+        self.m[{"a": 1}] = "dict"
+        self.assertEqual(self.m[{"a": 1}], "dict")
+        self.assertEqual(self.cache.hits, 4)
+
+    def test_large_int_keys_are_cached_apart(self):
+        self.m[2 ** 53] = "a"
+        self.m[2 ** 53 + 1] = "b"
+
+        self.assertEqual(self.m[2 ** 53], "a")
+        self.assertEqual(self.m[2 ** 53 + 1], "b")
+        self.assertEqual(self.m[float(2 ** 53)], "a")
+
+    def test_fork_shares_cache(self):
+        self.m["1"] = "foo"
+        fork = self.m.fork()
+        fork["1"] = "bar"
+
+        self.assertEqual(fork["1"], "bar")
+        self.assertEqual(self.m["1"], "foo")
+
+        DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT).drop_dict(fork.get_my_id())
+
+    def tearDown(self):
+        self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+        self.dropper.drop_dict(self.m.get_my_id())
+
+
+class BulkWriteBehindTests(unittest.TestCase):
+
+    def setUp(self):
+        self.m = MongoDict(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+    def test_write_behind(self):
+        with self.m.bulk(buffer_size=100, write_behind=True, max_in_flight=2) as b:
+            for x in range(2000):
+                b["key{}".format(x)] = x
+
+        self.assertEqual(len(self.m), 2000)
+        self.assertEqual(self.m["key1999"], 1999)
+
+    def test_write_behind_errors_are_raised(self):
+        self.m["key5"] = 5
+
+        with self.assertRaises(BulkWriteError):
+            with self.m.bulk(buffer_size=10, do_upserts=False, write_behind=True) as b:
+                for x in range(100):
+                    b["key{}".format(x)] = x
+
+    def test_adaptive_buffer_size(self):
+        with self.m.bulk(buffer_size=1000, target_bytes=4096) as b:
+            for x in range(500):
+                b["key{}".format(x)] = "x" * 100
+
+        stats = b.stats()
+
+        self.assertEqual(len(self.m), 500)
+        self.assertEqual(sum(commit['operations'] for commit in stats['commits']), 500)
+        self.assertTrue(all(commit['bytes'] <= 4096 + 200 for commit in stats['commits']))
+        self.assertLess(stats['buffer_size'], 1000)
+
+    def test_auto_upserts(self):
+        self.m["key5"] = "old"
+
+        with self.m.bulk(buffer_size=50, do_upserts="auto") as b:
+            for x in range(100):
+                b["key{}".format(x)] = x
+
+            b["key7"] = "last"
+            del b["key8"]
+
+        self.assertEqual(len(self.m), 99)
+        self.assertEqual(self.m["key5"], 5)
+        self.assertEqual(self.m["key7"], "last")
+        self.assertNotIn("key8", self.m)
+
+    def test_auto_upserts_tell_keys_apart_like_mongodb(self):
+        self.m[True] = "old"
+
+        # True and 1 are equal for Python, but not for MongoDB
+        with self.m.bulk(do_upserts="auto") as b:
+            b[1] = "one"
+            b[True] = "true"
+
+        self.assertEqual(self.m.get_many([1, True]), {1: "one", True: "true"})
+        self.assertEqual(len(self.m), 2)
+
+    def test_auto_upserts_on_fork(self):
+        self.m["key1"] = 1
+        self.m["key2"] = 2
+        fork = self.m.fork()
+
+        with fork.bulk(do_upserts="auto") as b:
+            del b["key1"]
+            b["key3"] = 3
+
+        with fork.bulk(do_upserts="auto") as b:
+            b["key1"] = "back"
+
+        self.assertEqual(fork["key1"], "back")
+        self.assertEqual(self.m["key1"], 1)
+        self.assertEqual(len(fork), 3)
+
+        self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+        self.dropper.drop_dict(fork.get_my_id())
+
+    def test_parallel_bulk(self):
+        with self.m.parallel_bulk(workers=4, buffer_size=100) as b:
+            for x in range(2000):
+                b["key{}".format(x)] = x
+
+            del b["key0"]
+
+        self.assertEqual(len(self.m), 1999)
+        self.assertNotIn("key0", self.m)
+        self.assertEqual(self.m["key1999"], 1999)
+
+    def test_parallel_bulk_stats(self):
+        with self.m.parallel_bulk(workers=2, buffer_size=100) as b:
+            for x in range(1000):
+                b["key{}".format(x)] = x
+
+        stats = b.stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(sum(commit['operations'] for worker in stats for commit in worker['commits']), 1000)
+        self.assertTrue(all(worker['buffer_size'] == 100 for worker in stats))
+
+    def test_operations_over_a_key_in_one_buffer(self):
+        with self.m.bulk(buffer_size=100) as b:
+            b["k1"] = 1
+            del b["k1"]
+            b["k1"] = 2
+            b["k2"] = 1
+            del b["k2"]
+
+        with self.m.parallel_bulk(workers=2, buffer_size=100) as b:
+            b["k3"] = 1
+            del b["k3"]
+            b["k3"] = 3
+
+        self.assertEqual(self.m["k1"], 2)
+        self.assertNotIn("k2", self.m)
+        self.assertEqual(self.m["k3"], 3)
+
+    def test_large_int_keys_in_one_buffer(self):
+        with self.m.bulk(buffer_size=100) as b:
+            b[2 ** 53] = "a"
+            b[2 ** 53 + 1] = "b"
+
+        self.assertEqual(len(self.m), 2)
+        self.assertEqual(self.m[2 ** 53], "a")
+        self.assertEqual(self.m[2 ** 53 + 1], "b")
+        self.assertEqual(mongo_dict.BulkMongoDict._latest_indexes([2 ** 53, 2 ** 53 + 1]), [0, 1])
+
+    def tearDown(self):
+        self.dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+        self.dropper.drop_dict(self.m.get_my_id())
+
+
 class BenchmarkTest(unittest.TestCase):
 
     def setUp(self):
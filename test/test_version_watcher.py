@@ -0,0 +1,207 @@
+import gc
+import os
+import unittest
+from time import sleep
+
+from pymdict.mongo_client_pool import CLIENT_POOL, MongoClientPool
+from pymdict.mongo_dict import ___MONGO_DICT_META___, MongoDict, DictDropper
+from pymdict.version_watcher import VERSION_CHANGES_PIPELINE, VersionWatcher, _MetadataWatcher
+
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+
+
+class WatchedDict:
+
+    def __init__(self, dict_id):
+        self._dict_id = dict_id
+        self.versions = None
+
+    def get_my_id(self):
+        return self._dict_id
+
+    def _check_versions(self, versions):
+        self.versions = versions
+
+
+class MetaCollection:
+
+    def __init__(self, collection):
+        self._instance = collection
+
+
+class PooledWatchedDict(WatchedDict):
+
+    def __init__(self, dict_id, client):
+        WatchedDict.__init__(self, dict_id)
+        self._client = client
+
+    def _get_dict_meta(self):
+        return MetaCollection(self._client["mongo_dicts"][___MONGO_DICT_META___])
+
+
+class MetadataWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        client = CLIENT_POOL.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        self.watcher = _MetadataWatcher(client["mongo_dicts"][___MONGO_DICT_META___], interval=1)
+
+    def test_notify(self):
+        d1 = WatchedDict("d1")
+        d1_bis = WatchedDict("d1")
+        d2 = WatchedDict("d2")
+
+        for d in [d1, d1_bis, d2]:
+            self.watcher.watch(d)
+
+        self.watcher._notify("d1", {'version': [1, 2]})
+
+        self.assertEqual(d1.versions, [1, 2])
+        self.assertEqual(d1_bis.versions, [1, 2])
+        self.assertIsNone(d2.versions)
+
+        self.watcher.unwatch(d1)
+        self.watcher._notify("d1", {'version': [1, 2, 3]})
+        self.assertEqual(d1.versions, [1, 2])
+        self.assertEqual(d1_bis.versions, [1, 2, 3])
+
+    def test_dicts_are_weakly_referenced(self):
+        d1 = WatchedDict("d1")
+        d2 = WatchedDict("d2")
+        self.watcher.watch(d1)
+        self.watcher.watch(d2)
+
+        del d1
+        gc.collect()
+
+        self.assertEqual(self.watcher._watched_ids(), ["d2"])
+
+    def test_stops_without_dicts(self):
+        stopped = []
+        watcher = _MetadataWatcher(self.watcher._meta_collection, interval=0.1, on_stop=stopped.append)
+        d1 = WatchedDict("d1")
+        watcher.watch(d1)
+        watcher.start()
+
+        del d1
+        gc.collect()
+        watcher.join(5)
+
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(stopped, [watcher])
+        self.assertFalse(watcher.watch(WatchedDict("d2")))
+
+    def test_change_stream_filters_version_changes(self):
+        # Change events are documents, so the pipeline can be checked on a regular collection
+        events = CLIENT_POOL.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts")["mongo_dicts"]["watcher_events"]
+        events.drop()
+        full_document = {'key': 'd1', 'value': {'version': ['v1'], 'lengths': {'d1': 3}}}
+        events.insert_many([
+            {'_id': 1, 'operationType': 'insert', 'fullDocument': full_document},
+            {'_id': 2, 'operationType': 'update', 'fullDocument': full_document,
+             'updateDescription': {'updatedFields': {'value.version.0': 'v1'}}},
+            {'_id': 3, 'operationType': 'update', 'fullDocument': full_document,
+             'updateDescription': {'updatedFields': {'value.version': ['v1']}}},
+            {'_id': 4, 'operationType': 'update', 'fullDocument': full_document,
+             'updateDescription': {'updatedFields': {'value.lengths.d1': 3}}},
+            {'_id': 5, 'operationType': 'update', 'fullDocument': full_document,
+             'updateDescription': {'updatedFields': {'value.versions_count': 1}}},
+            {'_id': 6, 'operationType': 'delete'},
+        ])
+
+        try:
+            changes = list(events.aggregate(VERSION_CHANGES_PIPELINE + [{'$sort': {'_id': 1}}]))
+        finally:
+            events.drop()
+
+        self.assertEqual([change['_id'] for change in changes], [1, 2, 3])
+        self.assertEqual(changes[0]['fullDocument'], {'key': 'd1', 'value': {'version': ['v1']}})
+
+
+class VersionWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = MongoClientPool()
+        self.version_watcher = VersionWatcher(interval=0.1)
+        self.pool.add_close_listener(self.version_watcher.forget_client)
+
+    def test_watchers_are_forgotten(self):
+        d1 = PooledWatchedDict("d1", self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts"))
+        self.version_watcher.watch(d1)
+        watcher = list(self.version_watcher._watchers.values())[0]
+
+        # A new watcher replaces the one that stopped because it had no dicts left
+        del d1
+        gc.collect()
+        watcher.join(5)
+        self.assertEqual(self.version_watcher._watchers, {})
+
+        d2 = PooledWatchedDict("d2", self.pool.get_client(MONGO_HOST, MONGO_PORT, "mongo_dicts"))
+        self.version_watcher.watch(d2)
+        watcher = list(self.version_watcher._watchers.values())[0]
+        self.assertTrue(watcher.is_alive())
+
+        # Closing the client stops its watcher, even if it still has dicts to watch
+        self.pool.close(MONGO_HOST, MONGO_PORT, "mongo_dicts")
+        watcher.join(5)
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(self.version_watcher._watchers, {})
+
+    def tearDown(self):
+        self.pool.close_all()
+
+
+class VersionWatcherForkTests(unittest.TestCase):
+
+    def setUp(self):
+        self._drop_db()
+        # Starts the watcher of the metadata collection in the parent process
+        self.parent_dict = MongoDict("watched_after_fork", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "os.fork() is not available")
+    def test_child_sees_version_changes(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                watched = MongoDict("watched_after_fork", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+                writer = MongoDict("watched_after_fork", mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+                writer["1"] = 1
+                writer.fork("watched_after_fork_child")
+
+                for _ in range(50):
+                    if watched._update_required:
+                        break
+
+                    sleep(0.1)
+
+                result = b"1" if watched._update_required else b"0"
+            except Exception:
+                result = b"E"
+
+            os.write(write_fd, result)
+            os._exit(0)
+
+        os.close(write_fd)
+        result = os.read(read_fd, 1)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(result, b"1")
+
+    def tearDown(self):
+        self._drop_db()
+
+    def _drop_db(self):
+        dropper = DictDropper(mongo_host=MONGO_HOST, mongo_port=MONGO_PORT)
+
+        for dict_id in ["watched_after_fork", "watched_after_fork_child"]:
+            try:
+                dropper.drop_dict(dict_id)
+            except Exception:
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()